@@ -0,0 +1,66 @@
+"""
+Gunicorn settings for production, picked up by the Procfile (`gunicorn -c gunicorn.conf.py main:app`).
+Everything can be overridden with environment variables, see docs/LOAD_TESTING.md
+"""
+import multiprocessing
+import os
+import shutil
+
+# main.py imports its sibling modules (models, utils...), so the app runs from src/
+chdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+bind = f"0.0.0.0:{os.environ.get('PORT', 3702)}"
+
+"""
+! Workers
+? gthread workers serve THREADS requests each: while a thread waits on the
+? database, on a password hash (hashlib releases the GIL, see passwords.py) or
+? on the /events stream, which holds its request open, the others keep
+? serving. sync workers serve one request at a time, so a login storm pins
+? them all and every other request queues behind it. Every worker (and
+? thread) can hold a pooled connection, so
+? WEB_CONCURRENCY * THREADS should stay below DB_POOL_SIZE + DB_MAX_OVERFLOW
+? per worker and the database's max connections overall
+"""
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 4 if worker_class == "gthread" else 1))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# Recycling workers now and then bounds the growth of the per-worker caches
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+"""
+! Preloading
+? The app is imported once in the master and forked, which saves memory and
+? startup time. Whatever the master opened is shared after the fork, so each
+? worker throws away the inherited database connections (without closing them,
+? they still belong to the master). The event hub and the password hashing pool
+? start themselves lazily in each process
+"""
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+
+"""
+! Metrics
+? Workers write their metrics to files in this directory and /metrics adds them
+? up, whichever worker serves it. It has to exist before the app is preloaded;
+? the files of a previous run are removed when gunicorn starts, and the live
+? gauges of a worker are dropped when it exits
+"""
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/ucoll-metrics")
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+def on_starting(server):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def post_fork(server, worker):
+    from main import app
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -0,0 +1,38 @@
+"""coll keyset pagination: per-row timestamps and (timestamp, id) indexes
+
+Revision ID: 3c1f7a9e52d4
+Revises: d8e91af2abf3
+Create Date: 2026-10-18 10:12:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f7a9e52d4'
+down_revision = 'd8e91af2abf3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rows created before this revision may have no timestamp at all
+    op.execute("UPDATE coll SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL")
+    with op.batch_alter_table('coll') as batch_op:
+        batch_op.alter_column('timestamp',
+               existing_type=sa.DateTime(),
+               nullable=False,
+               server_default=sa.func.now())
+        batch_op.create_index('ix_coll_timestamp_id', ['timestamp', 'id'], unique=False)
+        batch_op.create_index('ix_coll_class_id_timestamp_id', ['class_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('coll') as batch_op:
+        batch_op.drop_index('ix_coll_class_id_timestamp_id')
+        batch_op.drop_index('ix_coll_timestamp_id')
+        batch_op.alter_column('timestamp',
+               existing_type=sa.DateTime(),
+               nullable=True,
+               server_default=None)
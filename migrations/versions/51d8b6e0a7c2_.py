@@ -0,0 +1,24 @@
+"""class_students index by class
+
+Revision ID: 51d8b6e0a7c2
+Revises: e4a91c27f6b8
+Create Date: 2026-10-18 13:05:48.271390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '51d8b6e0a7c2'
+down_revision = 'e4a91c27f6b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_class_students_class_id_user_id', 'class_students', ['class_id', 'user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_class_students_class_id_user_id', table_name='class_students')
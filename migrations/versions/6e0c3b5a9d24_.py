@@ -0,0 +1,32 @@
+"""stored content of the files
+
+Revision ID: 6e0c3b5a9d24
+Revises: 2d6a9e4c81f7
+Create Date: 2026-10-18 19:41:05.872310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e0c3b5a9d24'
+down_revision = '2d6a9e4c81f7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.add_column(sa.Column('sha256', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('size', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('mimetype', sa.String(length=100), nullable=True))
+        batch_op.create_index('ix_file_sha256', ['sha256'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.drop_index('ix_file_sha256')
+        batch_op.drop_column('mimetype')
+        batch_op.drop_column('size')
+        batch_op.drop_column('sha256')
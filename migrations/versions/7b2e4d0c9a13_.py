@@ -0,0 +1,37 @@
+"""coll like/dislike counters
+
+Revision ID: 7b2e4d0c9a13
+Revises: 3c1f7a9e52d4
+Create Date: 2026-10-18 11:02:17.604511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e4d0c9a13'
+down_revision = '3c1f7a9e52d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('coll', sa.Column('like_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('coll', sa.Column('dislike_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill the counters from the existing likes
+    coll = sa.table('coll', sa.column('id'), sa.column('like_count'), sa.column('dislike_count'))
+    liked_colls = sa.table('liked_colls', sa.column('coll_id'), sa.column('is_like'))
+    likes = sa.select(sa.func.count()).where(
+        liked_colls.c.coll_id == coll.c.id, liked_colls.c.is_like.is_(True)
+    ).scalar_subquery()
+    dislikes = sa.select(sa.func.count()).where(
+        liked_colls.c.coll_id == coll.c.id, liked_colls.c.is_like.is_(False)
+    ).scalar_subquery()
+    op.execute(coll.update().values(like_count=likes, dislike_count=dislikes))
+
+
+def downgrade():
+    op.drop_column('coll', 'dislike_count')
+    op.drop_column('coll', 'like_count')
@@ -0,0 +1,62 @@
+"""conversation summary table and message thread index
+
+Revision ID: 9d3c5e81b47f
+Revises: 51d8b6e0a7c2
+Create Date: 2026-10-18 14:11:32.508927
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3c5e81b47f'
+down_revision = '51d8b6e0a7c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("UPDATE message SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL")
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.alter_column('timestamp',
+               existing_type=sa.DateTime(),
+               nullable=False,
+               server_default=sa.func.now())
+        batch_op.create_index('ix_message_receiver_sender_timestamp', ['receiver', 'sender', 'timestamp', 'id'], unique=False)
+
+    op.create_table('conversation',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('counterpart_id', sa.Integer(), nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=False),
+    sa.Column('unread_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['counterpart_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['last_message_id'], ['message.id'], ),
+    sa.ForeignKeyConstraint(['owner_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'counterpart_id')
+    )
+    op.create_index('ix_conversation_owner_id_updated_at', 'conversation', ['owner_id', 'updated_at', 'counterpart_id'], unique=False)
+
+    # One row per side of every existing conversation, all of them read
+    op.execute("""
+        INSERT INTO conversation (owner_id, counterpart_id, last_message_id, unread_count, updated_at)
+        SELECT sides.owner_id, sides.counterpart_id, MAX(sides.id), 0, MAX(sides.timestamp)
+        FROM (
+            SELECT sender AS owner_id, receiver AS counterpart_id, id, timestamp FROM message
+            UNION ALL
+            SELECT receiver, sender, id, timestamp FROM message WHERE receiver <> sender
+        ) sides
+        GROUP BY sides.owner_id, sides.counterpart_id
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_conversation_owner_id_updated_at', table_name='conversation')
+    op.drop_table('conversation')
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.drop_index('ix_message_receiver_sender_timestamp')
+        batch_op.alter_column('timestamp',
+               existing_type=sa.DateTime(),
+               nullable=True,
+               server_default=None)
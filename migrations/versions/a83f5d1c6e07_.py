@@ -0,0 +1,30 @@
+"""metadata and preview state of the files
+
+Revision ID: a83f5d1c6e07
+Revises: 6e0c3b5a9d24
+Create Date: 2026-10-18 20:26:13.409518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83f5d1c6e07'
+down_revision = '6e0c3b5a9d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.add_column(sa.Column('pages', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('has_preview', sa.Boolean(), server_default=sa.false(), nullable=False))
+        batch_op.add_column(sa.Column('processed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.drop_column('processed_at')
+        batch_op.drop_column('has_preview')
+        batch_op.drop_column('pages')
@@ -0,0 +1,74 @@
+"""full-text search index for colls and files
+
+Revision ID: b62f0d4e8c91
+Revises: 9d3c5e81b47f
+Create Date: 2026-10-18 15:26:50.113842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b62f0d4e8c91'
+down_revision = '9d3c5e81b47f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("""
+            CREATE VIRTUAL TABLE search_index USING fts5(
+                title, content, kind UNINDEXED, ref_id UNINDEXED, class_id UNINDEXED, type UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        key = 'rowid'
+    elif dialect == 'postgresql':
+        op.execute("""
+            CREATE TABLE search_index (
+                doc_id BIGINT PRIMARY KEY,
+                kind VARCHAR(4) NOT NULL,
+                ref_id INTEGER NOT NULL,
+                class_id INTEGER,
+                type VARCHAR(12),
+                title TEXT,
+                content TEXT,
+                document TSVECTOR GENERATED ALWAYS AS (
+                    setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+                    setweight(to_tsvector('simple', coalesce(content, '')), 'B')
+                ) STORED
+            )
+        """)
+        op.execute("CREATE INDEX ix_search_index_document ON search_index USING GIN (document)")
+        key = 'doc_id'
+    else:
+        op.execute("""
+            CREATE TABLE search_index (
+                doc_id BIGINT PRIMARY KEY,
+                kind VARCHAR(4) NOT NULL,
+                ref_id INTEGER NOT NULL,
+                class_id INTEGER,
+                type VARCHAR(12),
+                title VARCHAR(60),
+                content TEXT,
+                FULLTEXT KEY ix_search_index_text (title, content)
+            )
+        """)
+        key = 'doc_id'
+
+    # doc_id = id * 2 + kind (0 = coll, 1 = file)
+    op.execute(f"""
+        INSERT INTO search_index ({key}, title, content, kind, ref_id, class_id, type)
+        SELECT id * 2, title, content, 'coll', id, class_id, type FROM coll
+    """)
+    op.execute(f"""
+        INSERT INTO search_index ({key}, title, content, kind, ref_id, class_id, type)
+        SELECT id * 2 + 1, title, '', 'file', id, class_id, type FROM file
+    """)
+
+
+def downgrade():
+    op.execute("DROP TABLE search_index")
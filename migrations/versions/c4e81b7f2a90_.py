@@ -0,0 +1,45 @@
+"""home timelines
+
+Revision ID: c4e81b7f2a90
+Revises: a83f5d1c6e07
+Create Date: 2026-10-18 21:12:40.583127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e81b7f2a90'
+down_revision = 'a83f5d1c6e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('coll_id', sa.Integer(), nullable=False),
+    sa.Column('class_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['class_id'], ['class.id'], ),
+    sa.ForeignKeyConstraint(['coll_id'], ['coll.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'coll_id')
+    )
+    op.create_index(op.f('ix_timeline_coll_id'), 'timeline', ['coll_id'], unique=False)
+    op.create_index('ix_timeline_user_id_timestamp_coll_id', 'timeline', ['user_id', 'timestamp', 'coll_id'], unique=False)
+    # Fills the timelines of the existing Colls (with the default TIMELINE_FANOUT_LIMIT,
+    # run `flask timeline rebuild` if it is set to something else)
+    op.execute(
+        "INSERT INTO timeline (user_id, coll_id, class_id, timestamp) "
+        "SELECT class_students.user_id, coll.id, coll.class_id, coll.timestamp FROM coll "
+        "JOIN class_students ON class_students.class_id = coll.class_id "
+        "WHERE (SELECT count(*) FROM class_students AS roster WHERE roster.class_id = coll.class_id) <= 1000"
+    )
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp_coll_id', table_name='timeline')
+    op.drop_index(op.f('ix_timeline_coll_id'), table_name='timeline')
+    op.drop_table('timeline')
@@ -0,0 +1,33 @@
+"""row versions for etags
+
+Revision ID: e4a91c27f6b8
+Revises: 7b2e4d0c9a13
+Create Date: 2026-10-18 12:20:05.930162
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a91c27f6b8'
+down_revision = '7b2e4d0c9a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    version_counter = op.create_table('version_counter',
+    sa.Column('name', sa.String(length=30), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(version_counter, [{'name': 'catalog', 'value': 1}])
+    op.add_column('coll', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('user', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('user', 'version')
+    op.drop_column('coll', 'version')
+    op.drop_table('version_counter')
@@ -0,0 +1,28 @@
+"""class files keyset pagination: (class_id, timestamp, id) index on file
+
+Revision ID: e7d2a5c31f48
+Revises: c4e81b7f2a90
+Create Date: 2026-10-18 11:42:17.406935
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7d2a5c31f48'
+down_revision = 'c4e81b7f2a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.create_index('ix_file_class_id_timestamp_id', ['class_id', 'timestamp', 'id'], unique=False)
+        batch_op.drop_index('ix_file_class_id')
+
+
+def downgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.create_index('ix_file_class_id', ['class_id'], unique=False)
+        batch_op.drop_index('ix_file_class_id_timestamp_id')
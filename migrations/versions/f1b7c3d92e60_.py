@@ -0,0 +1,48 @@
+"""indexes for the foreign keys and the feed sort columns
+
+Revision ID: f1b7c3d92e60
+Revises: c47a2e9b1d05
+Create Date: 2026-10-18 17:48:21.114862
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7c3d92e60'
+down_revision = 'c47a2e9b1d05'
+branch_labels = None
+depends_on = None
+
+# (index, table, columns). Foreign keys that already lead an index (message.receiver,
+# coll.class_id, class_students.class_id, the first column of every primary key) are left out
+INDEXES = [
+    ('ix_message_sender_timestamp', 'message', ['sender', 'timestamp', 'id']),
+    ('ix_coll_sender_id_timestamp_id', 'coll', ['sender_id', 'timestamp', 'id']),
+    ('ix_comment_coll_id', 'comment', ['coll_id']),
+    ('ix_comment_commenter_id', 'comment', ['commenter_id']),
+    ('ix_liked_colls_coll_id_is_like', 'liked_colls', ['coll_id', 'is_like']),
+    ('ix_liked_files_file_id', 'liked_files', ['file_id']),
+    ('ix_favorite_colls_coll_id', 'favorite_colls', ['coll_id']),
+    ('ix_favorite_files_file_id', 'favorite_files', ['file_id']),
+    ('ix_faculty_members_faculty_id', 'faculty_members', ['faculty_id']),
+    ('ix_tag_user_id', 'tag', ['user_id']),
+    ('ix_network_owner', 'network', ['owner']),
+    ('ix_faculty_college_id', 'faculty', ['college_id']),
+    ('ix_class_faculty_id', 'class', ['faculty_id']),
+    ('ix_file_class_id', 'file', ['class_id']),
+    ('ix_file_uploader_id', 'file', ['uploader_id']),
+    ('ix_conversation_counterpart_id', 'conversation', ['counterpart_id']),
+    ('ix_conversation_last_message_id', 'conversation', ['last_message_id']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
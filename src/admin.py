@@ -1,6 +1,6 @@
 import os
 from flask_admin import Admin
-from models import db, User, Message, Network, Tag, College, Faculty, Class, File, Coll, Comment, LikedFiles, LikedColls
+from models import db, User, Message, Network, Tag, College, Faculty, Class, File, Coll, Comment, LikedFiles, LikedColls, Job
 from flask_admin.contrib.sqla import ModelView
 
 def setup_admin(app):
@@ -22,6 +22,7 @@ def setup_admin(app):
     admin.add_view(ModelView(Comment, db.session))
     admin.add_view(ModelView(LikedFiles, db.session))
     admin.add_view(ModelView(LikedColls, db.session))
+    admin.add_view(ModelView(Job, db.session))
 
     # You can duplicate that line to add mew models
     # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
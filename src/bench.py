@@ -0,0 +1,485 @@
+"""
+This module benchmarks every route of the API through the Flask test client,
+recording latency percentiles and SQL query counts into a JSON report that can
+be diffed between commits. Run it on a scratch database filled by seed.py: the
+write routes are exercised too, undoing what they change after each request
+"""
+import io
+import statistics
+import threading
+import time
+import instrumentation
+import models
+import passwords
+import seed
+import previews
+import storage
+from utils import MAX_BATCH_SIZE
+from models import db, unit_of_work, ClassStudents, Job, Timeline, User, Message, Network, Tag, Class, File, Coll, Comment, LikedColls
+
+# Rows sent to each batch endpoint by the route scenarios
+BATCH = 10
+# Content of the Files uploaded by the scenarios (256 KB)
+FILE = bytes(range(256)) * 1024
+
+# Routes that are left out on purpose, with the reason why
+SKIPPED = {
+    "GET /events": "endless stream",
+    "GET /static/<path:filename>": "static files",
+    "GET /metrics": "monitoring, not part of the API",
+}
+
+def _add(row):
+    db.session.add(row)
+    db.session.commit()
+    return row.id
+
+def _newest(model, **filters):
+    return model.query.filter_by(**filters).order_by(model.id.desc()).first()
+
+# Deletes the rows of a model after the given id, one by one so the search index follows
+def _delete_after(model, last):
+    with unit_of_work():
+        for row in model.query.filter(model.id > last):
+            db.session.delete(row)
+
+def _last_id(model):
+    return db.session.query(db.func.max(model.id)).scalar() or 0
+
+# Messages go through Message.delete, which moves their conversation off them first
+def _delete_messages_after(last):
+    with unit_of_work():
+        for message in Message.query.filter(Message.id > last).all():
+            Message.delete(message)
+
+"""
+! The requests made for each route, as (route, path, options)
+? path (and the json option) can be functions, called untimed before each request
+? to create what it needs (e.g. the Coll a delete removes). options are the test
+? client's (json, data, headers) plus "before" and "after", called untimed around
+? each request to set up or undo what it changes. Updates send the seeded values
+? back, so the dataset is the same after a run
+"""
+def scenarios(ids, token):
+    coll, klass, other, user, message = ids["coll"], ids["class"], ids["other_class"], ids["user"], ids["message"]
+    auth = {"Authorization": f"Bearer {token}"}
+
+    def bench_coll():
+        return Coll.create(2, "Bench", "Bench content", klass, "note").id
+
+    def bench_file():
+        return File.create(2, "Bench", klass, "notes", *storage.save(io.BytesIO(FILE)), "application/pdf").id
+
+    def delete_bench_file():
+        File.delete(_newest(File, uploader_id=2))
+
+    def bench_preview():
+        file = File.query.get(bench_file())
+        storage.save_derived(file.sha256, previews.PREVIEW_NAME, FILE[:16 * 1024])
+        File.describe(file, file.mimetype, 1, True)
+        return file.id
+
+    last = {}
+
+    def remember(*models):
+        last.update({model: _last_id(model) for model in models})
+
+    return [
+        ("GET /", "/", {}),
+        ("GET /classes", "/classes", {}),
+        ("GET /classes/<int:classId>", f"/classes/{klass}", {}),
+        ("POST /classes/<int:classId>", f"/classes/{other}", {"after": lambda: Class.leave(other, 2)}),
+        ("POST /classes/<int:classId>/leave", f"/classes/{other}/leave", {"before": lambda: Class.join(other, 2)}),
+        ("GET /classes/<int:classId>/students", f"/classes/{klass}/students", {}),
+        ("POST /classes/<int:classId>/students", f"/classes/{klass}/students", {"json": {"students": ids["students"]}}),
+        ("GET /classes/faculty/<int:facultyId>", f"/classes/faculty/{ids['faculty']}", {}),
+        ("GET /colleges", "/colleges", {}),
+        ("GET /colleges/<int:collegeId>", f"/colleges/{ids['college']}", {}),
+        ("GET /colls", "/colls", {}),
+        ("GET /colls?view=counts", "/colls?view=counts", {}),
+        ("GET /colls?stream=true&view=counts", "/colls?stream=true&view=counts", {}),
+        ("GET /home", "/home", {}),
+        ("GET /home?view=counts", "/home?view=counts", {}),
+        ("POST /colls", "/colls", {
+            "json": {"title": "Bench", "content": "Bench content", "_class": klass, "type": "note"},
+            "after": lambda: Coll.delete(_newest(Coll, sender_id=2))
+        }),
+        ("POST /colls/batch", "/colls/batch", {
+            "json": {"colls": [{"title": "Bench", "content": "Bench content", "_class": klass, "type": "note"}] * BATCH},
+            "before": lambda: remember(Coll),
+            "after": lambda: _delete_after(Coll, last[Coll])
+        }),
+        ("GET /colls/<int:collId>", f"/colls/{coll}", {}),
+        ("POST /colls/<int:collId>", f"/colls/{coll}", {"data": {"title": ids["coll_title"], "content": ids["coll_content"]}}),
+        ("POST /colls/<int:collId>/delete", lambda: f"/colls/{bench_coll()}/delete", {}),
+        ("GET /colls/<int:collId>/fav", f"/colls/{coll}/fav", {}),
+        ("POST /colls/<int:collId>/fav", f"/colls/{coll}/fav", {}),
+        ("PUT /colls/<int:collId>/fav", f"/colls/{coll}/fav", {"after": lambda: Coll.unfav(coll, 2)}),
+        ("DELETE /colls/<int:collId>/fav", f"/colls/{coll}/fav", {"before": lambda: Coll.fav(coll, 2)}),
+        ("GET /colls/<int:collId>/like", f"/colls/{coll}/like", {}),
+        ("POST /colls/<int:collId>/like", f"/colls/{coll}/like", {"json": {"like": True}}),
+        ("PUT /colls/<int:collId>/like", f"/colls/{coll}/like", {"json": {"like": True}}),
+        ("DELETE /colls/<int:collId>/like", f"/colls/{coll}/like", {}),
+        ("GET /colls/class/<int:classId>", f"/colls/class/{klass}", {}),
+        ("GET /conversations", "/conversations", {}),
+        ("GET /conversations/<int:userId>", f"/conversations/{ids['counterpart']}", {}),
+        ("GET /faculties", "/faculties", {}),
+        ("GET /faculties/<int:facultyId>", f"/faculties/{ids['faculty']}", {}),
+        ("GET /faculties/college/<int:collegeId>", f"/faculties/college/{ids['college']}", {}),
+        ("POST /login", "/login", {"json": {"email": "user2@ucoll.es", "password": seed.PASSWORD}}),
+        ("GET /me", "/me", {"headers": auth}),
+        ("POST /me", "/me", {"headers": auth, "data": {
+            "username": "user2", "old_password": seed.PASSWORD, "password": seed.PASSWORD,
+            "confirmation": seed.PASSWORD, "faculty": ids["faculty"], "classes": ids["classes"]
+        }}),
+        # Only queues the deletion, the job is removed before a worker can run it
+        ("POST /me/delete", "/me/delete", {"after": lambda: db.session.delete(_newest(Job, name="delete_user"))}),
+        ("POST /files", f"/files?title=Bench&class={klass}&type=notes", {
+            "data": FILE, "headers": {"Content-Type": "application/pdf"},
+            "after": lambda: (delete_bench_file(), db.session.delete(_newest(Job, name="process_file")))
+        }),
+        ("GET /files/<int:fileId>", f"/files/{ids['file']}", {}),
+        ("GET /files/<int:fileId>/download", lambda: f"/files/{bench_file()}/download", {"after": delete_bench_file}),
+        ("GET /files/<int:fileId>/preview", lambda: f"/files/{bench_preview()}/preview", {"after": delete_bench_file}),
+        ("POST /files/<int:fileId>/delete", lambda: f"/files/{bench_file()}/delete", {
+            "after": lambda: db.session.delete(_newest(Job, name="delete_blob"))
+        }),
+        ("GET /files/class/<int:classId>", f"/files/class/{klass}", {}),
+        ("GET /messages", "/messages", {}),
+        ("POST /messages", "/messages", {
+            "data": {"receiver": ids["counterpart"], "content": "Bench"},
+            "after": lambda: Message.delete(_newest(Message, sender=2))
+        }),
+        ("GET /messages/<int:messageId>", f"/messages/{message}", {}),
+        ("POST /messages/<int:messageId>", f"/messages/{message}", {"data": {"content": ids["message_content"]}}),
+        ("POST /messages/<int:messageId>/delete", lambda: f"/messages/{Message.create(2, ids['counterpart'], 'Bench').id}/delete", {}),
+        ("POST /messages/batch", "/messages/batch", {
+            "json": {"messages": [{"receiver": ids["counterpart"], "content": "Bench"}] * BATCH},
+            "before": lambda: remember(Message),
+            "after": lambda: _delete_messages_after(last[Message])
+        }),
+        ("GET /messages/sent", "/messages/sent", {}),
+        ("GET /networks", "/networks", {}),
+        ("POST /networks", "/networks", {
+            "data": {"name": "Bench", "link": "bench.com"},
+            "after": lambda: Network.delete(_newest(Network, owner=2))
+        }),
+        ("POST /networks/<int:networkId>", f"/networks/{ids['network']}", {"data": ids["network_data"]}),
+        ("POST /networks/<int:networkId>/delete", lambda: f"/networks/{_add(Network(owner=2, name='Bench', link='bench.com'))}/delete", {}),
+        ("POST /register", "/register", {
+            "json": lambda: {"username": "bench", "email": "bench@ucoll.es", "password": seed.PASSWORD,
+                             "confirmation": seed.PASSWORD, "faculty": ids["faculty"], "classes": ids["classes"]},
+            "after": lambda: User.delete(User.query.filter_by(username="bench").first().id)
+        }),
+        ("GET /search", "/search?q=integral+matrix", {}),
+        ("GET /tags", "/tags", {}),
+        ("POST /tags", "/tags", {"data": {"name": "Bench"}, "after": lambda: Tag.delete(_newest(Tag, user_id=2))}),
+        ("POST /tags/batch", "/tags/batch", {
+            "json": {"names": ["Bench"] * BATCH},
+            "before": lambda: remember(Tag),
+            "after": lambda: _delete_after(Tag, last[Tag])
+        }),
+        ("POST /tags/<int:tagId>", f"/tags/{ids['tag']}", {"data": {"name": ids["tag_name"]}}),
+        ("POST /tags/<int:tagId>/delete", lambda: f"/tags/{_add(Tag(name='Bench', user_id=2))}/delete", {}),
+        ("GET /user/<int:userId>", f"/user/{user}", {}),
+    ]
+
+# Ids of seeded rows the scenarios work on, all related to user 2 (the acting user for now)
+def sample_ids():
+    user2 = User.query.get(2)
+    klass = user2.classes[0].id
+    coll = Coll.query.filter_by(class_id=klass).order_by(Coll.id).first()
+    message = Message.query.filter_by(sender=2).order_by(Message.id).first()
+    network = Network.query.filter_by(owner=2).order_by(Network.id).first()
+    tag = Tag.query.filter_by(user_id=2).order_by(Tag.id).first()
+    return {
+        "coll": coll.id,
+        "coll_title": coll.title,
+        "coll_content": coll.content,
+        "class": klass,
+        "classes": [c.id for c in user2.classes],
+        "other_class": Class.query.filter(Class.id.notin_([c.id for c in user2.classes])).order_by(Class.id).first().id,
+        "students": [student.id for student in Class.roster_query(klass).limit(5)],
+        "faculty": user2.faculties[0].id,
+        "college": user2.faculties[0].college_id,
+        "user": 3,
+        "counterpart": message.receiver,
+        "message": message.id,
+        "message_content": message.content,
+        "network": network.id,
+        "network_data": {"name": network.name, "link": network.link},
+        "tag": tag.id,
+        "file": File.query.filter_by(class_id=klass).order_by(File.id).first().id,
+        "tag_name": tag.name,
+    }
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+"""
+! Runs every scenario `repeat` times, returns the report
+"""
+def run(app, repeat=20):
+    client = app.test_client()
+    ids = sample_ids()
+    token = client.post("/login", json={"email": "user2@ucoll.es", "password": seed.PASSWORD}).json["access_token"]
+    db.session.commit()
+
+    results = {}
+    for route, path, options in scenarios(ids, token):
+        timings, queries, db_times, status = [], [], [], None
+        for _ in range(repeat):
+            if "before" in options:
+                options["before"]()
+            url = path() if callable(path) else path
+            json = options["json"]() if callable(options.get("json")) else options.get("json")
+            db.session.commit()
+
+            method = route.split(" ")[0]
+            with instrumentation.collect() as stats:
+                started = time.perf_counter()
+                response = client.open(url, method=method, json=json, data=options.get("data"), headers=options.get("headers"))
+                response.get_data()
+                timings.append(time.perf_counter() - started)
+            queries.append(stats.count)
+            db_times.append(stats.duration)
+            status = response.status_code
+
+            if "after" in options:
+                options["after"]()
+            db.session.commit()
+
+        results[route] = {
+            "status": status,
+            "p50_ms": round(_percentile(timings, 0.5) * 1000, 2),
+            "p99_ms": round(_percentile(timings, 0.99) * 1000, 2),
+            "db_ms": round(statistics.median(db_times) * 1000, 2),
+            "queries": int(statistics.median(queries))
+        }
+
+    return {
+        "dataset": {model.__tablename__: model.query.count() for model in (User, Coll, LikedColls, Comment, File, Message, Class, Timeline)},
+        "repeat": repeat,
+        "results": results,
+        "skipped": SKIPPED,
+        "not_benchmarked": sorted(set(routes(app)) - {route.split("?")[0] for route in results} - set(SKIPPED))
+    }
+
+"""
+! Compares writing rows one request at a time with writing them in batches
+? For Colls, Tags and messages, `rows` rows go through the single-row endpoint
+? and then through the batch one (MAX_BATCH_SIZE rows per request). What each
+? pass wrote is deleted afterwards, untimed
+"""
+def writes(app, rows=200):
+    client = app.test_client()
+    ids = sample_ids()
+    klass, counterpart = ids["class"], ids["counterpart"]
+    kinds = [
+        ("colls", Coll,
+            lambda i: {"title": f"Bench {i}", "content": "Bench content", "_class": klass, "type": "note"},
+            lambda row: client.post("/colls", json=row),
+            lambda chunk: client.post("/colls/batch", json={"colls": chunk})),
+        ("tags", Tag,
+            lambda i: f"Bench {i}",
+            lambda name: client.post("/tags", data={"name": name}),
+            lambda chunk: client.post("/tags/batch", json={"names": chunk})),
+        ("messages", Message,
+            lambda i: {"receiver": counterpart, "content": f"Bench {i}"},
+            lambda row: client.post("/messages", data=row),
+            lambda chunk: client.post("/messages/batch", json={"messages": chunk})),
+    ]
+
+    results = {}
+    for name, model, make, single, batch in kinds:
+        data = [make(i) for i in range(rows)]
+        chunks = [data[i:i + MAX_BATCH_SIZE] for i in range(0, rows, MAX_BATCH_SIZE)]
+        passes = {}
+        for mode, send, requests in (("per_row", single, data), ("batched", batch, chunks)):
+            last = _last_id(model)
+            db.session.commit()
+            with instrumentation.collect() as stats:
+                started = time.perf_counter()
+                for payload in requests:
+                    response = send(payload)
+                    if response.status_code >= 400:
+                        raise RuntimeError(f"{name} {mode}: {response.status_code} {response.get_data(as_text=True)}")
+                seconds = time.perf_counter() - started
+            passes[mode] = {
+                "requests": len(requests),
+                "seconds": round(seconds, 3),
+                "rows_per_s": round(rows / seconds, 1),
+                "queries": stats.count
+            }
+            if model is Message:
+                _delete_messages_after(last)
+            else:
+                _delete_after(model, last)
+        passes["speedup"] = round(passes["batched"]["rows_per_s"] / passes["per_row"]["rows_per_s"], 1)
+        results[name] = passes
+
+    return {"rows": rows, "results": results}
+
+"""
+! Compares the home feed read from the timelines with the feed built from coll
+? "timeline" is fan-out on write (the default), "read" is fan-out on read
+? (fanout_limit=0, every Class read from coll). Both walk the first `pages`
+? pages of the feeds of `users` users, and must find the same Colls. select is
+? the time spent picking a page's Colls, the page times add loading and
+? serializing them (the same work for both strategies). Then
+? `writes` Colls are created through POST /colls with and without fan-out,
+? and deleted afterwards
+"""
+def home(app, users=50, pages=5, writes=100):
+    client = app.test_client()
+    klass = sample_ids()["class"]
+    sample = db.session.scalars(
+        db.select(ClassStudents.c.user_id).distinct().order_by(ClassStudents.c.user_id).limit(users)
+    ).all()
+    strategies = (("timeline", models.FANOUT_LIMIT), ("read", 0))
+
+    reads, feeds = {}, {}
+    for strategy, fanout_limit in strategies:
+        first, deeper, selects, queries = [], [], [], []
+        for user in sample:
+            cursor, feed = None, []
+            for page in range(pages):
+                with instrumentation.collect() as stats:
+                    started = time.perf_counter()
+                    ids, cursor = Timeline.page_ids(user, cursor, fanout_limit=fanout_limit)
+                    selects.append(time.perf_counter() - started)
+                    Coll.serialize_page(Timeline.load(ids, likes=False), user, True)
+                    (deeper if page else first).append(time.perf_counter() - started)
+                queries.append(stats.count)
+                feed += ids
+                # Each page starts from an empty session, like a request
+                db.session.expunge_all()
+                if cursor is None:
+                    break
+            feeds.setdefault(user, {})[strategy] = feed
+        reads[strategy] = {
+            "select_p50_ms": round(_percentile(selects, 0.5) * 1000, 3),
+            "select_p99_ms": round(_percentile(selects, 0.99) * 1000, 3),
+            "first_page_p50_ms": round(_percentile(first, 0.5) * 1000, 2),
+            "first_page_p99_ms": round(_percentile(first, 0.99) * 1000, 2),
+            "next_pages_p50_ms": round(_percentile(deeper, 0.5) * 1000, 2) if deeper else None,
+            "next_pages_p99_ms": round(_percentile(deeper, 0.99) * 1000, 2) if deeper else None,
+            "queries_per_page": int(statistics.median(queries))
+        }
+    different = [user for user, feed in feeds.items() if feed["timeline"] != feed["read"]]
+    if different:
+        raise RuntimeError(f"The timelines of users {different} differ from their Classes' Colls")
+
+    results = {}
+    for strategy, fanout_limit in strategies:
+        last, entries = _last_id(Coll), Timeline.query.count()
+        db.session.commit()
+        models.FANOUT_LIMIT = fanout_limit
+        try:
+            with instrumentation.collect() as stats:
+                started = time.perf_counter()
+                for i in range(writes):
+                    response = client.post("/colls", json={"title": f"Bench {i}", "content": "Bench content", "_class": klass, "type": "note"})
+                    if response.status_code >= 400:
+                        raise RuntimeError(f"POST /colls: {response.status_code} {response.get_data(as_text=True)}")
+                seconds = time.perf_counter() - started
+        finally:
+            models.FANOUT_LIMIT = strategies[0][1]
+        results[strategy] = {
+            "colls_per_s": round(writes / seconds, 1),
+            "queries_per_coll": round(stats.count / writes, 1),
+            "entries_per_coll": round((Timeline.query.count() - entries) / writes, 1)
+        }
+        _delete_after(Coll, last)
+
+    return {
+        "users": len(sample),
+        "pages": pages,
+        "timeline_entries": Timeline.query.count(),
+        "fanout_limit": strategies[0][1],
+        "reads": reads,
+        "writes": results
+    }
+
+"""
+! Login storm through POST /login
+? For each thread count, that many threads (like the threads of a gthread
+? worker) send `logins` logins in all through the real route: user lookup,
+? password check and token. A first, untimed login re-hashes the password
+? if PASSWORD_HASH_METHOD changed since the database was seeded
+"""
+def logins(app, logins=200, thread_counts=(1, 2, 4, 8)):
+    credentials = {"email": "user2@ucoll.es", "password": seed.PASSWORD}
+    if not app.test_client().post("/login", json=credentials).is_json:
+        raise RuntimeError("POST /login failed, run it on a seeded database")
+
+    def storm(count, timings, failures):
+        client = app.test_client()
+        for _ in range(count):
+            started = time.perf_counter()
+            response = client.post("/login", json=credentials)
+            timings.append(time.perf_counter() - started)
+            if not response.is_json:
+                failures.append(response.status_code)
+
+    results = []
+    for count in thread_counts:
+        timings, failures = [], []
+        threads = [
+            threading.Thread(target=storm, args=(logins // count + (i < logins % count), timings, failures))
+            for i in range(count)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+        results.append({
+            "threads": count,
+            "logins_per_s": round(logins / seconds, 1),
+            "p50_ms": round(_percentile(timings, 0.5) * 1000, 1),
+            "p99_ms": round(_percentile(timings, 0.99) * 1000, 1),
+            "failures": len(failures)
+        })
+
+    return {
+        "method": passwords.PASSWORD_HASH_METHOD,
+        "hash_workers": passwords.PASSWORD_HASH_WORKERS,
+        "logins": logins,
+        "results": results
+    }
+
+# Every "METHOD /rule" of the API (the admin views are not part of it)
+def routes(app):
+    return [
+        f"{method} {rule.rule}"
+        for rule in app.url_map.iter_rules() if not rule.rule.startswith("/admin")
+        for method in sorted(rule.methods - {"HEAD", "OPTIONS"})
+    ]
+
+"""
+! Compares two reports, returns the lines of the routes that changed
+? Query counts are exact, so any change shows; latencies only when they move
+? more than `threshold` (0.2 = 20%) and more than a millisecond, below that it is noise
+"""
+def compare(old, new, threshold=0.2):
+    lines = []
+    for route in sorted(set(old["results"]) | set(new["results"])):
+        before, after = old["results"].get(route), new["results"].get(route)
+        if before is None or after is None:
+            lines.append(f"{route}: {'added' if before is None else 'removed'}")
+            continue
+        changes = []
+        if before["status"] != after["status"]:
+            changes.append(f"status {before['status']} -> {after['status']}")
+        if before["queries"] != after["queries"]:
+            changes.append(f"queries {before['queries']} -> {after['queries']}")
+        for key in ("p50_ms", "p99_ms"):
+            change = abs(after[key] - before[key])
+            if before[key] and change > 1 and change / before[key] > threshold:
+                changes.append(f"{key} {before[key]} -> {after[key]}")
+        if changes:
+            lines.append(f"{route}: " + ", ".join(changes))
+    return lines
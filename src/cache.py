@@ -0,0 +1,171 @@
+"""
+This module keeps an in-process cache for the read-mostly endpoints
+and answers conditional GETs (If-None-Match) with 304s
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, make_response, request
+from metrics import CACHE_LOOKUPS
+
+"""
+! Thread-safe cache whose entries expire after ttl seconds
+? Every gunicorn worker has its own copy. cached() checks each hit against a
+? shared version, so changes made through another worker are seen right away
+? and the ttl only bounds how long unused entries take memory
+"""
+class TTLCache:
+    def __init__(self, name, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._hits = CACHE_LOOKUPS.labels(name, "hit")
+        self._misses = CACHE_LOOKUPS.labels(name, "miss")
+
+    def get(self, key):
+        value = self._get(key)
+        (self._misses if value is None else self._hits).inc()
+        return value
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+catalog_cache = TTLCache("catalog", ttl=int(os.environ.get("CATALOG_CACHE_TTL", 300)))
+
+"""
+! Thread-safe cache of at most size entries, the least recently used go first
+? Entries also expire after ttl seconds, which bounds how stale a copy can get
+? when the row is changed through another worker
+"""
+class LRUCache:
+    def __init__(self, name, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = CACHE_LOOKUPS.labels(name, "hit")
+        self._misses = CACHE_LOOKUPS.labels(name, "miss")
+
+    def get(self, key):
+        value = self._get(key)
+        (self._misses if value is None else self._hits).inc()
+        return value
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+identity_cache = LRUCache(
+    "identity",
+    size=int(os.environ.get("IDENTITY_CACHE_SIZE", 1024)),
+    ttl=int(os.environ.get("IDENTITY_CACHE_TTL", 60))
+)
+
+"""
+! Caches the JSON body of a GET endpoint, keyed by path + query string
+? The body is sent with a strong ETag (its hash), so a client that already has
+? it gets a 304 without the body being rebuilt or even copied. version() is a
+? cheap read of a version shared by every worker (a VersionCounter), stored
+? with each entry: a hit whose version changed since is rebuilt. It is read
+? before the view runs, so an entry is never newer than its version
+"""
+def cached(cache, version):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET":
+                return view(*args, **kwargs)
+
+            key = request.full_path
+            entry, current = cache.get(key), version()
+            if entry is None or entry[2] != current:
+                response = view(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                entry = (body, hashlib.sha1(body).hexdigest(), current)
+                cache.set(key, entry)
+
+            body, etag, _ = entry
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            response = Response(body, mimetype="application/json")
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+"""
+! Answers GETs with a 304 when the ETag built from version_of(<url param>) matches
+? version_of is a cheap lookup of the row versions the response depends on, so
+? repeat views skip the serialize() cascade. When it returns None the view runs
+? as usual (and handles the missing row)
+"""
+def conditional(version_of):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET":
+                return view(*args, **kwargs)
+
+            version = version_of(*kwargs.values())
+            if version is None:
+                return view(*args, **kwargs)
+
+            etag = hashlib.sha1(f"{request.path}:{tuple(version)}".encode()).hexdigest()
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,157 @@
+"""
+This module delivers events (new messages, new Colls, likes, comments) to the
+clients connected to the Server-Sent Events endpoint
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Largest event sent, in bytes (a datagram must hold it). The data of a bigger
+# one is cut down to its id, the clients fetch the rest
+MAX_PAYLOAD = 60 * 1024
+
+"""
+! Backends that carry the published events to every process
+? LocalBackend only reaches the subscribers of the current process. SocketBackend
+? lets several gunicorn workers share events without an external broker: every
+? worker binds a datagram socket inside EVENTS_SOCKET_DIR and a publish is sent
+? to all the sockets found there (the publisher's own included)
+"""
+class LocalBackend:
+    def start(self, dispatch):
+        self.dispatch = dispatch
+
+    def send(self, payload):
+        self.dispatch(payload)
+
+
+class SocketBackend:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def start(self, dispatch):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.receiver.bind(self.path)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        threading.Thread(target=self._listen, args=(dispatch,), daemon=True).start()
+
+    # A bad datagram is logged and skipped, the thread must outlive it or the
+    # worker stops delivering events. It only ends with its socket
+    def _listen(self, dispatch):
+        while True:
+            try:
+                payload = self.receiver.recv(MAX_PAYLOAD)
+            except OSError:
+                return
+            try:
+                dispatch(payload)
+            except Exception:
+                logger.exception("Dropped an event that could not be dispatched")
+
+    def send(self, payload):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".sock"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                self.sender.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The worker that owned it is gone
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # That worker is not keeping up, it misses this event
+                pass
+            except OSError:
+                # The event is published after its transaction committed, failing
+                # to deliver it must not fail the request
+                logger.exception("Could not send an event to %s", path)
+
+
+"""
+! In-process publish/subscribe hub
+? Subscribers get a bounded queue of the events published to their channels
+? (e.g. "user:2", "class:5"); a slow client drops events instead of blocking
+? the publisher. The backend is started lazily in each process, so a hub
+? created before gunicorn forks still works in every worker
+"""
+class Subscription:
+    def __init__(self, channels, size=100):
+        self.channels = set(channels)
+        self.queue = queue.Queue(maxsize=size)
+
+    # Returns the next (event, data) or None if nothing arrived within timeout seconds
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    def __init__(self, backend):
+        self.backend = backend
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._subscriptions = set()
+                self.backend.start(self._dispatch)
+                self._pid = os.getpid()
+
+    def subscribe(self, channels):
+        self._ensure_started()
+        subscription = Subscription(channels)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, channel, event, data):
+        self._ensure_started()
+        payload = json.dumps([channel, event, data], default=str).encode()
+        if len(payload) > MAX_PAYLOAD:
+            if not isinstance(data, dict) or "id" not in data:
+                logger.warning("Dropped a %s event of %d bytes on %s", event, len(payload), channel)
+                return
+            payload = json.dumps([channel, event, {"id": data["id"], "truncated": True}], default=str).encode()
+        self.backend.send(payload)
+
+    def _dispatch(self, payload):
+        channel, event, data = json.loads(payload)
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions if channel in s.channels]
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait((event, data))
+            except queue.Full:
+                pass
+
+
+def _backend():
+    if os.environ.get("EVENTS_BACKEND", "local") == "socket":
+        return SocketBackend(os.environ.get("EVENTS_SOCKET_DIR", "/tmp/ucoll-events"))
+    return LocalBackend()
+
+hub = EventHub(_backend())
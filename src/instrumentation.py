@@ -0,0 +1,99 @@
+"""
+This module counts the SQL statements (and the time spent on them) of every
+request, sends them back as Server-Timing / X-Query-Count headers and warns
+about the requests that go over the query budget
+"""
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", 20))
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    # Returns (statement, times) of the statement run the most, the usual sign of an N+1
+    def most_repeated(self):
+        return self.statements.most_common(1)[0] if self.statements else (None, 0)
+
+"""
+! Collectors of the statements run in the current context
+? They stack, so a caller (e.g. the benchmark) can collect around a request that
+? collects its own. Statements run outside of any collector cost nothing
+"""
+_collectors = ContextVar("query_collectors", default=())
+
+@contextmanager
+def collect():
+    stats = QueryStats()
+    token = _collectors.set(_collectors.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _collectors.reset(token)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _collectors.get() and context is not None:
+        context._query_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_started", None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    for stats in _collectors.get():
+        stats.record(statement, duration)
+
+"""
+! Hooks the per-request stats into the app
+? Statements run while a streamed body is being sent are not in the headers,
+? those are already gone by then
+"""
+def setup_instrumentation(app):
+    @app.before_request
+    def start_collecting():
+        g.request_started = time.perf_counter()
+        g.query_stats = QueryStats()
+        g.query_stats_token = _collectors.set(_collectors.get() + (g.query_stats,))
+
+    @app.after_request
+    def add_timing_headers(response):
+        stats = g.get("query_stats")
+        if stats is None:
+            return response
+
+        total = (time.perf_counter() - g.request_started) * 1000
+        response.headers["X-Query-Count"] = str(stats.count)
+        response.headers["Server-Timing"] = (
+            f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries", app;dur={total:.2f}'
+        )
+        response.headers["Timing-Allow-Origin"] = "*"
+
+        if stats.count > QUERY_BUDGET:
+            statement, times = stats.most_repeated()
+            app.logger.warning(
+                "%s %s ran %d queries (budget %d), the most repeated one %d times: %s",
+                request.method, request.full_path.rstrip("?"), stats.count, QUERY_BUDGET, times, " ".join(statement.split())
+            )
+        return response
+
+    @app.teardown_request
+    def stop_collecting(error=None):
+        token = g.pop("query_stats_token", None)
+        if token is not None:
+            _collectors.reset(token)
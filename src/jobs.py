@@ -0,0 +1,175 @@
+"""
+This module runs slow side effects (deleting a user, repairing counters...) in
+the background. Handlers enqueue a job in their own transaction and return right
+away; `flask jobs work` runs a pool of worker processes that take the jobs from
+the job table, so no broker is needed
+"""
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from datetime import datetime, timedelta
+from flask import current_app
+from metrics import JOBS, JOB_SECONDS, JOB_WAIT_SECONDS, JOBS_BACKLOG
+import previews
+import storage
+from models import db, unit_of_work, Job, User, Coll, File
+
+# Some tasks (the previews) are CPU bound, so one worker per core
+WORKERS = int(os.environ.get("JOBS_WORKERS", os.cpu_count() or 2))
+POLL_INTERVAL = float(os.environ.get("JOBS_POLL_INTERVAL", 1))
+# Seconds after which a running job is considered lost (its worker died) and queued again
+TIMEOUT = int(os.environ.get("JOBS_TIMEOUT", 300))
+MAX_ATTEMPTS = int(os.environ.get("JOBS_MAX_ATTEMPTS", 5))
+
+"""
+! Tasks
+? A task is a function registered under a name, called with the job's payload
+? inside a unit of work (its writes commit together, or not at all). Jobs can
+? run more than once (a retry, a worker that died mid-job), so tasks must be
+? safe to repeat
+"""
+TASKS = {}
+
+def task(name):
+    def register(function):
+        TASKS[name] = function
+        return function
+    return register
+
+@task("delete_user")
+def delete_user(id):
+    if User.query.get(id) is not None:
+        User.delete(id)
+
+@task("repair_counters")
+def repair_counters():
+    Coll.repair_counts()
+
+@task("delete_blob")
+def delete_blob(sha256):
+    if not File.is_stored(sha256):
+        storage.remove(sha256)
+
+@task("process_file")
+def process_file(id):
+    file = File.query.get(id)
+    if file is not None and file.sha256 is not None:
+        File.describe(file, *previews.process(file.sha256, file.mimetype))
+
+# Adds a job to the queue in the current transaction (the request's, in a handler)
+def enqueue(name, delay=0, **payload):
+    if name not in TASKS:
+        raise ValueError(f"Unknown task {name}")
+    return Job.enqueue(name, payload, delay, MAX_ATTEMPTS)
+
+"""
+! Runs a claimed job, returns how it ended (done, retry or failed)
+? Unknown tasks are retried too: during a deploy the web can be newer than
+? the workers
+"""
+def run(job):
+    name = job.name
+    JOB_WAIT_SECONDS.labels(name).observe(max((job.started_at - job.run_at).total_seconds(), 0))
+    started = time.perf_counter()
+    try:
+        with unit_of_work():
+            TASKS[name](**job.payload)
+    except Exception:
+        current_app.logger.exception("Job #%d %s failed (attempt %d)", job.id, name, job.attempts)
+        result = "retry" if Job.fail(job, traceback.format_exc()) == "queued" else "failed"
+    else:
+        Job.finish(job)
+        result = "done"
+    JOB_SECONDS.labels(name).observe(time.perf_counter() - started)
+    JOBS.labels(name, result).inc()
+    return result
+
+def _work(app, worker, names, burst, stop, processed):
+    # The pool stops on SIGTERM/SIGINT once the current jobs are done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    with app.app_context():
+        # Connections inherited from the parent belong to it
+        db.engine.dispose(close=False)
+        while not stop.is_set():
+            job = Job.claim(worker, names)
+            if job is None:
+                Job.requeue_stale(TIMEOUT)
+                backlog = Job.backlog_by_name()
+                for name in TASKS:
+                    JOBS_BACKLOG.labels(name).set(backlog.get(name, 0))
+                if burst:
+                    break
+                stop.wait(POLL_INTERVAL)
+                continue
+            run(job)
+            with processed.get_lock():
+                processed.value += 1
+        db.session.remove()
+
+"""
+! Runs a pool of worker processes until SIGTERM/SIGINT, returns the jobs run
+? names limits the pool to some tasks, e.g. a pool of its own for the previews
+? so they never hold up the rest. With burst=True each worker stops as soon as
+? no job is due, instead of polling every POLL_INTERVAL seconds
+"""
+def work(app, workers=WORKERS, burst=False, names=None):
+    # The workers are forks, they get the app as it is
+    context = multiprocessing.get_context("fork")
+    stop = context.Event()
+    processed = context.Value("i", 0)
+    pool = [
+        context.Process(target=_work, args=(app, f"{os.uname().nodename}:{os.getpid()}:{i}", names, burst, stop, processed))
+        for i in range(workers)
+    ]
+    for process in pool:
+        process.start()
+
+    previous = {sig: signal.signal(sig, lambda signum, frame: stop.set()) for sig in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        for process in pool:
+            process.join()
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+    return processed.value
+
+def _percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 3) if values else None
+
+"""
+! Returns the state of the queue and its throughput/latency over the last `window` seconds
+? wait is how long a due job waited for a worker, run how long it took
+"""
+def stats(window=3600):
+    now = datetime.now()
+    jobs = {}
+    for name, status, count in db.session.execute(
+        db.select(Job.name, Job.status, db.func.count()).group_by(Job.name, Job.status)
+    ):
+        jobs.setdefault(name, {})[status] = count
+
+    oldest = db.session.scalar(db.select(db.func.min(Job.run_at)).where(Job.status == "queued", Job.run_at <= now))
+    finished = db.session.execute(
+        db.select(Job.run_at, Job.started_at, Job.finished_at).where(
+            Job.status == "done", Job.finished_at >= now - timedelta(seconds=window)
+        )
+    ).all()
+    waits = [(started - run_at).total_seconds() for run_at, started, _ in finished]
+    runs = [(finished_at - started).total_seconds() for _, started, finished_at in finished]
+
+    return {
+        "jobs": jobs,
+        "backlog": Job.backlog(),
+        "oldest_due_s": round((now - oldest).total_seconds(), 3) if oldest else None,
+        "window_s": window,
+        "done": len(finished),
+        "per_minute": round(len(finished) * 60 / window, 2),
+        "wait_p50_s": _percentile(waits, 0.5),
+        "wait_p95_s": _percentile(waits, 0.95),
+        "run_p50_s": _percentile(runs, 0.5),
+        "run_p95_s": _percentile(runs, 0.95)
+    }
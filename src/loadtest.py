@@ -0,0 +1,89 @@
+"""
+This module is a small HTTP load generator, to measure a running server:
+    python src/loadtest.py http://localhost:3702 --path /colls --path /classes --concurrency 16 --seconds 20
+Each client thread keeps one connection open and requests the paths in turn.
+--post '/login={"email": ..., "password": ...}' adds a POST with a JSON body
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+def _client(url, requests, deadline, timings, errors):
+    target = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if target.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(target.netloc, timeout=30)
+    position = 0
+    while time.perf_counter() < deadline:
+        method, path, body = requests[position % len(requests)]
+        position += 1
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body, {"Content-Type": "application/json"} if body else {})
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as error:
+            errors.append(type(error).__name__)
+            connection.close()
+            connection = connection_class(target.netloc, timeout=30)
+            continue
+        timings[f"{method} {path}"].append(time.perf_counter() - started)
+    connection.close()
+
+# The p-th percentile of sorted timings, in ms
+def _percentile(timings, p):
+    if not timings:
+        return None
+    return round(timings[min(len(timings) - 1, int(len(timings) * p))] * 1000, 2)
+
+# requests are (method, path, JSON body or None)
+def run(url, requests, concurrency, seconds):
+    timings, errors = {f"{method} {path}": [] for method, path, body in requests}, []
+    deadline = time.perf_counter() + seconds
+    clients = [
+        threading.Thread(target=_client, args=(url, requests, deadline, timings, errors))
+        for _ in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+
+    every = sorted(timing for path_timings in timings.values() for timing in path_timings)
+    return {
+        "url": url,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        "requests": len(every),
+        "errors": len(errors),
+        "requests_per_second": round(len(every) / elapsed, 1),
+        "p50_ms": _percentile(every, 0.5),
+        "p99_ms": _percentile(every, 0.99),
+        "paths": {
+            path: {
+                "requests": len(path_timings),
+                "p50_ms": _percentile(sorted(path_timings), 0.5),
+                "p99_ms": _percentile(sorted(path_timings), 0.99)
+            }
+            for path, path_timings in timings.items()
+        }
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP load generator")
+    parser.add_argument("url")
+    parser.add_argument("--path", action="append", dest="paths", help="Path to request, can be repeated (default /colls)")
+    parser.add_argument("--post", action="append", default=[], help="PATH=JSON to POST, can be repeated")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=20)
+    arguments = parser.parse_args()
+    requests = [("GET", path, None) for path in arguments.paths or ([] if arguments.post else ["/colls"])]
+    requests += [("POST", *post.split("=", 1)) for post in arguments.post]
+    print(json.dumps(run(arguments.url, requests, arguments.concurrency, arguments.seconds), indent=2))
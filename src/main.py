@@ -3,19 +3,35 @@ This module takes care of starting the API Server, Loading the DB and Adding the
 """
 #from crypt import methods
 import os
-from flask import Flask, redirect, render_template, request, jsonify, url_for
+import json
+import click
+from flask import Flask, Response, redirect, render_template, request, jsonify, url_for
 from flask_migrate import Migrate
+from flask.cli import AppGroup
 from sqlalchemy import null
+from sqlalchemy.orm import joinedload
 from flask_swagger import swagger
 from flask_cors import CORS
 from flask_jwt_extended import create_access_token
+from flask_jwt_extended import current_user
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
-from utils import APIException, generate_sitemap
+from utils import APIException, generate_sitemap, keyset_page, jsonify_page, stream_json, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MAX_BATCH_SIZE
 import operator
 from admin import setup_admin
-from models import db, User, Message, Network, Tag, College, Faculty, Class, File, Coll, Comment, LikedFiles, LikedColls
+from instrumentation import setup_instrumentation
+from metrics import setup_metrics
+from cache import cached, catalog_cache, conditional
+from events import hub
+import search
+import plans
+import seed
+import bench
+import jobs
+import storage
+import previews
+from models import db, setup_unit_of_work, unit_of_work, ClassStudents, Job, VersionCounter, Timeline, User, Message, Conversation, Network, Tag, College, Faculty, Class, File, Coll, Comment, LikedFiles, LikedColls
 
 # ----------------------------------------------------------------------------------------------
 
@@ -24,10 +40,28 @@ app = Flask(__name__)
 app.url_map.strict_slashes = False
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+""" Connection pool of each worker, see gunicorn.conf.py for how the workers add up """
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true",
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800))
+}
+if not (app.config['SQLALCHEMY_DATABASE_URI'] or "").startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30))
+    })
+""" Uploads stream to disk (see storage.py), this only caps their size """
+app.config['MAX_CONTENT_LENGTH'] = storage.MAX_SIZE
+app.config['USE_X_SENDFILE'] = storage.SENDFILE == "x-sendfile"
 MIGRATE = Migrate(app, db)
 db.init_app(app)
-CORS(app)
+CORS(app, expose_headers=["X-Next-Cursor", "ETag", "X-Query-Count", "Server-Timing"])
 setup_admin(app)
+setup_instrumentation(app)
+setup_metrics(app, db)
+# After the metrics, so its commit runs before the timing headers are added
+setup_unit_of_work(app)
 
 # ----------------------------------------------------------------------------------------------
 """ Handle/serialize errors like a JSON object"""
@@ -39,6 +73,11 @@ def handle_invalid_usage(error):
 #TODO: STORE THIS KEY INSIDE THE ENV VARIABLES
 app.config["JWT_SECRET_KEY"] = "4c73578c1dade3172998bfc97d1d14801e1a27c31ced907653f694efc939d017"
 jwt = JWTManager(app)
+
+""" Loads the User behind the token into current_user (see User.from_identity) """
+@jwt.user_lookup_loader
+def user_lookup_callback(_jwt_header, jwt_data):
+    return User.from_identity(jwt_data["sub"])
 # ----------------------------------------------------------------------------------------------
 
 # """
@@ -65,6 +104,10 @@ def todo():
     return jsonify("Ucoll Backend is up and running!")
 
 
+# The catalog endpoints are cached in every worker, each hit is checked against this
+def catalog_version():
+    return VersionCounter.read("catalog")
+
 # ----------------------------------------------------------------------------------------------
 #####################
 # ? CLASS ENDPOINTS
@@ -76,8 +119,9 @@ def todo():
 """
 @app.route("/classes", methods=["GET"])
 #@login_required
+@cached(catalog_cache, catalog_version)
 def classes():
-    return jsonify(list(map(lambda x: x.serialize(), Class.query.all())))
+    return jsonify(Class.serialize_many(Class.query.options(joinedload(Class.faculty)).all()))
 
 """
 ! Gets the list of all Classes from a Faculty
@@ -85,8 +129,9 @@ def classes():
 """
 @app.route("/classes/faculty/<int:facultyId>", methods=["GET"])
 #@login_required
+@cached(catalog_cache, catalog_version)
 def faculty_classes(facultyId):
-    return jsonify(list(map(lambda x: x.serialize(), Class.query.filter_by(faculty_id=facultyId))))
+    return jsonify(Class.serialize_many(Class.query.options(joinedload(Class.faculty)).filter_by(faculty_id=facultyId).all()))
 
 """
 ! Gets a certain Class or add current user to it
@@ -94,16 +139,14 @@ def faculty_classes(facultyId):
 """
 @app.route("/classes/<int:classId>", methods=["GET", "POST"])
 #@login_required
+@cached(catalog_cache, catalog_version)
 def get_class(classId):
-    _class = Class.query.get(classId)
     if request.method == "GET":
+        _class = Class.query.get(classId)
         return jsonify(_class.serialize())
     else:
-        students = [student for student in _class.students]
         #TODO: CURRENT USER
-        user = User.query.get(2)
-        students.append(user)
-        Class.update_students(_class.id, students)
+        Class.join(classId, 2)
         return redirect(f"/classes/{classId}")
 
 """
@@ -113,14 +156,39 @@ def get_class(classId):
 @app.route("/classes/<int:classId>/leave", methods=["POST"])
 #@login_required
 def leave_class(classId):
-    _class = Class.query.get(classId)
     #TODO: CURRENT USER
-    user = User.query.get(2)
-    students = [student for student in _class.students]
-    students.remove(user)
-    Class.update_students(_class.id, students)
+    Class.leave(classId, 2)
     return redirect("/home")
-    
+
+"""
+! Gets a page of the students of a Class or enrols many Users in it at once
+? GET pages with ?after=<X-Next-Cursor>&limit=, POST expects {"students": [user ids]},
+? up to MAX_BATCH_SIZE, and skips the ones already enrolled
+"""
+@app.route("/classes/<int:classId>/students", methods=["GET", "POST"])
+#@login_required
+def class_students(classId):
+    if request.method == "GET":
+        students, cursor = keyset_page(
+            Class.roster_query(classId),
+            (Class.roster_key(),),
+            request.args.get("after"),
+            request.args.get("limit", type=int)
+        )
+        return jsonify_page([student.serialize_summary() for student in students], cursor)
+
+    try:
+        students = [int(student) for student in request.json["students"]]
+    except: 
+        return {"success": False,
+                "msg": "Unable to retrieve the students"}, 400
+
+    if not 0 < len(students) <= MAX_BATCH_SIZE:
+        return {"success": False,
+                "msg": f"Send between 1 and {MAX_BATCH_SIZE} students"}, 400
+
+    return jsonify({"enrolled": Class.enroll(classId, students)})
+
 
 # ----------------------------------------------------------------------------------------------
 #####################
@@ -128,15 +196,32 @@ def leave_class(classId):
 #####################
 
 """
-! Return all the Colls or Create a new Coll
+! Return a page of Colls (newest first) or Create a new Coll
 * OvidioSantoro - 2022-02-25
+? Pages are requested with ?after=<X-Next-Cursor of the previous page>&limit=
+? and ?view=counts sends like/dislike counters + own vote instead of every like.
+? ?stream=true streams every Coll instead, with bounded memory
 """
 @app.route("/colls", methods=["GET", "POST"])
 #@login_required
 def colls():
-    # Return all Colls
+    # Return a page of Colls
     if request.method == "GET":
-        return jsonify(list(map(lambda x: x.serialize(), Coll.query.all())))
+        counts = request.args.get("view") == "counts"
+        if request.args.get("stream") == "true":
+            # TODO: Remove hardcoded User (2 = Harry Potter)
+            return stream_json(
+                Coll.feed_query(likes=not counts).order_by(Coll.timestamp.desc(), Coll.id.desc()),
+                lambda colls: Coll.serialize_page(colls, 2, counts)
+            )
+        colls, cursor = keyset_page(
+            Coll.feed_query(likes=not counts),
+            (Coll.timestamp, Coll.id),
+            request.args.get("after"),
+            request.args.get("limit", type=int)
+        )
+        # TODO: Remove hardcoded User (2 = Harry Potter)
+        return jsonify_page(Coll.serialize_page(colls, 2, counts), cursor)
     
     # Create a new Coll
     else:
@@ -166,14 +251,43 @@ def colls():
                     "msg": "Unable to create Coll"}, 400
 
 """
-! Returns the Colls of a certain Class
+! Creates many Colls in one transaction
+? {"colls": [{"title", "content", "_class", "type"}, ...]}, up to MAX_BATCH_SIZE.
+? Either all of them are created or none
+"""
+@app.route("/colls/batch", methods=["POST"])
+#@login_required
+def create_colls():
+    try:
+        rows = [{key: row[key] for key in ("title", "content", "_class", "type")} for row in request.json["colls"]]
+    except:
+        return {"success": False,
+                "msg": "Unable to retrieve all the data"}, 400
+
+    if not 0 < len(rows) <= MAX_BATCH_SIZE or any("" in row.values() for row in rows):
+        return {"success": False,
+                "msg": f"Send between 1 and {MAX_BATCH_SIZE} complete Colls"}, 400
+
+    # TODO: Remove hardcoded User (2 = Harry Potter)
+    colls = Coll.create_many(2, rows)
+    return jsonify({"created": [coll.id for coll in colls]}), 201
+
+"""
+! Returns a page of the Colls of a certain Class
 * OvidioSantoro - 2022-02-25
 """
 @app.route("/colls/class/<int:classId>", methods=["GET"])
 #@login_required
 def get_class_colls(classId):
-    colls = Class.query.filter_by(class_id = classId)
-    return jsonify(list(map(lambda x: x.serialize(), colls)))
+    counts = request.args.get("view") == "counts"
+    colls, cursor = keyset_page(
+        Coll.feed_query(likes=not counts).filter_by(class_id = classId),
+        (Coll.timestamp, Coll.id),
+        request.args.get("after"),
+        request.args.get("limit", type=int)
+    )
+    # TODO: Remove hardcoded User (2 = Harry Potter)
+    return jsonify_page(Coll.serialize_page(colls, 2, counts), cursor)
 
 """
 ! Returns a single Coll (For full-page) or edits it
@@ -181,6 +295,7 @@ def get_class_colls(classId):
 """
 @app.route("/colls/<int:collId>", methods=["GET", "POST"])
 ##@login_required
+@conditional(Coll.version_of)
 def get_coll(collId):
     coll = Coll.query.get(collId)
     if request.method == "GET":
@@ -206,57 +321,56 @@ def delete_coll(collId):
 """
 ! Handles the Like/Dislike clicks
 * OvidioSantoro - 2022-03-08
+? POST toggles like the buttons do (same vote again removes it), PUT sets the
+? vote ({"like": true|false|null}) and DELETE removes it. All of them are single
+? upserts/deletes and answer with the new vote
 """
-@app.route("/colls/<int:collId>/like", methods=["GET", "POST"])
+@app.route("/colls/<int:collId>/like", methods=["GET", "POST", "PUT", "DELETE"])
 #@login_required
 def handle_like(collId):
     # TODO: Remove hardcoded User (2 = Harry Potter)
-    likedColl = LikedColls.query.filter_by(coll_id=collId, user_id=2).first()
+    user_id = 2
 
     if request.method == "GET":
+        likedColl = LikedColls.query.filter_by(coll_id=collId, user_id=user_id).first()
         if not likedColl:
             return jsonify(None)
         else:
             return jsonify(likedColl.is_like)
-    
-    else:
-        try:
-            like = request.json["like"]
-        except: 
-            return {"success": False,
-                    "msg": "Unable to like Coll"}, 500
 
-        if not likedColl:
-            # TODO: Remove hardcoded User (2 = Harry Potter)
-            LikedColls.create(2, collId, like)
-            return jsonify("Coll liked/disliked")
-        else:
-            if likedColl.is_like == like:
-                LikedColls.delete(likedColl)
-                return jsonify("Valoration removed")
-            else:
-                LikedColls.update(likedColl, like)
-                return jsonify("Valoration updated")
+    if request.method == "DELETE":
+        return jsonify(LikedColls.vote(user_id, collId, None))
+
+    try:
+        like = request.json["like"]
+    except: 
+        return {"success": False,
+                "msg": "Unable to like Coll"}, 500
+
+    if request.method == "PUT":
+        return jsonify(LikedColls.vote(user_id, collId, like))
+    else:
+        return jsonify(LikedColls.toggle(user_id, collId, like))
 
 """
 ! Handles the Fav clicks
 * OvidioSantoro - 2022-03-10
+? POST toggles, PUT/DELETE fav or unfav idempotently. All answer with the new state
 """
-@app.route("/colls/<int:collId>/fav", methods=["POST"])
+@app.route("/colls/<int:collId>/fav", methods=["GET", "POST", "PUT", "DELETE"])
 #@login_required
 def handle_fav(collId):
     # TODO: Remove hardcoded User (2 = Harry Potter)
     user_id = 2
-    user = User.query.get(user_id)
-    favedColls = list(map(lambda x: x.serialize(),User.query.get(user_id).fav_colls))
-    coll = Coll.query.get(collId)
 
-    if coll.serialize() in favedColls:
-        Coll.unfav(coll, user)
-        return jsonify("Coll unfaved")
+    if request.method == "GET":
+        return jsonify(Coll.is_faved(collId, user_id))
+    elif request.method == "PUT":
+        return jsonify(Coll.fav(collId, user_id))
+    elif request.method == "DELETE":
+        return jsonify(Coll.unfav(collId, user_id))
     else:
-        Coll.fav(coll, user)
-        return jsonify("Coll faved") 
+        return jsonify(Coll.toggle_fav(collId, user_id))
 
 # ----------------------------------------------------------------------------------------------
 #####################
@@ -269,6 +383,7 @@ def handle_fav(collId):
 """
 @app.route("/colleges", methods=["GET"])
 #@login_required
+@cached(catalog_cache, catalog_version)
 def colleges():
     return jsonify(list(map(lambda x: x.serialize(), College.query.all())))
 
@@ -278,10 +393,53 @@ def colleges():
 """
 @app.route("/colleges/<int:collegeId>", methods=["GET"])
 #@login_required
+@cached(catalog_cache, catalog_version)
 def get_college(collegeId):
     college = College.query.get(collegeId)
     return jsonify(college.serialize())
 
+# ----------------------------------------------------------------------------------------------
+#####################
+# ? EVENT ENDPOINTS
+#####################
+
+"""
+! Server-Sent Events stream with the current User's new messages and the new
+! Colls, likes and comments of their Classes
+? The Classes are looked up once when the client connects; after that the
+? connection only waits on the event hub, so idle clients cost no queries.
+? Each open stream holds a worker thread, run gunicorn with threaded workers.
+? Events over events.MAX_PAYLOAD only carry {"id", "truncated": true}
+"""
+EVENTS_HEARTBEAT = 15
+
+@app.route("/events", methods=["GET"])
+#@login_required
+def events():
+    #TODO: CURRENT USER
+    user_id = 2
+    classes = db.session.query(ClassStudents.c.class_id).filter(ClassStudents.c.user_id == user_id)
+    subscription = hub.subscribe([f"user:{user_id}"] + [f"class:{class_id}" for class_id, in classes])
+    db.session.remove()
+
+    def stream():
+        try:
+            yield f"retry: {EVENTS_HEARTBEAT * 1000}\n\n"
+            while True:
+                event = subscription.get(timeout=EVENTS_HEARTBEAT)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    name, data = event
+                    yield f"event: {name}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
 # ----------------------------------------------------------------------------------------------
 #####################
 # ? FACULTY ENDPOINTS
@@ -293,6 +451,7 @@ def get_college(collegeId):
 """
 @app.route("/faculties", methods=["GET"])
 ##@login_required
+@cached(catalog_cache, catalog_version)
 def faculties():
     return jsonify(list(map(lambda x: x.serialize(), Faculty.query.all())))
 
@@ -302,6 +461,7 @@ def faculties():
 """
 @app.route("/faculties/college/<int:collegeId>", methods=["GET"])
 ##@login_required
+@cached(catalog_cache, catalog_version)
 def college_faculties(collegeId):
     return jsonify(list(map(lambda x: x.serialize(), Faculty.query.filter_by(college_id=collegeId))))
 
@@ -311,6 +471,7 @@ def college_faculties(collegeId):
 """
 @app.route("/faculties/<int:facultyId>", methods=["GET"])
 #@login_required
+@cached(catalog_cache, catalog_version)
 def get_faculty(facultyId):
     faculty = Faculty.query.get(facultyId)
     return jsonify(faculty.serialize())
@@ -321,7 +482,129 @@ def get_faculty(facultyId):
 # ? FILE ENDPOINTS
 #####################
 
-# TODO: All of these endpoints
+"""
+! Uploads a File
+? The body is the file itself, with its Content-Type, and the data goes in the
+? query string (/files?title=Slides&class=3&type=notes). It is written to disk
+? as it arrives, never held in memory. A multipart form with a "file" field
+? and the same fields works too (werkzeug spools it to a temporary file)
+"""
+@app.route("/files", methods=["POST"])
+#@login_required
+def upload_file():
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        fields, stream, mimetype = request.form, upload and upload.stream, upload and upload.mimetype
+    else:
+        fields, stream, mimetype = request.args, request.stream, request.mimetype
+    try:
+        title = fields["title"]
+        _class = int(fields["class"])
+        type = fields["type"]
+    except:
+        return {"success": False,
+                "msg": "Unable to retrieve all the data"}, 400
+
+    if stream is None or not 0 < len(title) <= File.title.type.length or not 0 < len(type) <= File.type.type.length:
+        return {"success": False,
+                "msg": "Unable to upload File"}, 400
+    if db.session.get(Class, _class) is None:
+        return {"success": False,
+                "msg": "Class not found"}, 400
+
+    sha256, size = storage.save(stream)
+    if size == 0:
+        return {"success": False,
+                "msg": "The File is empty"}, 400
+
+    #TODO: CURRENT USER
+    try:
+        file = File.create(2, title, _class, type, sha256, size, mimetype or "application/octet-stream")
+    except Exception:
+        # The request is rolled back, the blob is collected once no upload can be using it
+        db.session.rollback()
+        jobs.enqueue("delete_blob", delay=storage.GRACE, sha256=sha256)
+        db.session.commit()
+        raise
+    jobs.enqueue("process_file", id=file.id)
+    return jsonify(file.serialize()), 201
+
+"""
+! Returns a page of the Files of a certain Class
+"""
+@app.route("/files/class/<int:classId>", methods=["GET"])
+#@login_required
+def get_class_files(classId):
+    files, cursor = keyset_page(
+        File.query.options(joinedload(File.uploader), joinedload(File._class)).filter_by(class_id = classId),
+        (File.timestamp, File.id),
+        request.args.get("after"),
+        request.args.get("limit", type=int)
+    )
+    return jsonify_page([file.serialize() for file in files], cursor)
+
+"""
+! Returns a single File's data
+"""
+@app.route("/files/<int:fileId>", methods=["GET"])
+#@login_required
+def get_file(fileId):
+    file = File.query.get(fileId)
+    if file is None:
+        return {"success": False,
+                "msg": "File not found"}, 404
+    return jsonify(file.serialize())
+
+"""
+! Downloads a File
+? Supports Range (resumed downloads, PDF viewers) and If-None-Match, or hands
+? the file off to the web server, see storage.send
+"""
+@app.route("/files/<int:fileId>/download", methods=["GET"])
+#@login_required
+def download_file(fileId):
+    file = File.query.get(fileId)
+    if file is None:
+        return {"success": False,
+                "msg": "File not found"}, 404
+    if file.sha256 is None:
+        return redirect(file.content)
+    return storage.send(storage.object_name(file.sha256), file.mimetype, file.download_name(), file.sha256)
+
+"""
+! Returns a File's preview
+? Its URL (see File.serialize) changes with the content, so browsers and
+? proxies can keep it for a year. 404 until the process_file job makes it,
+? and for the Files that can't have one
+"""
+@app.route("/files/<int:fileId>/preview", methods=["GET"])
+#@login_required
+def file_preview(fileId):
+    file = File.query.get(fileId)
+    if file is None or not file.has_preview:
+        return {"success": False,
+                "msg": "No preview for this File"}, 404
+    return storage.send(
+        storage.derived_name(file.sha256, previews.PREVIEW_NAME), "image/jpeg", f"{file.title}.jpg", file.sha256,
+        max_age=365 * 24 * 3600, immutable=True
+    )
+
+"""
+! Deletes a File
+? Its content stays on disk while other Files share it, a job checks that
+"""
+@app.route("/files/<int:fileId>/delete", methods=["POST"])
+#@login_required
+def delete_file(fileId):
+    file = File.query.get(fileId)
+    if file is None:
+        return {"success": False,
+                "msg": "File not found"}, 404
+    sha256, _class = file.sha256, file.class_id
+    File.delete(file)
+    if sha256 is not None:
+        jobs.enqueue("delete_blob", sha256=sha256)
+    return redirect(f"/files/class/{_class}")
 
 # ----------------------------------------------------------------------------------------------
 #####################
@@ -329,13 +612,23 @@ def get_faculty(facultyId):
 #####################
 
 """
-! Renders the home page
+! Returns a page of the home feed: the Colls of the user's Classes, newest first
 * OvidioSantoro - 2022-03-05
+? Read from the user's precomputed timeline (see Timeline in models.py). Pages
+? and ?view=counts work like in /colls
 """
-# TODO: When the Front is installed, check whether this should return something
 @app.route("/home")
-def sitemap():
-    return redirect("/colls")
+#@login_required
+def home():
+    counts = request.args.get("view") == "counts"
+    #TODO: CURRENT USER
+    colls, cursor = Timeline.page(
+        2,
+        request.args.get("after"),
+        request.args.get("limit", type=int),
+        likes=not counts
+    )
+    return jsonify_page(Coll.serialize_page(colls, 2, counts), cursor)
 
 # ----------------------------------------------------------------------------------------------
 #####################
@@ -352,11 +645,11 @@ def message():
     if request.method == "GET":
         #TODO: CURRENT USER
         messages = Message.query.filter_by(receiver = 2)
-        return jsonify(list(map(lambda x: x.serialize(), messages)))
+        return stream_json(messages, Message.serialize_many)
 
     else:
         try:
-            receiver = request.form["receiver"]
+            receiver = int(request.form["receiver"])
             content = request.form["content"]
         except: 
             return {"success": False,
@@ -375,7 +668,29 @@ def message():
 def sent_messages():
     #TODO: CURRENT USER
     messages = Message.query.filter_by(sender = 2)
-    return jsonify(list(map(lambda x: x.serialize(), messages)))
+    return stream_json(messages, Message.serialize_many)
+
+"""
+! Sends many messages in one transaction
+? {"messages": [{"receiver", "content"}, ...]}, up to MAX_BATCH_SIZE.
+? Either all of them are sent or none
+"""
+@app.route("/messages/batch", methods=["POST"])
+#@login_required
+def send_messages():
+    try:
+        rows = [{"receiver": int(row["receiver"]), "content": row["content"]} for row in request.json["messages"]]
+    except:
+        return {"success": False,
+                "msg": "Unable to send messages"}, 400
+
+    if not 0 < len(rows) <= MAX_BATCH_SIZE or any(row["content"] == "" for row in rows):
+        return {"success": False,
+                "msg": f"Send between 1 and {MAX_BATCH_SIZE} messages with content"}, 400
+
+    #TODO: CURRENT USER
+    messages = Message.create_many(2, rows)
+    return jsonify({"created": [message.id for message in messages]}), 201
 
 """
 ! Gets a certain Message or deletes it
@@ -409,6 +724,40 @@ def delete_messages(messageId):
     Message.delete(message)
     return redirect("/messages/sent")
 
+"""
+! Gets the current User's inbox: one row per conversation, latest first
+? Pages with ?after=<X-Next-Cursor>&limit=
+"""
+@app.route("/conversations", methods=["GET"])
+#@login_required
+def conversations():
+    #TODO: CURRENT USER
+    conversations, cursor = keyset_page(
+        Conversation.inbox_query(2),
+        Conversation.inbox_keys(),
+        request.args.get("after"),
+        request.args.get("limit", type=int)
+    )
+    return jsonify_page(Conversation.serialize_many(conversations), cursor)
+
+"""
+! Gets the messages exchanged with another User, latest first
+? Pages with ?after=<X-Next-Cursor>&limit=, opening it marks the conversation as read
+"""
+@app.route("/conversations/<int:userId>", methods=["GET"])
+#@login_required
+def conversation(userId):
+    #TODO: CURRENT USER
+    messages, cursor = Message.thread_page(
+        2,
+        userId,
+        request.args.get("after"),
+        request.args.get("limit", type=int)
+    )
+    if not request.args.get("after"):
+        Conversation.mark_read(2, userId)
+    return jsonify_page(Message.serialize_many(messages), cursor)
+
 # ----------------------------------------------------------------------------------------------
 #####################
 #? NETWORK ENDPOINTS
@@ -526,11 +875,58 @@ def login():
     user = User.query.filter_by(email=email).first()
 
     if user is not None and User.check_password(user.password, password):
-        access_token = create_access_token(identity=email)
+        User.upgrade_password(user, password)
+        access_token = create_access_token(identity=str(user.id))
         return jsonify(access_token=access_token)
     else: 
         return "Something went wrong, please check your login data"
 
+# ----------------------------------------------------------------------------------------------
+#####################
+#? SEARCH ENDPOINTS
+#####################
+
+"""
+! Ranked full-text search over the Colls and Files
+? ?q=<words>, optionally narrowed with &class=<id>&type=<type>&kind=coll|file,
+? and paginated with &page=<n>&limit=
+"""
+@app.route("/search", methods=["GET"])
+#@login_required
+def search_colls_and_files():
+    query = request.args.get("q", "")
+    kind = request.args.get("kind")
+    if kind is not None and kind not in search.KINDS:
+        return {"success": False,
+                "msg": f"Unknown kind {kind}"}, 400
+
+    limit = min(max(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    page = max(request.args.get("page", 1, type=int), 1)
+    hits = search.search(
+        db.session.connection(),
+        query,
+        class_id=request.args.get("class", type=int),
+        type=request.args.get("type"),
+        kind=kind,
+        limit=limit,
+        offset=(page - 1) * limit
+    )
+
+    coll_ids = [ref_id for hit_kind, ref_id, rank in hits if hit_kind == "coll"]
+    file_ids = [ref_id for hit_kind, ref_id, rank in hits if hit_kind == "file"]
+    colls = Coll.feed_query(likes=False).filter(Coll.id.in_(coll_ids)).all() if coll_ids else []
+    files = File.query.options(joinedload(File.uploader), joinedload(File._class)).filter(
+        File.id.in_(file_ids)
+    ).all() if file_ids else []
+    # TODO: Remove hardcoded User (2 = Harry Potter)
+    items = {("coll", coll["id"]): coll for coll in Coll.serialize_page(colls, 2, counts=True)}
+    items.update({("file", file.id): file.serialize() for file in files})
+
+    return jsonify([
+        {"kind": hit_kind, "rank": rank, "item": items[(hit_kind, ref_id)]}
+        for hit_kind, ref_id, rank in hits if (hit_kind, ref_id) in items
+    ])
+
 # ----------------------------------------------------------------------------------------------
 #####################
 #? TAG ENDPOINTS
@@ -557,6 +953,27 @@ def tags():
         Tag.create(name, user)
     return redirect("/tags")
 
+"""
+! Creates many Tags in one transaction
+? {"names": [...]}, up to MAX_BATCH_SIZE
+"""
+@app.route("/tags/batch", methods=["POST"])
+#@login_required
+def create_tags():
+    try:
+        names = [str(name) for name in request.json["names"]]
+    except:
+        return {"success": False,
+                "msg": "Unable to retrieve all the data"}, 400
+
+    if not 0 < len(names) <= MAX_BATCH_SIZE or "" in names:
+        return {"success": False,
+                "msg": f"Send between 1 and {MAX_BATCH_SIZE} names"}, 400
+
+    #TODO: CURRENT USER
+    tags = Tag.create_many(names, User.query.get(2))
+    return jsonify({"created": [tag.id for tag in tags]}), 201
+
 @app.route("/tags/<int:tagId>", methods=["POST"])
 #@login_required
 def update_tag(tagId): 
@@ -589,8 +1006,7 @@ def delete_tag(tagId):
 @app.route("/me", methods=["GET", "POST"])
 @jwt_required()
 def me():
-    email = get_jwt_identity()
-    user = User.query.filter_by(email=email).first()
+    user = current_user
     if request.method == "GET":
         return jsonify(user.serialize())
         
@@ -608,6 +1024,8 @@ def me():
             return {"success": False,
                     "msg": "Unable to retrieve all the data"}, 400
 
+        # The cached copy may be a little stale, the password has to be checked against the row
+        db.session.refresh(user)
         if not User.check_password(user.password, old_password):
             return {"success": False,
                     "msg": "Old password is not correct"}, 403
@@ -634,6 +1052,7 @@ def me():
 * OvidioSantoro - 2022-02-24
 """
 @app.route("/user/<int:userId>", methods=["GET"])
+@conditional(User.version_of)
 def userProfile(userId):
     user = User.query.get(userId)
     return jsonify(user.serialize())
@@ -645,9 +1064,235 @@ def userProfile(userId):
 """
 @app.route("/me/delete", methods=["POST"])
 def me_delete():
+    # Deleting a user touches all of their rows, a worker does it (see jobs.py)
     #TODO: CURRENT USER
-    User.delete(2)
-    return jsonify("Goodbye, you will be missed :(")
+    jobs.enqueue("delete_user", id=2)
+    return jsonify("Goodbye, you will be missed :("), 202
+
+# ----------------------------------------------------------------------------------------------
+#####################
+# ? CLI COMMANDS
+#####################
+
+colls_cli = AppGroup("colls", help="Coll maintenance commands.")
+
+"""
+! Repairs the denormalized like/dislike counters of the Colls
+"""
+@colls_cli.command("repair-counters")
+def repair_counters():
+    """Recomputes like_count/dislike_count from liked_colls."""
+    click.echo(f"{Coll.repair_counts()} Coll(s) repaired")
+
+app.cli.add_command(colls_cli)
+
+search_cli = AppGroup("search", help="Full-text search index commands.")
+
+"""
+! Rebuilds the full-text search index from the Colls and Files
+"""
+@search_cli.command("reindex")
+def reindex():
+    """Drops and rebuilds the search index."""
+    connection = db.session.connection()
+    search.drop_index(connection)
+    search.create_index(connection)
+    for model in (Coll, File):
+        documents = [row.search_document() for row in model.query.yield_per(1000)]
+        search.index(connection, documents)
+        click.echo(f"{len(documents)} {model.__name__}(s) indexed")
+    db.session.commit()
+
+"""
+! Benchmarks the search index on a synthetic corpus
+"""
+@search_cli.command("benchmark")
+@click.option("--rows", default=1000000, help="Size of the synthetic corpus.")
+@click.option("--queries", default=500, help="Number of searches to time.")
+@click.option("--database", default=None, help="Scratch database URL (a temporary SQLite file by default).")
+def search_benchmark(rows, queries, database):
+    """Times ranked searches over a synthetic corpus."""
+    click.echo(json.dumps(search.benchmark(rows, queries, database), indent=2))
+
+app.cli.add_command(search_cli)
+
+auth_cli = AppGroup("auth", help="Authentication commands.")
+
+"""
+! Benchmarks POST /login against the number of threads sending logins
+? The hashing method and pool come from PASSWORD_HASH_METHOD and
+? PASSWORD_HASH_WORKERS
+"""
+@auth_cli.command("benchmark")
+@click.option("--logins", default=200, help="Logins sent in all.")
+@click.option("--threads", default="1,2,4,8", help="Comma separated thread counts to try.")
+def auth_benchmark(logins, threads):
+    """Times a login storm through POST /login (run it on a seeded database)."""
+    thread_counts = [int(count) for count in threads.split(",")]
+    click.echo(json.dumps(bench.logins(app, logins, thread_counts), indent=2))
+
+app.cli.add_command(auth_cli)
+
+plans_cli = AppGroup("plans", help="Query plan commands.")
+
+"""
+! Fails if any hot query of the endpoints needs a full table scan
+"""
+@plans_cli.command("check")
+@click.option("--verbose", is_flag=True, help="Print every plan, not only the failing ones.")
+def check_plans(verbose):
+    """EXPLAINs the hot queries (see plans.py) and fails on full table scans."""
+    failures = 0
+    for name, plan, scans in plans.check(db.session.connection()):
+        if scans:
+            failures += 1
+        if scans or verbose:
+            click.echo(f"{'FULL SCAN' if scans else 'ok'} {name}: {', '.join(scans)}")
+            for line in plan:
+                click.echo(f"    {line}")
+    db.session.rollback()
+    if failures:
+        raise click.ClickException(f"{failures} hot query(ies) scan a whole table")
+    click.echo("Every hot query uses an index")
+
+app.cli.add_command(plans_cli)
+
+"""
+! Fills the database with a deterministic synthetic dataset
+"""
+@app.cli.command("seed")
+@click.option("--scale", default=1, help="Multiplies the users, Colls, Files and messages (scale 1 = 500 users, 5000 Colls).")
+@click.option("--seed", "seed_", default=42, help="Random seed, the same one gives the same dataset.")
+@click.option("--reset", is_flag=True, help="Drops every table and creates them again first. Destroys all the data!")
+def seed_database(scale, seed_, reset):
+    """Generates a synthetic dataset into DB_CONNECTION_STRING."""
+    if reset:
+        search.drop_index(db.session.connection())
+        db.session.commit()
+        db.drop_all()
+        db.create_all()
+    elif User.query.count() != 0:
+        raise click.ClickException("The database is not empty, use --reset to wipe it first")
+    click.echo(json.dumps(seed.generate(scale, seed_), indent=2))
+
+jobs_cli = AppGroup("jobs", help="Background job queue commands.")
+
+"""
+! Runs the background job workers
+"""
+@jobs_cli.command("work")
+@click.option("--workers", default=jobs.WORKERS, help="Worker processes (JOBS_WORKERS, one per core by default).")
+@click.option("--burst", is_flag=True, help="Stops once no job is due instead of waiting for more.")
+@click.option("--task", "tasks", multiple=True, type=click.Choice(sorted(jobs.TASKS)), help="Only runs these tasks (repeatable).")
+def jobs_work(workers, burst, tasks):
+    """Runs the queued jobs until SIGTERM/Ctrl+C."""
+    click.echo(f"{jobs.work(app, workers, burst, tasks)} job(s) run")
+
+@jobs_cli.command("enqueue")
+@click.argument("name")
+@click.option("--payload", default="{}", help="JSON object with the task's arguments.")
+@click.option("--delay", default=0, help="Seconds to wait before running it.")
+def jobs_enqueue(name, payload, delay):
+    """Adds a job to the queue (e.g. repair_counters)."""
+    try:
+        job = jobs.enqueue(name, delay, **json.loads(payload))
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"Job #{job.id} queued")
+
+@jobs_cli.command("stats")
+@click.option("--window", default=3600, help="Seconds of finished jobs to measure throughput and latency on.")
+def jobs_stats(window):
+    """Prints the queue's size, throughput and latency."""
+    click.echo(json.dumps(jobs.stats(window), indent=2))
+
+@jobs_cli.command("retry")
+@click.argument("ids", nargs=-1, type=int)
+def jobs_retry(ids):
+    """Queues the failed jobs again (all of them, or the given ids)."""
+    click.echo(f"{Job.retry(ids)} job(s) queued again")
+
+@jobs_cli.command("purge")
+@click.option("--days", default=7, help="Deletes the jobs done more than this many days ago.")
+def jobs_purge(days):
+    """Deletes old finished jobs."""
+    click.echo(f"{Job.purge(days)} job(s) deleted")
+
+app.cli.add_command(jobs_cli)
+
+files_cli = AppGroup("files", help="Uploaded Files commands.")
+
+"""
+! Queues the metadata/preview job of the Files that never had it
+"""
+@files_cli.command("process")
+@click.option("--all", "all_", is_flag=True, help="Processes every uploaded File again (e.g. after installing poppler).")
+def process_files(all_):
+    """Queues process_file jobs for the uploaded Files."""
+    query = db.session.query(File.id).filter(File.sha256.isnot(None))
+    if not all_:
+        query = query.filter(File.processed_at.is_(None))
+    with unit_of_work():
+        queued = [jobs.enqueue("process_file", id=id) for id, in query]
+    click.echo(f"{len(queued)} File(s) queued")
+
+app.cli.add_command(files_cli)
+
+timeline_cli = AppGroup("timeline", help="Home timeline commands.")
+
+"""
+! Rewrites every timeline from the Colls and the Class memberships
+? Needed after changing TIMELINE_FANOUT_LIMIT, or after editing Class
+? memberships outside the API (e.g. in the admin)
+"""
+@timeline_cli.command("rebuild")
+def rebuild_timelines():
+    """Rewrites the home timelines of every user."""
+    with unit_of_work():
+        written = Timeline.fill()
+    click.echo(f"{written} timeline entries written")
+
+app.cli.add_command(timeline_cli)
+
+"""
+! Benchmarks every route through the test client
+"""
+@app.cli.command("bench")
+@click.option("--repeat", default=20, help="Requests per route.")
+@click.option("--output", type=click.Path(), default=None, help="File to write the JSON report to.")
+@click.option("--compare", type=click.Path(exists=True), default=None, help="Previous report to compare with.")
+def bench_routes(repeat, output, compare):
+    """Records p50/p99 latency and query counts per route (run it on a seeded database)."""
+    report = bench.run(app, repeat)
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+    if compare:
+        with open(compare) as file:
+            changes = bench.compare(json.load(file), report)
+        click.echo("\n".join(changes) or "No changes")
+
+"""
+! Benchmarks per-row against batched writes
+"""
+@app.cli.command("bench-writes")
+@click.option("--rows", default=200, help="Rows written per kind (Colls, Tags, messages) and mode.")
+def bench_writes(rows):
+    """Compares the write throughput of the single-row and batch endpoints (run it on a seeded database)."""
+    click.echo(json.dumps(bench.writes(app, rows), indent=2))
+
+"""
+! Benchmarks the home feed read from the timelines against reading it from coll
+"""
+@app.cli.command("bench-home")
+@click.option("--users", default=50, help="Users whose feed is read.")
+@click.option("--pages", default=5, help="Pages read per user.")
+@click.option("--writes", default=100, help="Colls created per strategy.")
+def bench_home(users, pages, writes):
+    """Compares fan-out on write (timelines) with fan-out on read (run it on a seeded database)."""
+    click.echo(json.dumps(bench.home(app, users, pages, writes), indent=2))
 
 # ----------------------------------------------------------------------------------------------
 
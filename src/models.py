@@ -1,8 +1,18 @@
 from email.policy import default
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import joinedload, selectinload, make_transient_to_detached
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, date
+import os
+import passwords
+from contextlib import contextmanager
+import mimetypes
+from datetime import datetime, date, timedelta
+from cache import catalog_cache, identity_cache
+from events import hub
+from utils import keyset_page, keyset_merge, encode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+import search
 
 db = SQLAlchemy()
 
@@ -12,26 +22,205 @@ db = SQLAlchemy()
 """
 FacultyMembers = db.Table('faculty_members',
     db.Column('user_id', db.ForeignKey("user.id"), primary_key=True),
-    db.Column('faculty_id', db.ForeignKey("faculty.id"), primary_key=True)
+    db.Column('faculty_id', db.ForeignKey("faculty.id"), primary_key=True, index=True)
 )
 
 ClassStudents = db.Table('class_students',
     db.Column('user_id', db.ForeignKey("user.id"), primary_key=True),
-    db.Column('class_id', db.ForeignKey("class.id"), primary_key=True)
+    db.Column('class_id', db.ForeignKey("class.id"), primary_key=True),
+    db.Index("ix_class_students_class_id_user_id", "class_id", "user_id")
 )
 
 FavoriteFiles = db.Table('favorite_files',
     db.Column('user_id', db.ForeignKey("user.id"), primary_key=True),
-    db.Column('file_id', db.ForeignKey("file.id"), primary_key=True)
+    db.Column('file_id', db.ForeignKey("file.id"), primary_key=True, index=True)
 )
 
 FavoriteColls = db.Table('favorite_colls',
     db.Column('user_id', db.ForeignKey("user.id"), primary_key=True),
-    db.Column('coll_id', db.ForeignKey("coll.id"), primary_key=True)
+    db.Column('coll_id', db.ForeignKey("coll.id"), primary_key=True, index=True)
 )
 
 # ----------------------------------------------------------------------------------------------
 
+"""
+! Single-statement upsert for the association tables
+? INSERT ... ON CONFLICT on Postgres/SQLite and ON DUPLICATE KEY on MySQL,
+? keyed on the primary key. Without "update" an existing row is left as is.
+? values can be a list of rows, which are sent as one multi-row INSERT
+"""
+def upsert(table, values, update=None):
+    table = getattr(table, "__table__", table)
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ("mysql", "mariadb"):
+        statement = mysql.insert(table).values(values)
+        if update is None:
+            key = table.primary_key.columns[0].name
+            update = {key: statement.inserted[key]}
+        statement = statement.on_duplicate_key_update(**update)
+    elif dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = insert(table).values(values)
+        keys = [column.name for column in table.primary_key.columns]
+        if update is None:
+            statement = statement.on_conflict_do_nothing(index_elements=keys)
+        else:
+            statement = statement.on_conflict_do_update(index_elements=keys, set_=update)
+    else:
+        raise NotImplementedError(f"Upserts are not supported on {dialect}")
+
+    return db.session.execute(statement)
+
+"""
+! Inserts the association rows that don't exist yet, returns how many were new
+? upsert's rowcount can't be used for that: MySQL reports the rows it found
+? (CLIENT_FOUND_ROWS), so its no-op ON DUPLICATE KEY UPDATE counts every
+? duplicate. This sends INSERT IGNORE there, whose rowcount leaves them out,
+? and ON CONFLICT DO NOTHING RETURNING on Postgres/SQLite, counting the keys
+? that came back
+"""
+def insert_new(table, values):
+    table = getattr(table, "__table__", table)
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ("mysql", "mariadb"):
+        return db.session.execute(mysql.insert(table).values(values).prefix_with("IGNORE")).rowcount
+    elif dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        keys = [column.name for column in table.primary_key.columns]
+        statement = insert(table).values(values).on_conflict_do_nothing(index_elements=keys)
+        return len(db.session.execute(statement.returning(*table.primary_key.columns)).all())
+    else:
+        raise NotImplementedError(f"Inserts are not supported on {dialect}")
+
+"""
+! Multi-row INSERT for the batch helpers, returns the new rows
+? The ORM can only batch INSERTs when it can tell which generated id belongs to
+? which object, which SQLite can't, so add_all() there sends one INSERT per row.
+? This sends one INSERT ... RETURNING id per batch and loads the rows back, doing
+? what the flush hooks below would (search index, version bumps). Backends
+? without RETURNING (MySQL) go through the ORM instead
+"""
+def insert_many(model, rows):
+    if not rows:
+        return []
+    if not db.session.get_bind().dialect.insert_executemany_returning:
+        objects = [model(**row) for row in rows]
+        db.session.add_all(objects)
+        db.session.flush()
+        return objects
+
+    ids = db.session.scalars(db.insert(model).returning(model.id), rows).all()
+    objects = model.query.filter(model.id.in_(ids)).order_by(model.id).all()
+    for obj in objects:
+        touched, id = _touched_row(obj)
+        if id is not None:
+            db.session.info.setdefault(touched, set()).add(id)
+    if model in SEARCHABLE:
+        search.index(db.session.connection(), [obj.search_document() for obj in objects])
+    return objects
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Unit of work
+? The model helpers end with commit(). Inside a unit of work that only flushes
+? (the ids and constraints are there, the events wait) and the whole unit is
+? committed once at its end, so a request that writes several times pays for a
+? single transaction. Every request is one (see setup_unit_of_work); the CLI
+? and scripts commit right away unless they open one themselves
+"""
+def commit():
+    if db.session.info.get("unit_of_work"):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+@contextmanager
+def unit_of_work():
+    session = db.session()
+    outer = session.info.get("unit_of_work", False)
+    session.info["unit_of_work"] = True
+    try:
+        yield
+        if not outer:
+            session.commit()
+    except Exception:
+        if not outer:
+            session.rollback()
+        raise
+    finally:
+        session.info["unit_of_work"] = outer
+
+# Requests that answer with an error are rolled back, the rest committed before the response is sent
+def setup_unit_of_work(app):
+    @app.before_request
+    def begin_unit_of_work():
+        db.session.info["unit_of_work"] = True
+
+    @app.after_request
+    def commit_unit_of_work(response):
+        if db.session.info.pop("unit_of_work", False):
+            if response.status_code < 400:
+                db.session.commit()
+            else:
+                db.session.rollback()
+        return response
+
+    @app.teardown_request
+    def end_unit_of_work(error=None):
+        if db.session.info.pop("unit_of_work", False):
+            db.session.rollback()
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Publishes an event to the SSE clients once the current transaction commits
+? Events of a transaction that is rolled back are never sent (see events.py)
+"""
+def publish(channel, event, data):
+    db.session.info.setdefault("events", []).append((channel, event, data))
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Row versions, used to build the ETags of the read endpoints
+? Versioned rows get their version bumped by every UPDATE the ORM emits for them
+? (relationship-only changes included). The names of Classes and Faculties are
+? read along with them, the usernames of other Users (likers, favs) share the
+? "usernames" VersionCounter. The "catalog" one is for the catalog cache only
+"""
+class Versioned:
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+@event.listens_for(Versioned, "before_update", propagate=True)
+def _bump_version(mapper, connection, target):
+    target.version = type(target).version + 1
+
+class VersionCounter(db.Model):
+    name = db.Column(db.String(30), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=1)
+
+    def __repr__(self):
+        return f"{self.name} v{self.value}"
+
+    # Increments a counter in the current transaction
+    def bump(name):
+        upsert(VersionCounter, {"name": name, "value": 1}, {"value": VersionCounter.value + 1})
+
+    # Reads the current value of a counter (one primary key lookup)
+    def read(name):
+        return db.session.scalar(db.select(VersionCounter.value).where(VersionCounter.name == name)) or 0
+
+    # Subquery with the current value of a counter, to embed in a version lookup
+    def current(name):
+        return db.select(db.func.coalesce(db.func.max(VersionCounter.value), 0)).where(
+            VersionCounter.name == name
+        ).scalar_subquery()
+
+# ----------------------------------------------------------------------------------------------
+
 """
 ! Asociation objects for the like tables
 * OvidioSantoro - 2022-02-22
@@ -40,7 +229,7 @@ FavoriteColls = db.Table('favorite_colls',
 """
 class LikedFiles(db.Model):
     user_id = db.Column(db.ForeignKey("user.id"), primary_key=True)
-    file_id = db.Column(db.ForeignKey("file.id"), primary_key=True)
+    file_id = db.Column(db.ForeignKey("file.id"), primary_key=True, index=True)
     is_like = db.Column(db.Boolean, default=True)
     file_liker = db.relationship("User", back_populates="liked_files")
     liked_file = db.relationship("File", back_populates="file_liked")
@@ -62,6 +251,11 @@ class LikedColls(db.Model):
     coll_liker = db.relationship("User", back_populates="liked_colls")
     liked_coll = db.relationship("Coll", back_populates="coll_liked")
 
+    # Lets the counters be recomputed from the index alone
+    __table_args__ = (
+        db.Index("ix_liked_colls_coll_id_is_like", "coll_id", "is_like"),
+    )
+
     def __repr__(self):
         return f"{self.coll_liker} like/dislike to {self.liked_coll}"
 
@@ -81,16 +275,71 @@ class LikedColls(db.Model):
             liked_coll = Coll.query.get(coll)
         )
         db.session.add(likedColl)
-        db.session.commit()
+        Coll.count_vote(coll, like, 1)
+        LikedColls.publish(user, likedColl.liked_coll, like)
+        commit()
         return likedColl
 
     def update(likedColl, like):
+        if likedColl.is_like != like:
+            Coll.count_vote(likedColl.coll_id, likedColl.is_like, -1)
+            Coll.count_vote(likedColl.coll_id, like, 1)
         likedColl.is_like = like
-        db.session.commit()
+        commit()
 
     def delete(likedColl):
+        Coll.count_vote(likedColl.coll_id, likedColl.is_like, -1)
         db.session.delete(likedColl)
-        db.session.commit()
+        commit()
+
+    # Sets the User's vote on a Coll (True = Like, False = Dislike, None = No vote)
+    # with one upsert/delete, so repeating it or racing another click is harmless
+    def vote(user, coll, like):
+        if like is None:
+            db.session.execute(LikedColls.__table__.delete().where(
+                LikedColls.user_id == user,
+                LikedColls.coll_id == coll
+            ))
+        else:
+            upsert(LikedColls, {"user_id": user, "coll_id": coll, "is_like": like}, {"is_like": like})
+        Coll.recount(coll)
+        LikedColls.publish(user, Coll.query.get(coll), like)
+        commit()
+        return like
+
+    # Votes like the Like/Dislike buttons do: repeating the same vote removes it.
+    # Returns the new vote
+    def toggle(user, coll, like):
+        removed = db.session.execute(LikedColls.__table__.delete().where(
+            LikedColls.user_id == user,
+            LikedColls.coll_id == coll,
+            LikedColls.is_like == like
+        )).rowcount
+        if not removed:
+            return LikedColls.vote(user, coll, like)
+        Coll.recount(coll)
+        LikedColls.publish(user, Coll.query.get(coll), None)
+        commit()
+        return None
+
+    # Tells the Coll's class that a User's vote on it changed
+    def publish(user, coll, like):
+        if coll is not None:
+            publish(f"class:{coll.class_id}", "like", {
+                "coll": coll.id,
+                "user": user,
+                "like": like
+            })
+
+    # Returns {coll_id: is_like} with the user's own votes on the given Colls, in one query
+    def votes_of(user, colls):
+        if not colls:
+            return {}
+        votes = db.session.query(LikedColls.coll_id, LikedColls.is_like).filter(
+            LikedColls.user_id == user,
+            LikedColls.coll_id.in_(colls)
+        )
+        return dict(votes)
         
 
 # ----------------------------------------------------------------------------------------------
@@ -104,20 +353,51 @@ class Message(db.Model):
     sender = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     receiver = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.now())
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.now, server_default=db.func.now())
+    __table_args__ = (
+        db.Index("ix_message_receiver_sender_timestamp", "receiver", "sender", "timestamp", "id"),
+        db.Index("ix_message_sender_timestamp", "sender", "timestamp", "id"),
+    )
 
 
     def __repr__(self):
         return f"Message #{self.id} from User #{self.sender} to User #{self.receiver}"
 
-    def serialize(self):
+    # usernames ({user_id: username}) avoids looking up both users of every message
+    def serialize(self, usernames=None):
+        if usernames is None:
+            usernames = User.usernames([self.sender, self.receiver])
         return{
             "id": self.id,
-            "sender": User.query.get(self.sender).username,
-            "receiver": User.query.get(self.receiver).username, 
-            "content": self.content
+            "sender": usernames.get(self.sender),
+            "receiver": usernames.get(self.receiver), 
+            "content": self.content,
+            "timestamp": f"{self.timestamp.strftime('%x, %X')}"
         }
 
+    # Serializes many Messages resolving all their usernames in one query
+    def serialize_many(messages):
+        usernames = User.usernames({id for message in messages for id in (message.sender, message.receiver)})
+        return [message.serialize(usernames) for message in messages]
+
+    # Queries for the messages between two users, one per direction, each a range
+    # of the (receiver, sender, timestamp, id) index already in the thread's order
+    def thread_queries(user, counterpart):
+        return [
+            Message.query.filter(Message.receiver == user, Message.sender == counterpart),
+            Message.query.filter(Message.receiver == counterpart, Message.sender == user)
+        ]
+
+    # Returns a page of the messages between two users (newest first) and the
+    # cursor of the next one. Both directions are read in index order and merged,
+    # a single query ORing them would sort the whole thread on every page
+    def thread_page(user, counterpart, after=None, limit=None, excluding=None):
+        columns = (Message.timestamp, Message.id)
+        queries = Message.thread_queries(user, counterpart)
+        if excluding is not None:
+            queries = [query.filter(Message.id != excluding) for query in queries]
+        return keyset_merge([(query, columns) for query in queries], after, limit)
+
 
     # Creates a new message
     def create(sender, receiver, content):
@@ -127,31 +407,151 @@ class Message(db.Model):
             content = content,
         )
         db.session.add(message)
-        db.session.commit()
+        db.session.flush()
+        Conversation.record(message)
+        publish(f"user:{message.receiver}", "message", message.serialize())
+        commit()
+        return message
+
+    # Sends many messages ({"receiver", "content"}) in one transaction, with one
+    # INSERT for all of them and one update per conversation
+    def create_many(sender, rows):
+        messages = insert_many(Message, [
+            {"sender": sender, "receiver": row["receiver"], "content": row["content"]} for row in rows
+        ])
+        Conversation.record_many(messages)
+        for message, data in zip(messages, Message.serialize_many(messages)):
+            publish(f"user:{message.receiver}", "message", data)
+        commit()
+        return messages
 
     # Updates a message in the database
     def update(message, content):
         message.content = content
-        db.session.commit()
+        commit()
 
-    # Deletes a message from the database
+    # Deletes a message from the database. Its conversation references it, so
+    # it is pointed to the message before it first
     def delete(message):
+        Conversation.refresh(message.sender, message.receiver, excluding=message.id)
         db.session.delete(message)
-        db.session.commit()
+        commit()
 
 # ----------------------------------------------------------------------------------------------
 
+"""
+! Conversation summary table
+? One row per (owner, counterpart) with the last message and how many of the
+? counterpart's messages the owner has not read, kept up to date by Message.create
+? and Message.delete so the inbox never has to scan the messages
+"""
+class Conversation(db.Model):
+    owner_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    counterpart_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True, index=True)
+    last_message_id = db.Column(db.Integer, db.ForeignKey("message.id"), nullable=False, index=True)
+    last_message = db.relationship("Message")
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    updated_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index("ix_conversation_owner_id_updated_at", "owner_id", "updated_at", "counterpart_id"),
+    )
+
+    def __repr__(self):
+        return f"User #{self.owner_id}'s conversation with User #{self.counterpart_id}"
+
+    def serialize(self, usernames):
+        return{
+            "user_id": self.counterpart_id,
+            "user": usernames.get(self.counterpart_id),
+            "unread": self.unread_count,
+            "last_message": self.last_message.serialize(usernames)
+        }
+
+    # Serializes an inbox page resolving all the usernames in one query
+    def serialize_many(conversations):
+        ids = set()
+        for conversation in conversations:
+            ids.update((conversation.last_message.sender, conversation.last_message.receiver))
+        usernames = User.usernames(ids)
+        return [conversation.serialize(usernames) for conversation in conversations]
+
+    # Query for a user's inbox (paginate it with keyset_page on inbox_keys())
+    def inbox_query(user):
+        return Conversation.query.options(joinedload(Conversation.last_message)).filter_by(owner_id=user)
+
+    def inbox_keys():
+        return (Conversation.updated_at, Conversation.counterpart_id)
+
+    # Updates both sides of the conversation of a new message, in the current transaction
+    def record(message, unread=1):
+        upsert(Conversation, {
+            "owner_id": message.sender,
+            "counterpart_id": message.receiver,
+            "last_message_id": message.id,
+            "unread_count": 0,
+            "updated_at": message.timestamp
+        }, {"last_message_id": message.id, "updated_at": message.timestamp})
+        upsert(Conversation, {
+            "owner_id": message.receiver,
+            "counterpart_id": message.sender,
+            "last_message_id": message.id,
+            "unread_count": unread,
+            "updated_at": message.timestamp
+        }, {
+            "last_message_id": message.id,
+            "unread_count": Conversation.unread_count + unread,
+            "updated_at": message.timestamp
+        })
+
+    # Same as record for many messages, with one pair of upserts per conversation
+    def record_many(messages):
+        latest, unread = {}, {}
+        for message in messages:
+            pair = (message.sender, message.receiver)
+            latest[pair] = message
+            unread[pair] = unread.get(pair, 0) + 1
+        for pair, message in latest.items():
+            Conversation.record(message, unread[pair])
+
+    # Points both sides of a conversation to its latest message (or removes them
+    # if there are no messages left), in the current transaction. excluding is
+    # a message that is about to be deleted
+    def refresh(user, counterpart, excluding=None):
+        messages, _ = Message.thread_page(user, counterpart, limit=1, excluding=excluding)
+        last = messages[0] if messages else None
+        sides = Conversation.query.filter(db.or_(
+            db.and_(Conversation.owner_id == user, Conversation.counterpart_id == counterpart),
+            db.and_(Conversation.owner_id == counterpart, Conversation.counterpart_id == user)
+        ))
+        if last is None:
+            sides.delete(synchronize_session=False)
+        else:
+            sides.update(
+                {Conversation.last_message_id: last.id, Conversation.updated_at: last.timestamp},
+                synchronize_session=False
+            )
+
+    # Marks the counterpart's messages as read by the owner
+    def mark_read(owner, counterpart):
+        read = Conversation.query.filter(
+            Conversation.owner_id == owner,
+            Conversation.counterpart_id == counterpart,
+            Conversation.unread_count > 0
+        ).update({Conversation.unread_count: 0}, synchronize_session=False)
+        if read:
+            commit()
+
 """
 ! User Model & methods
 * OvidioSantoro - 2022-02-23
 """
-class User(db.Model, UserMixin):
+class User(db.Model, UserMixin, Versioned):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(30), unique=True, nullable=False)
     email = db.Column(db.String(60), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
+    password = db.Column(db.String(255), nullable=False)
     portrait = db.Column(db.String(300), default="https://i.pravatar.cc/300")
-    registered = db.Column(db.Date, default=date.today())
+    registered = db.Column(db.Date, default=date.today)
     name = db.Column(db.String(30))
     surname = db.Column(db.String(30))
     description = db.Column(db.Text)
@@ -179,7 +579,7 @@ class User(db.Model, UserMixin):
             "username": self.username,
             "portrait": self.portrait,
             "email": self.email,
-            "classes": list(map(lambda x: x.serialize(), self.classes)),
+            "classes": Class.serialize_many(self.classes),
             "registered": self.registered,
             "faculties": list(map(lambda x: x.serialize(), self.faculties)),
             "tags": list(map(lambda x: x.serialize(), self.tags)),
@@ -190,37 +590,140 @@ class User(db.Model, UserMixin):
         }
 
 
+    # Returns {user_id: username} for the given Users, in one query
+    def usernames(users):
+        if not users:
+            return {}
+        return dict(db.session.query(User.id, User.username).filter(User.id.in_(users)))
+
+    # Just what lists of Users (e.g. class rosters) need
+    def serialize_summary(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "portrait": self.portrait
+        }
+
+    # Returns what the serialized User depends on, without loading it: its version,
+    # its Classes (with their faculty names and student counts) and its Faculties
+    def version_of(id):
+        students = ClassStudents.alias()
+        student_count = db.select(db.func.count()).where(students.c.class_id == Class.id).scalar_subquery()
+        classes = db.session.query(User.version, Class.id, Class.name, Faculty.name, student_count).outerjoin(
+            ClassStudents, ClassStudents.c.user_id == User.id
+        ).outerjoin(Class, ClassStudents.c.class_id == Class.id).outerjoin(
+            Faculty, Class.faculty_id == Faculty.id
+        ).filter(User.id == id).order_by(Class.id).all()
+        if not classes:
+            return None
+        faculties = db.session.query(Faculty.id, Faculty.name, College.name).join(
+            FacultyMembers, FacultyMembers.c.faculty_id == Faculty.id
+        ).outerjoin(College, Faculty.college_id == College.id).filter(
+            FacultyMembers.c.user_id == id
+        ).order_by(Faculty.id).all()
+        return (*classes, *faculties)
+
+    """
+    ! Resolves the identity of a JWT into a User
+    ? The identity is the user id (tokens issued before that carry the email).
+    ? Cached column values are attached to the session as an already loaded row,
+    ? so a cache hit only reads the row's version: the cache is per process, and a
+    ? User changed or deleted by another worker (or by a job) must not be served
+    ? from it. A deleted User resolves to None, which the JWT extension answers with 401
+    """
+    def from_identity(identity):
+        if not identity.isdigit():
+            return User.query.filter_by(email=identity).first()
+
+        values = identity_cache.get(int(identity))
+        if values is not None:
+            version = db.session.scalar(db.select(User.version).where(User.id == values["id"]))
+            if version != values["version"]:
+                identity_cache.pop(values["id"])
+                values = None
+        if values is None:
+            user = User.query.get(int(identity))
+            if user is not None:
+                identity_cache.set(user.id, {attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs})
+            return user
+
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     # Checks the hashed password
     def check_password(userPassword, password):
-        return check_password_hash(userPassword, password)
+        return passwords.check_password(userPassword, password)
+
+    # Re-hashes the password if it was hashed with an older method or cost, only
+    # possible right after a successful login, when the plain password is known
+    def upgrade_password(user, password):
+        if passwords.needs_rehash(user.password):
+            user.password = passwords.hash_password(password)
+            commit()
 
     # Register the user into the database
     def register(username, email, password, faculty, classes):
         user = User(
             username = username, 
             email = email, 
-            password = generate_password_hash(password),
+            password = passwords.hash_password(password),
             faculties = [Faculty.query.get(faculty)],
             classes = [Class.query.get(_class) for _class in classes]
         )
         db.session.add(user)
-        db.session.commit()
+        db.session.flush()
+        Timeline.fill([user.id])
+        Timeline.resize({_class.id: 1 for _class in user.classes})
+        commit()
         return user
 
-    # Updates the user's data in the database
+    # Updates the user's data in the database. The Classes they joined or left may
+    # cross FANOUT_LIMIT, their timelines are resized
     def update(user, username, password, faculty, classes):
+        before = {_class.id for _class in user.classes}
         user.username = username
-        user.password = generate_password_hash(password)
+        user.password = passwords.hash_password(password)
         user.faculties = [Faculty.query.get(faculty)]
         user.classes = [Class.query.get(_class) for _class in classes]
+        db.session.flush()
+        after = {_class.id for _class in user.classes}
+        Timeline.fill([user.id])
+        Timeline.resize({**{id: 1 for id in after - before}, **{id: -1 for id in before - after}})
 
-        db.session.commit()
+        commit()
 
-    # Deletes an user from the database
+    # Deletes an user from the database, with what only makes sense with them (votes,
+    # messages, conversations, networks, tags). Their Colls, Files and comments stay,
+    # without an author. It touches a lot of rows, the API runs it as a job (see jobs.py)
     def delete(id):
         user = User.query.get(id)
+        classes = {_class.id for _class in user.classes}
+        voted = db.session.scalars(db.select(LikedColls.coll_id).where(LikedColls.user_id == id)).all()
+        LikedColls.query.filter_by(user_id=id).delete(synchronize_session=False)
+        if voted:
+            likes, dislikes = Coll._vote_counts()
+            Coll.query.filter(Coll.id.in_(voted)).update(
+                {Coll.like_count: likes, Coll.dislike_count: dislikes, Coll.version: Coll.version + 1},
+                synchronize_session=False
+            )
+        LikedFiles.query.filter_by(user_id=id).delete(synchronize_session=False)
+        Conversation.query.filter(
+            db.or_(Conversation.owner_id == id, Conversation.counterpart_id == id)
+        ).delete(synchronize_session=False)
+        Message.query.filter(db.or_(Message.sender == id, Message.receiver == id)).delete(synchronize_session=False)
+        Network.query.filter_by(owner=id).delete(synchronize_session=False)
+        Tag.query.filter_by(user_id=id).delete(synchronize_session=False)
+        Timeline.clear([id])
+        Coll.query.filter_by(sender_id=id).update(
+            {Coll.sender_id: None, Coll.version: Coll.version + 1}, synchronize_session=False
+        )
+        File.query.filter_by(uploader_id=id).update({File.uploader_id: None}, synchronize_session=False)
+        Comment.query.filter_by(commenter_id=id).update({Comment.commenter_id: None}, synchronize_session=False)
         db.session.delete(user)
-        db.session.commit()
+        db.session.flush()
+        Timeline.resize({_class: -1 for _class in classes})
+        commit()
         
 # ----------------------------------------------------------------------------------------------
 
@@ -230,7 +733,7 @@ class User(db.Model, UserMixin):
 """
 class Network(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    owner = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    owner = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
     name = db.Column(db.String(20), nullable=False)
     link = db.Column(db.String(30), nullable=False)
 
@@ -254,19 +757,19 @@ class Network(db.Model):
             link=link
         )
         db.session.add(network)
-        db.session.commit()
+        commit()
 
     # Updates a network the database
     def update(network, name, link):
         network.name = name
         network.link = link
       
-        db.session.commit()
+        commit()
 
     # Deletes a network from the database
     def delete(network):
         db.session.delete(network)
-        db.session.commit()
+        commit()
 
 # ----------------------------------------------------------------------------------------------
 
@@ -278,7 +781,7 @@ class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
     user = db.relationship("User", back_populates="tags")
-    user_id =  db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id =  db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
 
     def __repr__(self):
         return f"Tag {self.name}"
@@ -297,17 +800,23 @@ class Tag(db.Model):
         )
 
         db.session.add(tag)
-        db.session.commit()
+        commit()
+
+    # Creates many Tags in one transaction, with one INSERT for all of them
+    def create_many(names, user):
+        tags = insert_many(Tag, [{"name": name, "user_id": user.id} for name in names])
+        commit()
+        return tags
 
     # Updates a Tag
     def update(tag, name):
         tag.name = name
-        db.session.commit()
+        commit()
 
     # Deletes a Tag from the database
     def delete(tag):
         db.session.delete(tag)
-        db.session.commit()
+        commit()
 
 # ----------------------------------------------------------------------------------------------
 
@@ -340,7 +849,7 @@ class Faculty(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(60), nullable=False)
     students = db.relationship("User", secondary=FacultyMembers, back_populates="faculties")
-    college_id = db.Column(db.Integer, db.ForeignKey("college.id"), nullable=False)
+    college_id = db.Column(db.Integer, db.ForeignKey("college.id"), nullable=False, index=True)
     college = db.relationship("College", back_populates="faculties")
     classes = db.relationship("Class", back_populates="faculty")
 
@@ -351,7 +860,7 @@ class Faculty(db.Model):
         return{
             "id": self.id,
             "name": self.name,
-            "college": College.query.get(self.college_id).name
+            "college": self.college.name
         }
 
 # ----------------------------------------------------------------------------------------------
@@ -363,7 +872,7 @@ class Faculty(db.Model):
 class Class(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(60), nullable=False)
-    faculty_id = db.Column(db.Integer, db.ForeignKey("faculty.id"))
+    faculty_id = db.Column(db.Integer, db.ForeignKey("faculty.id"), index=True)
     faculty = db.relationship("Faculty", back_populates="classes")
     students = db.relationship("User", secondary=ClassStudents, back_populates="classes")
     files = db.relationship("File", back_populates="_class")
@@ -372,19 +881,72 @@ class Class(db.Model):
     def __repr__(self):
         return f"{self.name} ({self.faculty})"
 
-    def serialize(self):
+    # Compact summary, the roster itself is paginated in /classes/<id>/students
+    def serialize(self, student_count=None):
+        if student_count is None:
+            student_count = Class.student_counts([self.id]).get(self.id, 0)
         return{
             "id": self.id,
             "name": self.name,
-            "faculty": Faculty.query.get(self.faculty_id).name,
-            "students": [student.username for student in self.students]
+            "faculty": self.faculty.name,
+            "student_count": student_count
         }
 
-    # Updates the Class' students
-    def update_students(id, students):
-        _class = Class.query.get(id)
-        _class.students = students
-        db.session.commit()
+    # Serializes many Classes with their student counts from one grouped query
+    def serialize_many(classes):
+        counts = Class.student_counts([_class.id for _class in classes])
+        return [_class.serialize(counts.get(_class.id, 0)) for _class in classes]
+
+    # Returns {class_id: number of students} for the given Classes
+    def student_counts(classes):
+        if not classes:
+            return {}
+        counts = db.session.query(ClassStudents.c.class_id, db.func.count()).filter(
+            ClassStudents.c.class_id.in_(classes)
+        ).group_by(ClassStudents.c.class_id)
+        return dict(counts)
+
+    # Query for the students of a Class (paginate it with keyset_page on roster_key())
+    def roster_query(id):
+        return User.query.join(ClassStudents, ClassStudents.c.user_id == User.id).filter(
+            ClassStudents.c.class_id == id
+        )
+
+    # The roster is sorted on class_students.user_id, not User.id, so a page is a
+    # range of the (class_id, user_id) index and not a sort of the whole Class.
+    # Labelled "id", keyset_page reads the cursor off the Users
+    def roster_key():
+        return ClassStudents.c.user_id.label("id")
+
+    # Adds a student to a Class with one insert (joining twice is harmless),
+    # and its Colls to their timeline
+    def join(id, user):
+        if insert_new(ClassStudents, {"user_id": user, "class_id": id}):
+            Timeline.fill([user], [id])
+            Timeline.resize({id: 1})
+        commit()
+
+    # Removes a student from a Class with one delete, and its Colls from their timeline
+    def leave(id, user):
+        left = db.session.execute(ClassStudents.delete().where(
+            ClassStudents.c.user_id == user,
+            ClassStudents.c.class_id == id
+        )).rowcount
+        if left:
+            Timeline.clear([user], [id])
+            Timeline.resize({id: -left})
+        commit()
+
+    # Enrols many students in one statement, returns how many of them were new
+    def enroll(id, users):
+        if not users:
+            return 0
+        enrolled = insert_new(ClassStudents, [{"user_id": user, "class_id": id} for user in set(users)])
+        if enrolled:
+            Timeline.fill(list(set(users)), [id])
+            Timeline.resize({id: enrolled})
+        commit()
+        return enrolled
         
 # ----------------------------------------------------------------------------------------------
 
@@ -398,11 +960,22 @@ class File(db.Model):
     content = db.Column(db.String(120), nullable=False)
     class_id = db.Column(db.Integer, db.ForeignKey("class.id"))
     _class = db.relationship("Class", back_populates="files") 
-    uploader_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    uploader_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     type = db.Column(db.String(12), nullable=False)
     file_liked = db.relationship("LikedFiles", back_populates="liked_file")
     file_faved = db.relationship("User", secondary=FavoriteFiles, back_populates="faved_files")
-    timestamp = db.Column(db.DateTime, default=datetime.now())
+    timestamp = db.Column(db.DateTime, default=datetime.now)
+    # The stored content (see storage.py). Files from before the uploads have none,
+    # their content is a link
+    sha256 = db.Column(db.String(64), index=True)
+    size = db.Column(db.Integer)
+    mimetype = db.Column(db.String(100))
+    # Filled in by the process_file job (see previews.py)
+    pages = db.Column(db.Integer)
+    has_preview = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    processed_at = db.Column(db.DateTime)
+    # A page of a Class's Files is a range of this index (see /files/class/<id>)
+    __table_args__ = (db.Index("ix_file_class_id_timestamp_id", "class_id", "timestamp", "id"),)
 
 
     def __repr__(self):
@@ -411,9 +984,67 @@ class File(db.Model):
     def serialize(self):
         return{
             "id": self.id,
+            "title": self.title,
             "content": self.content,
-            "uploader": self.uploader,
-            "class": self._class
+            "type": self.type,
+            "uploader": self.uploader.username if self.uploader else None,
+            "class": self._class.name if self._class else None,
+            "size": self.size,
+            "mimetype": self.mimetype,
+            "pages": self.pages,
+            # The content decides the URL, so the preview can be cached for good
+            "preview": f"/files/{self.id}/preview?v={self.sha256[:16]}" if self.has_preview else None
+        }
+
+    # Name the browser saves the File as
+    def download_name(self):
+        return self.title + (mimetypes.guess_extension(self.mimetype or "") or "")
+
+    # Creates a File for content already in the store, its content is the download link
+    def create(uploader, title, _class, type, sha256, size, mimetype):
+        file = File(
+            uploader_id=uploader,
+            title=title,
+            class_id=_class,
+            type=type,
+            sha256=sha256,
+            size=size,
+            mimetype=mimetype,
+            content=""
+        )
+        db.session.add(file)
+        db.session.flush()
+        file.content = f"/files/{file.id}/download"
+        commit()
+        return file
+
+    # Saves what the process_file job found out about the File's content
+    def describe(file, mimetype, pages, preview):
+        file.mimetype = mimetype
+        file.pages = pages
+        file.has_preview = preview
+        file.processed_at = datetime.now()
+        commit()
+
+    # Deletes a File, its stored content is removed by a job once unused (see jobs.py)
+    def delete(file):
+        LikedFiles.query.filter_by(file_id=file.id).delete(synchronize_session=False)
+        db.session.delete(file)
+        commit()
+
+    # Whether any File still has this content
+    def is_stored(sha256):
+        return db.session.query(File.query.filter_by(sha256=sha256).exists()).scalar()
+
+    # What the search index stores for this File (only its title is searchable)
+    def search_document(self):
+        return {
+            "kind": "file",
+            "ref_id": self.id,
+            "class_id": self.class_id,
+            "type": self.type,
+            "title": self.title,
+            "content": ""
         }
 
 # ----------------------------------------------------------------------------------------------        
@@ -422,7 +1053,7 @@ class File(db.Model):
 ! Coll Model & methods
 * OvidioSantoro - 2022-02-23
 """
-class Coll(db.Model):
+class Coll(db.Model, Versioned):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60), nullable=False)
     content = db.Column(db.Text, nullable=False)
@@ -434,27 +1065,129 @@ class Coll(db.Model):
     favs_colls = db.relationship("User", secondary=FavoriteColls, back_populates="fav_colls")
     coll_liked = db.relationship("LikedColls", back_populates="liked_coll")
     comments = db.relationship("Comment", back_populates="coll")
-    timestamp = db.Column(db.DateTime, default=datetime.now())
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.now, server_default=db.func.now())
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    dislike_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    __table_args__ = (
+        db.Index("ix_coll_timestamp_id", "timestamp", "id"),
+        db.Index("ix_coll_class_id_timestamp_id", "class_id", "timestamp", "id"),
+        db.Index("ix_coll_sender_id_timestamp_id", "sender_id", "timestamp", "id"),
+    )
 
     def __repr__(self):
         return f"{self.title} in {self._class}"
 
-    def serialize(self):
-        return{
+    # With counts=True the likes list is replaced by the like/dislike counters
+    # and the vote of the user viewing the Coll (my_like)
+    def serialize(self, counts=False, my_like=None):
+        coll = {
             "id": self.id,
-            "portrait": User.query.get(self.sender_id).portrait,
-            "sender": User.query.get(self.sender_id).username,
-            "class": Class.query.get(self.class_id).name,
-            "studies": [faculty.name for faculty in User.query.get(self.sender_id).faculties],
+            "portrait": self.sender.portrait if self.sender else None,
+            "sender": self.sender.username if self.sender else None,
+            "class": self._class.name,
+            "studies": [faculty.name for faculty in self.sender.faculties] if self.sender else [],
             "timestamp": f"{self.timestamp.strftime('%x, %X')}",
             "title": self.title,
-            "likes": [{like.coll_liker.username: like.is_like} for like in LikedColls.query.filter_by(coll_id=self.id)],
             "content": self.content,
             "comments": [comment.content for comment in self.comments],
             "favs": [fav.username for fav in self.favs_colls],
             "type": self.type
         }
+        if counts:
+            coll["like_count"] = self.like_count
+            coll["dislike_count"] = self.dislike_count
+            coll["my_like"] = my_like
+        else:
+            coll["likes"] = [{like.coll_liker.username: like.is_like} for like in self.coll_liked]
+        return coll
+
+    # Serializes a page of Colls flagging the ones faved by the viewer,
+    # the viewer's favs (and votes, in counts mode) come from one query each
+    def serialize_page(colls, viewer=None, counts=False):
+        ids = [coll.id for coll in colls]
+        votes = LikedColls.votes_of(viewer, ids) if counts else {}
+        faved = Coll.faved_by(viewer, ids)
+
+        page = []
+        for coll in colls:
+            serialized = coll.serialize(counts, votes.get(coll.id))
+            serialized["faved_by_me"] = coll.id in faved
+            page.append(serialized)
+        return page
+
+
+    # What the search index stores for this Coll
+    def search_document(self):
+        return {
+            "kind": "coll",
+            "ref_id": self.id,
+            "class_id": self.class_id,
+            "type": self.type,
+            "title": self.title,
+            "content": self.content
+        }
 
+    # Returns what the serialized Coll depends on, without loading it: its version,
+    # its sender's, the name of its Class and the names of the sender's Faculties
+    def version_of(id):
+        rows = db.session.query(
+            Coll.version, User.version, Class.name, Faculty.name, VersionCounter.current("usernames")
+        ).outerjoin(User, Coll.sender_id == User.id).outerjoin(Class, Coll.class_id == Class.id).outerjoin(
+            FacultyMembers, FacultyMembers.c.user_id == User.id
+        ).outerjoin(Faculty, FacultyMembers.c.faculty_id == Faculty.id).filter(Coll.id == id).order_by(Faculty.id).all()
+        return tuple(rows) or None
+
+    # Bumps the version of a Coll whose likes/favs changed outside the ORM
+    def touch(coll):
+        Coll.query.filter_by(id=coll).update({Coll.version: Coll.version + 1}, synchronize_session=False)
+
+    # Query that loads everything serialize() needs for a whole page of Colls
+    # in a constant number of queries, no matter how many Colls it returns
+    # (the likes are skipped when the page is serialized with counts=True)
+    def feed_query(likes=True):
+        options = [
+            joinedload(Coll.sender).selectinload(User.faculties),
+            joinedload(Coll._class),
+            selectinload(Coll.comments),
+            selectinload(Coll.favs_colls)
+        ]
+        if likes:
+            options.append(selectinload(Coll.coll_liked).joinedload(LikedColls.coll_liker))
+        return Coll.query.options(*options)
+
+    # Adds delta to the like (or dislike) counter of a Coll in the current transaction
+    def count_vote(coll, like, delta):
+        if like is None:
+            return
+        counter = Coll.like_count if like else Coll.dislike_count
+        Coll.query.filter_by(id=coll).update({counter: counter + delta}, synchronize_session=False)
+
+    # Correlated subqueries counting the likes and dislikes of each Coll
+    def _vote_counts():
+        likes = db.select(db.func.count()).where(
+            LikedColls.coll_id == Coll.id, LikedColls.is_like.is_(True)
+        ).scalar_subquery()
+        dislikes = db.select(db.func.count()).where(
+            LikedColls.coll_id == Coll.id, LikedColls.is_like.is_(False)
+        ).scalar_subquery()
+        return likes, dislikes
+
+    # Recomputes the counters of one Coll from liked_colls, in the current transaction
+    def recount(coll):
+        likes, dislikes = Coll._vote_counts()
+        Coll.query.filter_by(id=coll).update(
+            {Coll.like_count: likes, Coll.dislike_count: dislikes, Coll.version: Coll.version + 1},
+            synchronize_session=False
+        )
+
+    # Recomputes the like/dislike counters that drifted from liked_colls, returns how many were fixed
+    def repair_counts():
+        likes, dislikes = Coll._vote_counts()
+        repaired = Coll.query.filter(
+            db.or_(Coll.like_count != likes, Coll.dislike_count != dislikes)
+        ).update({Coll.like_count: likes, Coll.dislike_count: dislikes}, synchronize_session=False)
+        commit()
+        return repaired
 
     # Creates a new Coll
     def create(sender, title, content, _class, type):
@@ -467,32 +1200,235 @@ class Coll(db.Model):
         )
 
         db.session.add(coll)
-        db.session.commit()
+        db.session.flush()
+        Timeline.fan_out([coll.id])
+        Coll.announce(coll)
+        commit()
+        return coll
+
+    # Creates many Colls ({"title", "content", "_class", "type"}) in one transaction,
+    # with one INSERT for all of them
+    def create_many(sender, rows):
+        colls = insert_many(Coll, [
+            {"sender_id": sender, "title": row["title"], "content": row["content"], "class_id": row["_class"], "type": row["type"]}
+            for row in rows
+        ])
+        Timeline.fan_out([coll.id for coll in colls])
+        for coll in colls:
+            Coll.announce(coll)
+        commit()
+        return colls
+
+    # Tells the Class about a new Coll (once the transaction commits)
+    def announce(coll):
+        publish(f"class:{coll.class_id}", "coll", {
+            "id": coll.id,
+            "sender": coll.sender_id,
+            "title": coll.title,
+            "type": coll.type
+        })
 
     # Updates a Coll
     def update(coll, title, content):
         coll.title = title
         coll.content = content
-        db.session.commit()
+        commit()
 
     # Deletes a Coll from the database
     def delete(coll):
         db.session.delete(coll)
-        db.session.commit()
+        commit()
+
+    # Checks whether a User has faved a Coll (a primary key lookup on favorite_colls)
+    def is_faved(coll, user):
+        return db.session.query(db.exists().where(
+            FavoriteColls.c.user_id == user,
+            FavoriteColls.c.coll_id == coll
+        )).scalar()
+
+    # Returns the ids of the given Colls that the User has faved, in one query
+    def faved_by(user, colls):
+        if user is None or not colls:
+            return set()
+        faved = db.session.query(FavoriteColls.c.coll_id).filter(
+            FavoriteColls.c.user_id == user,
+            FavoriteColls.c.coll_id.in_(colls)
+        )
+        return {coll_id for coll_id, in faved}
 
-    # Favs a Coll
+    # Favs a Coll (faving it twice is harmless), returns the new state
     def fav(coll, user):
-        favs = coll.favs_colls
-        favs.append(user)
-        coll.favs_colls = favs
-        db.session.commit()
+        upsert(FavoriteColls, {"user_id": user, "coll_id": coll})
+        Coll.touch(coll)
+        commit()
+        return True
 
-    # Favs a Coll
+    # Unfavs a Coll, returns the new state
     def unfav(coll, user):
-        favs = coll.favs_colls
-        favs.remove(user)
-        coll.favs_colls = favs
-        db.session.commit()
+        db.session.execute(FavoriteColls.delete().where(
+            FavoriteColls.c.user_id == user,
+            FavoriteColls.c.coll_id == coll
+        ))
+        Coll.touch(coll)
+        commit()
+        return False
+
+    # Favs or unfavs a Coll like the Fav button does, returns the new state
+    def toggle_fav(coll, user):
+        removed = db.session.execute(FavoriteColls.delete().where(
+            FavoriteColls.c.user_id == user,
+            FavoriteColls.c.coll_id == coll
+        )).rowcount
+        if not removed:
+            return Coll.fav(coll, user)
+        Coll.touch(coll)
+        commit()
+        return False
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Timeline Model & methods
+? The home feed of every user, precomputed: one row per (student, Coll of one
+? of their Classes), written when the Coll is created (fan-out on write), so a
+? page of /home is one index range scan whatever the number of Classes. Classes
+? with more than FANOUT_LIMIT students would write too many rows per Coll, so
+? they are left out and their Colls are read from coll when the page is built
+? (fan-out on read). Both are merged under one cursor, the same as /colls'
+"""
+FANOUT_LIMIT = int(os.environ.get("TIMELINE_FANOUT_LIMIT", 1000))
+
+class Timeline(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    coll_id = db.Column(db.Integer, db.ForeignKey("coll.id"), primary_key=True, index=True)
+    class_id = db.Column(db.Integer, db.ForeignKey("class.id"), nullable=False)
+    # The Coll's, copied so pages are read from this table alone
+    timestamp = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index("ix_timeline_user_id_timestamp_coll_id", "user_id", "timestamp", "coll_id"),
+    )
+
+    def __repr__(self):
+        return f"Coll #{self.coll_id} in User #{self.user_id}'s timeline"
+
+    # The entries of the given Colls (and users) that should exist, as a SELECT.
+    # Colls of Classes above the limit have none
+    def _entries(limit, colls=None, users=None, classes=None):
+        roster = ClassStudents.alias("roster")
+        students = db.select(db.func.count()).where(roster.c.class_id == Coll.class_id).scalar_subquery()
+        query = db.select(ClassStudents.c.user_id, Coll.id, Coll.class_id, Coll.timestamp).join(
+            ClassStudents, ClassStudents.c.class_id == Coll.class_id
+        ).where(students <= limit)
+        if colls is not None:
+            query = query.where(Coll.id.in_(colls))
+        if users is not None:
+            query = query.where(ClassStudents.c.user_id.in_(users))
+        if classes is not None:
+            query = query.where(Coll.class_id.in_(classes))
+        return query
+
+    def _insert(query):
+        return db.session.execute(db.insert(Timeline).from_select(
+            ["user_id", "coll_id", "class_id", "timestamp"], query
+        )).rowcount
+
+    # Adds new Colls to the timelines of their Classes' students, with one
+    # INSERT ... SELECT. Returns the number of entries written
+    def fan_out(colls):
+        if not colls:
+            return 0
+        return Timeline._insert(Timeline._entries(FANOUT_LIMIT, colls=colls))
+
+    # Removes the entries of some users and/or Classes (all of them by default)
+    def clear(users=None, classes=None):
+        query = Timeline.query
+        if users is not None:
+            query = query.filter(Timeline.user_id.in_(users))
+        if classes is not None:
+            query = query.filter(Timeline.class_id.in_(classes))
+        query.delete(synchronize_session=False)
+
+    # Rewrites the entries of some users and/or Classes from their Colls, e.g.
+    # after joining a Class (everything by default). Returns the entries written
+    def fill(users=None, classes=None):
+        Timeline.clear(users, classes)
+        return Timeline._insert(Timeline._entries(FANOUT_LIMIT, users=users, classes=classes))
+
+    # Keeps the timelines of Classes right after students joined (or left) them,
+    # {class_id: students that joined, negative if they left}, for the ones that
+    # went over (or back under) FANOUT_LIMIT. The students are counted in one query
+    def resize(changes):
+        counts = Class.student_counts(list(changes))
+        for id, change in changes.items():
+            after = counts.get(id, 0)
+            before = after - change
+            if before <= FANOUT_LIMIT < after:
+                Timeline.clear(classes=[id])
+            elif after <= FANOUT_LIMIT < before:
+                Timeline.fill(classes=[id])
+
+    # Query for (class_id, number of students) of the Classes of a user
+    def classes_query(user):
+        mine = ClassStudents.alias()
+        return db.session.query(mine.c.class_id, db.func.count()).join(
+            ClassStudents, ClassStudents.c.class_id == mine.c.class_id
+        ).filter(mine.c.user_id == user).group_by(mine.c.class_id)
+
+    # Returns {class_id: number of students} of the Classes of a user, in one query
+    def classes_of(user):
+        return dict(Timeline.classes_query(user))
+
+    # The two sources of a home feed, paginated with keyset_page on (timestamp, id):
+    # the user's timeline entries, but those of the pulled Classes, and the Colls
+    # of the pulled Classes (the ones over fanout_limit)
+    def pushed_query(user, pulled=None):
+        query = db.session.query(Timeline.timestamp, Timeline.coll_id).filter(Timeline.user_id == user)
+        if pulled:
+            query = query.filter(Timeline.class_id.notin_(pulled))
+        return query
+
+    def pulled_query(pulled):
+        return db.session.query(Coll.timestamp, Coll.id).filter(Coll.class_id.in_(pulled))
+
+    """
+    ! Returns the Coll ids of a page of a user's home feed and the cursor of the next one
+    ? The Colls of the Classes up to fanout_limit students come from the
+    ? timeline, the rest straight from coll; each source sends one page and the
+    ? newest `limit` of both are kept. fanout_limit=0 reads everything from coll
+    ? (plain fan-out on read, what the benchmark compares it with)
+    """
+    def page_ids(user, after=None, limit=None, fanout_limit=None):
+        limit = min(max(limit or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+        fanout_limit = FANOUT_LIMIT if fanout_limit is None else fanout_limit
+        classes = Timeline.classes_of(user)
+        pulled = [id for id, students in classes.items() if students > fanout_limit]
+
+        rows, more = [], False
+        if len(pulled) < len(classes):
+            entries, cursor = keyset_page(
+                Timeline.pushed_query(user, pulled), (Timeline.timestamp, Timeline.coll_id), after, limit
+            )
+            rows += [(entry.timestamp, entry.coll_id) for entry in entries]
+            more = cursor is not None
+        if pulled:
+            colls, cursor = keyset_page(Timeline.pulled_query(pulled), (Coll.timestamp, Coll.id), after, limit)
+            rows += [(coll.timestamp, coll.id) for coll in colls]
+            more = more or cursor is not None
+
+        rows.sort(reverse=True)
+        if len(rows) > limit:
+            rows, more = rows[:limit], True
+        return [id for _, id in rows], encode_cursor(rows[-1]) if more else None
+
+    # Loads the Colls of a page for serialize_page, in the page's order
+    def load(ids, likes=True):
+        colls = {coll.id: coll for coll in Coll.feed_query(likes).filter(Coll.id.in_(ids))} if ids else {}
+        return [colls[id] for id in ids if id in colls]
+
+    # Same as page_ids, with the Colls loaded
+    def page(user, after=None, limit=None, likes=True, fanout_limit=None):
+        ids, cursor = Timeline.page_ids(user, after, limit, fanout_limit)
+        return Timeline.load(ids, likes), cursor
 
 # ----------------------------------------------------------------------------------------------
 
@@ -503,11 +1439,11 @@ class Coll(db.Model):
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    commenter_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    commenter_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     commenter = db.relationship("User", back_populates="comments")
-    coll_id = db.Column(db.Integer, db.ForeignKey("coll.id"))
+    coll_id = db.Column(db.Integer, db.ForeignKey("coll.id"), index=True)
     coll = db.relationship("Coll", back_populates="comments")
-    timestamp = db.Column(db.DateTime, default=datetime.now())
+    timestamp = db.Column(db.DateTime, default=datetime.now)
 
 
     def __repr__(self):
@@ -519,4 +1455,276 @@ class Comment(db.Model):
             "commenter": self.commenter,
             "coll": self.coll,
             "content": self.content
-        }
\ No newline at end of file
+        }
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Job Model & methods
+? The background job queue (see jobs.py). A job is enqueued in the transaction
+? of the request that needs it, so it only exists if that request commits.
+? Workers claim a job with a conditional UPDATE (queued -> running), which only
+? one of them can win on any backend. Failed jobs are retried later with an
+? exponential backoff until max_attempts
+"""
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    worker = db.Column(db.String(50))
+    error = db.Column(db.Text)
+
+    __table_args__ = (db.Index("ix_job_status_run_at", "status", "run_at"),)
+
+    def __repr__(self):
+        return f"Job #{self.id} {self.name} ({self.status})"
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "payload": self.payload,
+            "status": self.status,
+            "attempts": self.attempts,
+            "run_at": self.run_at,
+            "error": self.error
+        }
+
+    # Adds a job to the queue, in the current transaction
+    def enqueue(name, payload, delay=0, max_attempts=5):
+        job = Job(name=name, payload=payload, max_attempts=max_attempts, run_at=datetime.now() + timedelta(seconds=delay))
+        db.session.add(job)
+        commit()
+        return job
+
+    # The ids of the next jobs that are due (of the given tasks, or any), oldest first
+    def due_query(now, names=None, limit=10):
+        due = db.select(Job.id).where(Job.status == "queued", Job.run_at <= now)
+        if names:
+            due = due.where(Job.name.in_(names))
+        return due.order_by(Job.run_at, Job.id).limit(limit)
+
+    # Takes the next job that is due for a worker (of the given tasks, or any),
+    # None if there is none
+    def claim(worker, names=None):
+        now = datetime.now()
+        due = db.session.scalars(Job.due_query(now, names)).all()
+        for id in due:
+            claimed = Job.query.filter(Job.id == id, Job.status == "queued").update({
+                Job.status: "running",
+                Job.worker: worker,
+                Job.started_at: now,
+                Job.attempts: Job.attempts + 1
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return db.session.get(Job, id)
+        return None
+
+    def finish(job):
+        job.status = "done"
+        job.finished_at = datetime.now()
+        job.error = None
+        db.session.commit()
+
+    # Schedules another attempt (after 5s, 10s, 20s... up to an hour) or gives up,
+    # returns the new status
+    def fail(job, error, backoff=5):
+        job.error = error
+        job.finished_at = datetime.now()
+        if job.attempts < job.max_attempts:
+            job.status = "queued"
+            job.run_at = job.finished_at + timedelta(seconds=min(backoff * 2 ** (job.attempts - 1), 3600))
+        else:
+            job.status = "failed"
+        db.session.commit()
+        return job.status
+
+    # Puts the jobs of workers that died mid-job back in the queue
+    def requeue_stale(timeout):
+        requeued = Job.query.filter(
+            Job.status == "running",
+            Job.started_at < datetime.now() - timedelta(seconds=timeout)
+        ).update({Job.status: "queued", Job.error: "Timed out"}, synchronize_session=False)
+        db.session.commit()
+        return requeued
+
+    # Failed jobs (all of them or the given ones) get another max_attempts
+    def retry(ids=None):
+        query = Job.query.filter(Job.status == "failed")
+        if ids:
+            query = query.filter(Job.id.in_(ids))
+        retried = query.update(
+            {Job.status: "queued", Job.attempts: 0, Job.run_at: datetime.now()}, synchronize_session=False
+        )
+        db.session.commit()
+        return retried
+
+    # Deletes the jobs that were done more than `days` ago
+    def purge(days):
+        purged = Job.query.filter(
+            Job.status == "done",
+            Job.finished_at < datetime.now() - timedelta(days=days)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return purged
+
+    # Number of jobs that are due and waiting for a worker
+    def backlog():
+        return Job.query.filter(Job.status == "queued", Job.run_at <= datetime.now()).count()
+
+    # Same as backlog, per task
+    def backlog_by_name():
+        return dict(db.session.execute(
+            db.select(Job.name, db.func.count()).where(Job.status == "queued", Job.run_at <= datetime.now()).group_by(Job.name)
+        ).all())
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Catalog cache invalidation & version bumps
+? The colleges/faculties/classes endpoints are cached (see cache.py). Any commit
+? that changes those rows or the class/faculty memberships bumps the "catalog"
+? VersionCounter, which the other workers check their cache against, and clears
+? the cache of this one, whether it comes from our helpers, Core statements or
+? the Flask-Admin views. Comments, likes and tags bump the
+? version of the Coll/User they are serialized into, renaming or deleting a User
+? bumps the "usernames" VersionCounter. The events published
+? during the transaction are sent, and the changed Users dropped from the
+? identity cache, once it commits
+"""
+CATALOG_TABLES = {"college", "faculty", "class", "class_students", "faculty_members"}
+
+def _changes_catalog(obj, session):
+    if isinstance(obj, (College, Faculty, Class)):
+        return True
+    if isinstance(obj, User):
+        if obj in session.new or obj in session.deleted:
+            return True
+        state = db.inspect(obj)
+        return any(state.attrs[attr].history.has_changes() for attr in ("classes", "faculties"))
+    return False
+
+def _renames_user(obj, session):
+    if not isinstance(obj, User) or obj in session.new:
+        return False
+    return obj in session.deleted or db.inspect(obj).attrs.username.history.has_changes()
+
+def _touched_row(obj):
+    if isinstance(obj, LikedColls):
+        return "touched_colls", obj.coll_id or getattr(obj.liked_coll, "id", None)
+    if isinstance(obj, Comment):
+        return "touched_colls", obj.coll_id or getattr(obj.coll, "id", None)
+    if isinstance(obj, Tag):
+        return "touched_users", obj.user_id or getattr(obj.user, "id", None)
+    return None, None
+
+@event.listens_for(db.session, "before_flush")
+def _track_catalog_flush(session, flush_context, instances):
+    for obj in session.new:
+        if isinstance(obj, Comment):
+            coll = obj.coll or (obj.coll_id and session.get(Coll, obj.coll_id))
+            if coll:
+                publish(f"class:{coll.class_id}", "comment", {
+                    "coll": coll.id,
+                    "commenter": obj.commenter_id or getattr(obj.commenter, "id", None),
+                    "content": obj.content
+                })
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if _changes_catalog(obj, session):
+            session.info["catalog_changed"] = True
+        if _renames_user(obj, session):
+            session.info["usernames_changed"] = True
+        touched, id = _touched_row(obj)
+        if id is not None:
+            session.info.setdefault(touched, set()).add(id)
+        if isinstance(obj, User) and obj not in session.new:
+            session.info.setdefault("changed_users", set()).add(obj.id)
+
+@event.listens_for(db.session, "do_orm_execute")
+def _track_catalog_statement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None and table.name in CATALOG_TABLES:
+            orm_execute_state.session.info["catalog_changed"] = True
+
+@event.listens_for(db.session, "before_commit")
+def _bump_versions(session):
+    session.flush()
+    if session.info.get("catalog_changed"):
+        VersionCounter.bump("catalog")
+    if session.info.pop("usernames_changed", False):
+        VersionCounter.bump("usernames")
+
+    colls = session.info.pop("touched_colls", None)
+    if colls:
+        Coll.query.filter(Coll.id.in_(colls)).update({Coll.version: Coll.version + 1}, synchronize_session=False)
+    users = session.info.pop("touched_users", None)
+    if users:
+        User.query.filter(User.id.in_(users)).update({User.version: User.version + 1}, synchronize_session=False)
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_catalog(session):
+    if session.info.pop("catalog_changed", False):
+        catalog_cache.clear()
+    for id in session.info.pop("changed_users", ()):
+        identity_cache.pop(id)
+    for channel, name, data in session.info.pop("events", ()):
+        hub.publish(channel, name, data)
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _discard_catalog_changes(session, previous_transaction):
+    for key in ("catalog_changed", "usernames_changed", "touched_colls", "touched_users", "changed_users", "events"):
+        session.info.pop(key, None)
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Timeline sync
+? Deleted Colls leave the timelines before their row goes (the foreign key),
+? whether they are deleted by Coll.delete, the admin or a script
+"""
+@event.listens_for(db.session, "before_flush")
+def _clear_deleted_colls(session, flush_context, instances):
+    colls = [obj.id for obj in session.deleted if isinstance(obj, Coll)]
+    if colls:
+        session.execute(Timeline.__table__.delete().where(Timeline.coll_id.in_(colls)))
+
+# ----------------------------------------------------------------------------------------------
+
+"""
+! Full-text search index sync
+? Colls and Files are (re)indexed in the same transaction that creates, edits
+? or deletes them (see search.py), and create_all() also creates the index
+"""
+SEARCHABLE = {Coll: ("title", "content", "class_id", "type"), File: ("title", "class_id", "type")}
+
+@event.listens_for(db.session, "after_flush")
+def _sync_search_index(session, flush_context):
+    documents, removed = [], []
+    for obj in (*session.new, *session.dirty):
+        attrs = SEARCHABLE.get(type(obj))
+        if attrs is None:
+            continue
+        state = db.inspect(obj)
+        if obj in session.new or any(state.attrs[attr].history.has_changes() for attr in attrs):
+            documents.append(obj.search_document())
+    for obj in session.deleted:
+        if type(obj) in SEARCHABLE:
+            removed.append(search.doc_id(obj.search_document()["kind"], obj.id))
+
+    if documents or removed:
+        connection = session.connection()
+        search.remove(connection, removed)
+        search.index(connection, documents)
+
+@event.listens_for(db.metadata, "after_create")
+def _create_search_index(target, connection, **kw):
+    search.create_index(connection)
@@ -0,0 +1,49 @@
+"""
+This module hashes and checks the passwords on a bounded pool of threads
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+"""
+! Password hashing settings
+? PASSWORD_HASH_METHOD is any Werkzeug method ("pbkdf2:sha256:600000",
+? "scrypt:32768:8:1"...), logins re-hash older passwords to it (see
+? User.upgrade_password). PASSWORD_HASH_WORKERS caps how many hashes run at
+? once in this process: hashlib releases the GIL, so they run in parallel
+? without starving the threads that serve other requests. The request thread
+? still waits for its hash, so a sync gunicorn worker serves nothing else
+? meanwhile; the gthread workers of gunicorn.conf.py keep serving on their
+? other threads (`flask auth benchmark` measures it on /login)
+"""
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:600000")
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_method_prefix = None
+
+# The pool is created lazily in each process, so it is safe to fork after importing this
+def _executor():
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+                _pool_pid = os.getpid()
+    return _pool
+
+def hash_password(password):
+    return _executor().submit(generate_password_hash, password, method=PASSWORD_HASH_METHOD).result()
+
+def check_password(hashed, password):
+    return _executor().submit(check_password_hash, hashed, password).result()
+
+# Whether a hash was made with another method or cost than the configured one
+def needs_rehash(hashed):
+    global _method_prefix
+    if _method_prefix is None:
+        _method_prefix = generate_password_hash("", method=PASSWORD_HASH_METHOD).split("$", 1)[0]
+    return hashed.split("$", 1)[0] != _method_prefix
@@ -0,0 +1,89 @@
+"""
+This module checks that the hot queries of the endpoints are answered through
+indexes: each one is EXPLAINed and any full table scan in its plan is reported
+"""
+import re
+from datetime import datetime
+from sqlalchemy import text
+import search
+from utils import keyset_query, encode_cursor
+from models import db, ClassStudents, FavoriteColls, User, Message, Conversation, Network, Tag, Faculty, Class, Coll, Comment, LikedColls, Timeline, Job, File
+
+"""
+! The queries the endpoints run the most, with sample ids
+? Keep it in step with main.py when an endpoint starts filtering or sorting on
+? another column
+"""
+def hot_queries():
+    feed_order = (Coll.timestamp.desc(), Coll.id.desc())
+    likes, dislikes = Coll._vote_counts()
+    return [
+        ("feed", Coll.feed_query(likes=False).order_by(*feed_order).limit(20)),
+        ("class feed", Coll.feed_query(likes=False).filter_by(class_id=1).order_by(*feed_order).limit(20)),
+        ("user colls", Coll.query.filter_by(sender_id=2).order_by(*feed_order)),
+        ("coll comments", Comment.query.filter_by(coll_id=1)),
+        ("coll counters", db.select(likes, dislikes).where(Coll.id == 1)),
+        ("faved by", db.session.query(FavoriteColls.c.coll_id).filter(
+            FavoriteColls.c.user_id == 2, FavoriteColls.c.coll_id.in_([1, 2, 3]))),
+        ("coll favs", db.session.query(FavoriteColls.c.user_id).filter(FavoriteColls.c.coll_id == 1)),
+        ("votes of", db.session.query(LikedColls.coll_id, LikedColls.is_like).filter(
+            LikedColls.user_id == 2, LikedColls.coll_id.in_([1, 2, 3]))),
+        ("received messages", Message.query.filter_by(receiver=2)),
+        ("sent messages", Message.query.filter_by(sender=2)),
+        *[(f"thread ({direction})", query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(21))
+          for direction, query in zip(("received", "sent"), Message.thread_queries(2, 3))],
+        ("inbox", keyset_query(Conversation.inbox_query(2), Conversation.inbox_keys())),
+        ("inbox (next page)", keyset_query(
+            Conversation.inbox_query(2), Conversation.inbox_keys(), encode_cursor([datetime(2020, 1, 1), 3]))),
+        ("networks", Network.query.filter_by(owner=2)),
+        ("tags", Tag.query.filter_by(user_id=2)),
+        ("roster", Class.roster_query(1).order_by(Class.roster_key().desc()).limit(21)),
+        ("student counts", db.session.query(ClassStudents.c.class_id, db.func.count()).filter(
+            ClassStudents.c.class_id.in_([1, 2, 3])).group_by(ClassStudents.c.class_id)),
+        ("user classes", db.session.query(ClassStudents.c.class_id).filter(ClassStudents.c.user_id == 2)),
+        ("faculty classes", Class.query.filter_by(faculty_id=1)),
+        ("college faculties", Faculty.query.filter_by(college_id=1)),
+        ("login", User.query.filter_by(email="someone@ucoll.es")),
+        ("home classes", Timeline.classes_query(2)),
+        ("home timeline", Timeline.pushed_query(2, [3]).order_by(
+            Timeline.timestamp.desc(), Timeline.coll_id.desc()).limit(21)),
+        ("home pulled colls", Timeline.pulled_query([3, 4]).order_by(*feed_order).limit(21)),
+        ("search", search.search_statement(db.session.connection(), "notes", class_id=1, kind="file")),
+        ("job claim", Job.due_query(datetime.now())),
+        ("job claim (tasks)", Job.due_query(datetime.now(), ["process_file"])),
+        ("class files", File.query.filter_by(class_id=1).order_by(File.timestamp.desc(), File.id.desc()).limit(21)),
+        ("stored blob", db.session.query(File.query.filter_by(sha256="0" * 64).exists())),
+    ]
+
+"""
+! EXPLAINs a query and returns (plan lines, tables read in full)
+? Postgres picks a sequential scan for any small table, so it is asked for the
+? plan with sequential scans turned off: a Seq Scan that survives that means
+? there is no index it could use
+"""
+def explain(connection, query):
+    statement = getattr(query, "statement", query)
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    dialect = connection.dialect.name
+
+    if dialect == "sqlite":
+        plan = [row[-1] for row in connection.execute(text("EXPLAIN QUERY PLAN " + sql))]
+        scans = [match.group(1) for line in plan for match in [re.match(r"SCAN (\w+)$", line)] if match]
+    elif dialect == "postgresql":
+        connection.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = [row[0] for row in connection.execute(text("EXPLAIN " + sql))]
+        scans = [match.group(1) for line in plan for match in [re.search(r"Seq Scan on (\w+)", line)] if match]
+    else:
+        rows = [row._mapping for row in connection.execute(text("EXPLAIN " + sql))]
+        plan = [f"{row['table']}: {row['type']} {row['key'] or ''}".strip() for row in rows]
+        scans = [row["table"] for row in rows if row["type"] == "ALL"]
+
+    return plan, scans
+
+# Returns [(name, plan, scans)] for every hot query
+def check(connection):
+    results = []
+    for name, query in hot_queries():
+        plan, scans = explain(connection, query)
+        results.append((name, plan, scans))
+    return results
@@ -0,0 +1,117 @@
+"""
+This module works out what an uploaded File is (its real type, its pages) and
+renders a small preview of the images and PDFs, so the lists of Files never
+need the originals. It runs in the job workers (see the process_file task in
+jobs.py). Pillow renders the images and poppler's pdftoppm the PDFs; without
+them those Files simply get no preview
+"""
+import mmap
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from io import BytesIO
+import storage
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Longest side of a preview, in pixels
+PREVIEW_SIZE = int(os.environ.get("PREVIEW_SIZE", 320))
+PREVIEW_NAME = "preview.jpg"
+PDFTOPPM = shutil.which("pdftoppm")
+PDFINFO = shutil.which("pdfinfo")
+# Seconds before giving up on a PDF poppler can't render
+TIMEOUT = 60
+
+# What a corrupt or hostile File makes the renderers raise
+RENDER_ERRORS = (OSError, ValueError, subprocess.SubprocessError) + ((Image.DecompressionBombError,) if Image else ())
+
+# (offset, magic bytes, type) of the formats we can tell by their first bytes
+SIGNATURES = [
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (0, b"PK\x03\x04", "application/zip"),
+]
+
+# The type of a blob by its first bytes, None if it is none we know. Office
+# documents are zips, the type they were uploaded with is kept for those
+def sniff(path, declared=None):
+    with open(path, "rb") as file:
+        head = file.read(16)
+    for offset, magic, mimetype in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            if mimetype == "application/zip" and declared and declared.startswith("application/vnd."):
+                return declared
+            return mimetype
+    return None
+
+# Pages of a PDF, from pdfinfo or else from the /Count of its page tree
+# (which compressed object streams can hide), None if unknown
+def page_count(path):
+    if PDFINFO:
+        try:
+            info = subprocess.run([PDFINFO, path], capture_output=True, text=True, timeout=TIMEOUT).stdout
+            match = re.search(r"^Pages:\s+(\d+)", info, re.MULTILINE)
+            if match:
+                return int(match.group(1))
+        except subprocess.TimeoutExpired:
+            pass
+
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        counts = [int(count) for count in re.findall(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)", content)]
+        counts += [int(count) for count in re.findall(rb"/Count\s+(\d+)[^>]*?/Type\s*/Pages\b", content)]
+    return max(counts) if counts else None
+
+def _thumbnail(image):
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    output = BytesIO()
+    image.convert("RGB").save(output, "JPEG", quality=80, optimize=True)
+    return output.getvalue()
+
+# JPEG preview of an image or of the first page of a PDF, None if it can't be made
+def render(path, mimetype):
+    if mimetype.startswith("image/") and Image is not None:
+        with Image.open(path) as image:
+            image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+            return _thumbnail(image)
+
+    if mimetype == "application/pdf" and PDFTOPPM:
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "page")
+            subprocess.run(
+                [PDFTOPPM, "-jpeg", "-f", "1", "-l", "1", "-singlefile", "-scale-to", str(PREVIEW_SIZE), path, output],
+                check=True, capture_output=True, timeout=TIMEOUT
+            )
+            with open(f"{output}.jpg", "rb") as page:
+                return page.read()
+    return None
+
+"""
+! Works out a stored blob's metadata and preview, returns (mimetype, pages, preview)
+? The preview is stored next to the blob (storage.derived_name), so Files with
+? the same content share it and it is only rendered once. A File that can't be
+? read (corrupt, an image bomb...) gets no preview instead of failing its job
+"""
+def process(sha256, declared):
+    path = storage.path(sha256)
+    mimetype = sniff(path, declared) or declared
+    pages = page_count(path) if mimetype == "application/pdf" else None
+
+    preview = os.path.exists(storage.derived_path(sha256, PREVIEW_NAME))
+    if not preview:
+        try:
+            data = render(path, mimetype)
+        except RENDER_ERRORS:
+            data = None
+        if data is not None:
+            storage.save_derived(sha256, PREVIEW_NAME, data)
+            preview = True
+    return mimetype, pages, preview
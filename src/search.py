@@ -0,0 +1,192 @@
+"""
+This module keeps the full-text search index of the Colls and Files, on top of
+the database's own full-text search: FTS5 on SQLite, tsvector + GIN on Postgres
+and FULLTEXT indexes on MySQL
+"""
+import os
+import random
+import re
+import tempfile
+import time
+from sqlalchemy import create_engine, text
+
+"""
+! Search index table
+? Colls and Files share one index. doc_id packs both kinds in one integer key
+? (id * 2 + kind) because FTS5 tables can only be looked up quickly by rowid
+"""
+KINDS = {"coll": 0, "file": 1}
+
+SCHEMA = {
+    "sqlite": [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            title, content, kind UNINDEXED, ref_id UNINDEXED, class_id UNINDEXED, type UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )"""
+    ],
+    "postgresql": [
+        """CREATE TABLE IF NOT EXISTS search_index (
+            doc_id BIGINT PRIMARY KEY,
+            kind VARCHAR(4) NOT NULL,
+            ref_id INTEGER NOT NULL,
+            class_id INTEGER,
+            type VARCHAR(12),
+            title TEXT,
+            content TEXT,
+            document TSVECTOR GENERATED ALWAYS AS (
+                setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('simple', coalesce(content, '')), 'B')
+            ) STORED
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_search_index_document ON search_index USING GIN (document)"
+    ],
+    "mysql": [
+        """CREATE TABLE IF NOT EXISTS search_index (
+            doc_id BIGINT PRIMARY KEY,
+            kind VARCHAR(4) NOT NULL,
+            ref_id INTEGER NOT NULL,
+            class_id INTEGER,
+            type VARCHAR(12),
+            title VARCHAR(60),
+            content TEXT,
+            FULLTEXT KEY ix_search_index_text (title, content)
+        )"""
+    ]
+}
+
+def _dialect(connection):
+    dialect = connection.dialect.name
+    return "mysql" if dialect == "mariadb" else dialect
+
+def create_index(connection):
+    for statement in SCHEMA[_dialect(connection)]:
+        connection.execute(text(statement))
+
+def drop_index(connection):
+    connection.execute(text("DROP TABLE IF EXISTS search_index"))
+
+def doc_id(kind, ref_id):
+    return ref_id * 2 + KINDS[kind]
+
+"""
+! Keeps the index in sync, called in the same transaction that changes the row
+"""
+def index(connection, documents):
+    if not documents:
+        return
+    rows = [dict(document, doc_id=doc_id(document["kind"], document["ref_id"])) for document in documents]
+    remove(connection, [row["doc_id"] for row in rows])
+    if _dialect(connection) == "sqlite":
+        connection.execute(text(
+            "INSERT INTO search_index (rowid, title, content, kind, ref_id, class_id, type) "
+            "VALUES (:doc_id, :title, :content, :kind, :ref_id, :class_id, :type)"
+        ), rows)
+    else:
+        connection.execute(text(
+            "INSERT INTO search_index (doc_id, title, content, kind, ref_id, class_id, type) "
+            "VALUES (:doc_id, :title, :content, :kind, :ref_id, :class_id, :type)"
+        ), rows)
+
+def remove(connection, doc_ids):
+    if not doc_ids:
+        return
+    key = "rowid" if _dialect(connection) == "sqlite" else "doc_id"
+    connection.execute(text(f"DELETE FROM search_index WHERE {key} = :doc_id"), [{"doc_id": id} for id in doc_ids])
+
+"""
+! Ranked search, returns [(kind, ref_id, rank)] best match first
+? Every word of the query has to match. class_id, type and kind narrow it down
+"""
+def search(connection, query, class_id=None, type=None, kind=None, limit=20, offset=0):
+    statement = search_statement(connection, query, class_id, type, kind, limit, offset)
+    if statement is None:
+        return []
+    return [tuple(row) for row in connection.execute(statement)]
+
+# The SQL of search, with its parameters bound (None if the query has no words)
+def search_statement(connection, query, class_id=None, type=None, kind=None, limit=20, offset=0):
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+
+    dialect = _dialect(connection)
+    params = {"class_id": class_id, "type": type, "kind": kind, "limit": limit, "offset": offset}
+    filters = "".join(
+        f" AND {column} = :{column}" for column in ("class_id", "type", "kind") if params[column] is not None
+    )
+
+    if dialect == "sqlite":
+        params["query"] = " ".join('"' + word + '"' for word in words)
+        sql = ("SELECT kind, ref_id, -bm25(search_index, 4.0, 1.0) AS rank FROM search_index "
+               f"WHERE search_index MATCH :query{filters} ORDER BY bm25(search_index, 4.0, 1.0) "
+               "LIMIT :limit OFFSET :offset")
+    elif dialect == "postgresql":
+        params["query"] = " & ".join(words)
+        sql = ("SELECT kind, ref_id, ts_rank(document, to_tsquery('simple', :query)) AS rank FROM search_index "
+               f"WHERE document @@ to_tsquery('simple', :query){filters} ORDER BY rank DESC "
+               "LIMIT :limit OFFSET :offset")
+    else:
+        params["query"] = " ".join("+" + word for word in words)
+        sql = ("SELECT kind, ref_id, MATCH (title, content) AGAINST (:query IN BOOLEAN MODE) AS rank "
+               f"FROM search_index WHERE MATCH (title, content) AGAINST (:query IN BOOLEAN MODE){filters} "
+               "ORDER BY rank DESC LIMIT :limit OFFSET :offset")
+
+    return text(sql).bindparams(**{name: value for name, value in params.items() if f":{name}" in sql})
+
+"""
+! Benchmark of the index on a synthetic corpus
+? Builds a deterministic corpus of `rows` Colls in a scratch database (a temporary
+? SQLite file unless another URL is given) and times `queries` random searches
+"""
+BENCHMARK_WORDS = [f"{stem}{n}" for stem in ("calc", "alg", "phys", "chem", "hist", "law", "bio", "econ") for n in range(250)]
+
+def benchmark(rows, queries, url=None, batch_size=10000, seed=42):
+    rng = random.Random(seed)
+    scratch = None
+    if url is None:
+        descriptor, scratch = tempfile.mkstemp(suffix=".db")
+        os.close(descriptor)
+        url = f"sqlite:///{scratch}"
+    engine = create_engine(url)
+
+    with engine.begin() as connection:
+        drop_index(connection)
+        create_index(connection)
+
+    started = time.perf_counter()
+    for first in range(0, rows, batch_size):
+        documents = [{
+            "kind": "coll",
+            "ref_id": id,
+            "class_id": rng.randrange(1, 500),
+            "type": rng.choice(("doubt", "note", "exam")),
+            "title": " ".join(rng.choices(BENCHMARK_WORDS, k=4)),
+            "content": " ".join(rng.choices(BENCHMARK_WORDS, k=40))
+        } for id in range(first + 1, min(first + batch_size, rows) + 1)]
+        with engine.begin() as connection:
+            index(connection, documents)
+    build = time.perf_counter() - started
+
+    timings = []
+    with engine.connect() as connection:
+        for _ in range(queries):
+            words = " ".join(rng.choices(BENCHMARK_WORDS, k=rng.choice((1, 2))))
+            class_id = rng.randrange(1, 500) if rng.random() < 0.5 else None
+            started = time.perf_counter()
+            search(connection, words, class_id=class_id)
+            timings.append(time.perf_counter() - started)
+
+    database = engine.url.render_as_string(hide_password=True)
+    engine.dispose()
+    if scratch is not None:
+        os.remove(scratch)
+
+    timings.sort()
+    return {
+        "database": database,
+        "rows": rows,
+        "build_seconds": round(build, 2),
+        "queries": queries,
+        "p50_ms": round(timings[len(timings) // 2] * 1000, 2),
+        "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000, 2)
+    }
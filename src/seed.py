@@ -0,0 +1,183 @@
+"""
+This module fills the database with a deterministic synthetic dataset, to have
+something realistic to measure: the same scale and seed always give the same rows
+"""
+import random
+from datetime import datetime, timedelta
+import passwords
+import search
+from models import db, FacultyMembers, ClassStudents, FavoriteColls, VersionCounter, User, Message, Conversation, Network, Tag, College, Faculty, Class, File, Coll, Comment, LikedColls, Timeline
+
+"""
+! Shape of the dataset at scale 1, everything but the catalog grows linearly with it
+"""
+COLLEGES = 2
+FACULTIES_PER_COLLEGE = 4
+CLASSES_PER_FACULTY = 8
+CLASSES_PER_USER = 6
+USERS = 500
+COLLS = 5000
+FILES = 1000
+MESSAGES = 5000
+TAGS_PER_USER = 3
+NETWORKS_PER_USER = 2
+MAX_LIKES_PER_COLL = 8
+MAX_FAVS_PER_COLL = 3
+MAX_COMMENTS_PER_COLL = 4
+
+# Every user logs in with this password
+PASSWORD = "password"
+TYPES = ("doubt", "note", "exam")
+WORDS = ["integral", "matrix", "vector", "limit", "proof", "lemma", "theorem", "derivative", "series", "graph",
+         "entropy", "enzyme", "protein", "cell", "atom", "molecule", "reaction", "market", "supply", "demand",
+         "contract", "statute", "court", "treaty", "empire", "revolution", "algorithm", "compiler", "kernel", "network"]
+START = datetime(2026, 1, 1)
+BATCH_SIZE = 5000
+
+def _text(rng, words):
+    return " ".join(rng.choices(WORDS, k=words))
+
+def _insert(model, rows):
+    for first in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(db.insert(model), rows[first:first + BATCH_SIZE])
+
+"""
+! Generates the dataset into the current database, which must be empty
+? Rows get explicit ids (1..n), so they can be referenced without reading them back.
+? The denormalized data (like counters, conversations, search index) is filled in too
+"""
+def generate(scale=1, seed=42):
+    rng = random.Random(seed)
+    hashed = passwords.hash_password(PASSWORD)
+
+    """ Catalog """
+    colleges = [{"id": id, "name": f"College {id}"} for id in range(1, COLLEGES + 1)]
+    faculties = [
+        {"id": (college["id"] - 1) * FACULTIES_PER_COLLEGE + n, "name": f"Faculty {n} of {college['name']}", "college_id": college["id"]}
+        for college in colleges for n in range(1, FACULTIES_PER_COLLEGE + 1)
+    ]
+    classes = [
+        {"id": (faculty["id"] - 1) * CLASSES_PER_FACULTY + n, "name": f"Class {n} of {faculty['name']}"[:60], "faculty_id": faculty["id"]}
+        for faculty in faculties for n in range(1, CLASSES_PER_FACULTY + 1)
+    ]
+    classes_of_faculty = {faculty["id"]: [c["id"] for c in classes if c["faculty_id"] == faculty["id"]] for faculty in faculties}
+
+    """ Users, each in one faculty and some of its classes """
+    users, members, students, classes_of_user = [], [], [], {}
+    for id in range(1, USERS * scale + 1):
+        faculty = rng.choice(faculties)["id"]
+        users.append({
+            "id": id,
+            "username": f"user{id}",
+            "email": f"user{id}@ucoll.es",
+            "password": hashed,
+            "registered": (START + timedelta(days=rng.randrange(180))).date(),
+            "name": f"Name{id}",
+            "surname": f"Surname{id}",
+            "description": _text(rng, 8)
+        })
+        members.append({"user_id": id, "faculty_id": faculty})
+        classes_of_user[id] = rng.sample(classes_of_faculty[faculty], CLASSES_PER_USER)
+        students += [{"user_id": id, "class_id": class_id} for class_id in classes_of_user[id]]
+    user_ids = [user["id"] for user in users]
+
+    """ Colls with their likes, favs and comments """
+    colls, likes, favs, comments = [], [], [], []
+    for id in range(1, COLLS * scale + 1):
+        sender = rng.choice(user_ids)
+        voters = rng.sample(user_ids, rng.randint(0, MAX_LIKES_PER_COLL))
+        votes = [{"user_id": voter, "coll_id": id, "is_like": rng.random() < 0.8} for voter in voters]
+        timestamp = START + timedelta(seconds=rng.randrange(180 * 24 * 3600))
+        colls.append({
+            "id": id,
+            "title": _text(rng, 4).capitalize(),
+            "content": _text(rng, 40),
+            "sender_id": sender,
+            "class_id": rng.choice(classes_of_user[sender]),
+            "type": rng.choice(TYPES),
+            "timestamp": timestamp,
+            "like_count": sum(vote["is_like"] for vote in votes),
+            "dislike_count": sum(not vote["is_like"] for vote in votes)
+        })
+        likes += votes
+        favs += [{"user_id": user, "coll_id": id} for user in rng.sample(user_ids, rng.randint(0, MAX_FAVS_PER_COLL))]
+        comments += [{
+            "content": _text(rng, 12),
+            "commenter_id": rng.choice(user_ids),
+            "coll_id": id,
+            "timestamp": timestamp + timedelta(minutes=rng.randrange(1, 600))
+        } for _ in range(rng.randint(0, MAX_COMMENTS_PER_COLL))]
+
+    files = []
+    for id in range(1, FILES * scale + 1):
+        uploader = rng.choice(user_ids)
+        files.append({
+            "id": id,
+            "title": _text(rng, 3).capitalize(),
+            "content": f"https://files.ucoll.es/{id}.pdf",
+            "class_id": rng.choice(classes_of_user[uploader]),
+            "uploader_id": uploader,
+            "type": rng.choice(TYPES),
+            "timestamp": START + timedelta(seconds=rng.randrange(180 * 24 * 3600))
+        })
+
+    """ Messages (user 2, the one the endpoints act as for now, always has some) and the conversations they make """
+    messages, others = [], [user for user in user_ids if user != 2]
+    for id in range(1, MESSAGES * scale + 1):
+        if id % 20 == 0:
+            sender, receiver = rng.choice(others), 2
+        elif id % 10 == 0:
+            sender, receiver = 2, rng.choice(others)
+        else:
+            sender, receiver = rng.sample(user_ids, 2)
+        messages.append({
+            "id": id,
+            "sender": sender,
+            "receiver": receiver,
+            "content": _text(rng, 10),
+            "timestamp": START + timedelta(seconds=id * 60)
+        })
+    conversations = {}
+    for message in messages:
+        for owner, counterpart, received in ((message["sender"], message["receiver"], False), (message["receiver"], message["sender"], True)):
+            conversation = conversations.setdefault((owner, counterpart), {"owner_id": owner, "counterpart_id": counterpart, "unread_count": 0})
+            conversation["last_message_id"] = message["id"]
+            conversation["updated_at"] = message["timestamp"]
+            if received and rng.random() < 0.3:
+                conversation["unread_count"] += 1
+
+    tags = [{"name": rng.choice(WORDS)[:20], "user_id": user} for user in user_ids for _ in range(TAGS_PER_USER)]
+    networks = [
+        {"owner": user, "name": name, "link": f"{name.lower()}.com/user{user}"[:30]}
+        for user in user_ids for name in rng.sample(["Twitter", "GitHub", "LinkedIn", "Instagram"], NETWORKS_PER_USER)
+    ]
+
+    for model, rows in (
+        (College, colleges), (Faculty, faculties), (Class, classes), (User, users),
+        (FacultyMembers, members), (ClassStudents, students),
+        (Coll, colls), (LikedColls, likes), (FavoriteColls, favs), (Comment, comments), (File, files),
+        (Message, messages), (Conversation, list(conversations.values())),
+        (Tag, tags), (Network, networks)
+    ):
+        _insert(model, rows)
+
+    connection = db.session.connection()
+    search.index(connection, [dict(coll, kind="coll", ref_id=coll["id"]) for coll in colls])
+    search.index(connection, [dict(file, kind="file", ref_id=file["id"], content="") for file in files])
+    timeline = Timeline.fill()
+    VersionCounter.bump("catalog")
+
+    # The ids were given explicitly, so Postgres' sequences have to be moved past them
+    if connection.dialect.name == "postgresql":
+        for table in ("college", "faculty", "class", "user", "coll", "comment", "file", "message", "tag", "network"):
+            connection.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), coalesce(max(id), 1)) FROM \"{table}\""
+            ))
+
+    db.session.commit()
+    return {
+        "colleges": len(colleges), "faculties": len(faculties), "classes": len(classes), "users": len(users),
+        "colls": len(colls), "likes": len(likes), "favs": len(favs), "comments": len(comments), "files": len(files),
+        "messages": len(messages), "conversations": len(conversations), "tags": len(tags), "networks": len(networks),
+        "timeline": timeline
+    }
@@ -0,0 +1,125 @@
+"""
+This module stores the uploaded Files on disk by the SHA-256 of their content,
+so the same slides uploaded by 40 students are stored once. Uploads are hashed
+and written as they arrive, and downloads are streamed with Range support or
+handed off to the web server (X-Sendfile / X-Accel-Redirect)
+"""
+import glob
+import hashlib
+import os
+import tempfile
+import time
+from urllib.parse import quote
+from flask import Response, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Point it to a persistent disk in production, /tmp is wiped on restarts
+STORAGE_DIR = os.environ.get("STORAGE_DIR", "/tmp/ucoll-files")
+MAX_SIZE = int(os.environ.get("STORAGE_MAX_SIZE", 50 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+# Downloads are cached this long by the browsers (a File's content never changes)
+MAX_AGE = int(os.environ.get("STORAGE_MAX_AGE", 86400))
+# "" (the app sends the bytes), "x-sendfile" (Apache, lighttpd) or "x-accel-redirect" (nginx)
+SENDFILE = os.environ.get("STORAGE_SENDFILE", "").lower()
+# The nginx internal location that serves STORAGE_DIR, see docs/FILES.md
+ACCEL_PREFIX = os.environ.get("STORAGE_ACCEL_PREFIX", "/protected-files/")
+# Blobs used in the last GRACE seconds are never removed, an upload may be about to reference them
+GRACE = int(os.environ.get("STORAGE_GC_GRACE", 600))
+
+# Paths inside STORAGE_DIR of a blob and of what is derived from it (previews...)
+def object_name(digest):
+    return os.path.join("objects", digest[:2], digest[2:])
+
+def derived_name(digest, name):
+    return os.path.join("derived", digest[:2], f"{digest[2:]}-{name}")
+
+def path(digest):
+    return os.path.join(STORAGE_DIR, object_name(digest))
+
+def derived_path(digest, name):
+    return os.path.join(STORAGE_DIR, derived_name(digest, name))
+
+"""
+! Writes a stream to the store, returns (sha256, size)
+? The stream is read CHUNK_SIZE bytes at a time into a temporary file, hashed
+? on the way, and moved to its place once complete (atomic, so a blob is either
+? whole or missing). Content that is already stored is not written twice, and
+? empty content is not stored at all
+"""
+def save(stream, max_size=MAX_SIZE):
+    directory = os.path.join(STORAGE_DIR, "tmp")
+    os.makedirs(directory, exist_ok=True)
+    sha256, size = hashlib.sha256(), 0
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as temporary:
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise RequestEntityTooLarge(f"Files can be up to {max_size} bytes")
+                sha256.update(chunk)
+                temporary.write(chunk)
+            temporary.flush()
+            os.fsync(temporary.fileno())
+        except BaseException:
+            os.remove(temporary.name)
+            raise
+
+    digest = sha256.hexdigest()
+    target = path(digest)
+    if size == 0:
+        os.remove(temporary.name)
+    elif os.path.exists(target):
+        os.remove(temporary.name)
+        # Keeps a blob that is waiting to be removed alive (see remove)
+        os.utime(target)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(temporary.name, target)
+    return digest, size
+
+# Stores something derived from a blob (a preview...), atomically like the blobs
+def save_derived(digest, name, data):
+    target = derived_path(digest, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(target), delete=False) as temporary:
+        temporary.write(data)
+    os.replace(temporary.name, target)
+
+# Removes a blob nothing references anymore, and what was derived from it, unless
+# it was used in the last GRACE seconds. Returns whether it was removed
+def remove(digest):
+    try:
+        if time.time() - os.path.getmtime(path(digest)) < GRACE:
+            return False
+        os.remove(path(digest))
+    except FileNotFoundError:
+        return False
+    for derived in glob.glob(derived_path(digest, "*")):
+        os.remove(derived)
+    return True
+
+"""
+! Response that sends a stored file (object_name or derived_name)
+? send_file answers Range requests (206) and conditional ones (304) on its
+? own. With X-Sendfile it only sets the header (USE_X_SENDFILE, set in
+? main.py) and the web server reads the file; with X-Accel-Redirect nginx
+? does, Range included. immutable is for URLs whose content never changes
+"""
+def send(name, mimetype, download_name, etag, max_age=MAX_AGE, immutable=False):
+    if SENDFILE == "x-accel-redirect":
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = ACCEL_PREFIX + name.replace(os.sep, "/")
+        response.headers["Content-Disposition"] = f"inline; filename*=UTF-8''{quote(download_name)}"
+        response.set_etag(etag)
+    else:
+        response = send_file(
+            os.path.join(STORAGE_DIR, name), mimetype=mimetype, download_name=download_name,
+            conditional=True, etag=etag, max_age=max_age
+        )
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = immutable
+    return response
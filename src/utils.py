@@ -1,4 +1,10 @@
-from flask import jsonify, url_for
+import base64
+import json
+from datetime import datetime
+from itertools import islice
+from operator import itemgetter
+from flask import Response, current_app, jsonify, stream_with_context, url_for
+from sqlalchemy import DateTime, and_, or_
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +21,102 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+"""
+! Keyset (cursor) pagination helpers
+? Pages are ordered newest first by the given columns (e.g. timestamp, id),
+? and the cursor holds the values of the last row sent, so fetching page N
+? is an index range scan just like page 1
+"""
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Rows a batch endpoint (/colls/batch...) takes in one call
+MAX_BATCH_SIZE = 500
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(columns):
+            raise ValueError(cursor)
+        return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                for value, column in zip(values, columns)]
+    except (ValueError, TypeError):
+        raise APIException("Invalid pagination cursor", 400)
+
+# Builds "(c1, c2, ...) < (v1, v2, ...)" in a form every database can use an index for
+def _before(columns, values):
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column < value
+    return or_(column < value, and_(column == value, _before(columns[1:], values[1:])))
+
+# The query of a page: the rows after the cursor in index order, one more than
+# the page holds to tell whether there is a next one
+def keyset_query(query, columns, after=None, limit=None):
+    limit = min(max(limit or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    if after:
+        query = query.filter(_before(columns, decode_cursor(after, columns)))
+    return query.order_by(*[column.desc() for column in columns]).limit(limit + 1)
+
+def keyset_page(query, columns, after=None, limit=None):
+    limit = min(max(limit or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    rows = keyset_query(query, columns, after, limit).all()
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column in columns])
+
+# Pages the rows of several queries as if they were one, e.g. the two directions of
+# a message thread, each a range of an index. sources are (query, columns) pairs,
+# with the columns of every query in the same order. Each query sends a page and
+# the newest `limit` rows of them all are kept
+def keyset_merge(sources, after=None, limit=None):
+    limit = min(max(limit or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    rows, more = [], False
+    for query, columns in sources:
+        page, cursor = keyset_page(query, columns, after, limit)
+        rows += [(tuple(getattr(row, column.key) for column in columns), row) for row in page]
+        more = more or cursor is not None
+    rows.sort(key=itemgetter(0), reverse=True)
+    if len(rows) > limit:
+        rows, more = rows[:limit], True
+    return [row for _, row in rows], encode_cursor(rows[-1][0]) if more else None
+
+# Returns a page as a JSON list, the cursor for the next one goes in a header
+def jsonify_page(items, cursor):
+    response = jsonify(items)
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = cursor
+    return response
+
+"""
+! Streams a query as a JSON array
+? Rows are fetched batch_size at a time (yield_per) and every batch is written
+? out before the next one is loaded, so memory is bounded by the batch size and
+? not by the number of rows. serialize_batch turns a list of rows into a list of
+? dicts, so per-batch lookups (e.g. Coll.serialize_page) still work
+"""
+STREAM_BATCH_SIZE = 200
+
+def stream_json(query, serialize_batch, batch_size=STREAM_BATCH_SIZE):
+    def generate():
+        rows = iter(query.yield_per(batch_size))
+        separator = "["
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            items = [current_app.json.dumps(item) for item in serialize_batch(batch)]
+            yield separator + ",".join(items)
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
@@ -0,0 +1,68 @@
+"""
+Fixtures of the test suite. The app runs against a SQLite file seeded once with
+the scale 1 dataset (see seed.py) and copied afresh for every test. Foreign keys
+are enforced, like they are on MySQL and Postgres
+"""
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+DIRECTORY = tempfile.mkdtemp(prefix="ucoll-tests-")
+DATABASE = os.path.join(DIRECTORY, "test.db")
+TEMPLATE = os.path.join(DIRECTORY, "template.db")
+os.environ["DB_CONNECTION_STRING"] = f"sqlite:///{DATABASE}"
+os.environ["STORAGE_DIR"] = os.path.join(DIRECTORY, "files")
+os.environ["EVENTS_BACKEND"] = "local"
+os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from main import app as flask_app
+from cache import catalog_cache, identity_cache
+from models import db
+import seed
+
+@event.listens_for(Engine, "connect")
+def _enforce_foreign_keys(connection, record):
+    if type(connection).__module__ == "sqlite3":
+        connection.execute("PRAGMA foreign_keys = ON")
+
+def _close_connections():
+    db.session.remove()
+    db.engine.dispose()
+
+@pytest.fixture(scope="session")
+def template():
+    with flask_app.app_context():
+        db.create_all()
+        seed.generate(1)
+        _close_connections()
+    shutil.copy(DATABASE, TEMPLATE)
+    yield TEMPLATE
+    shutil.rmtree(DIRECTORY, ignore_errors=True)
+
+@pytest.fixture
+def app(template):
+    shutil.copy(template, DATABASE)
+    catalog_cache.clear()
+    identity_cache.clear()
+    with flask_app.app_context():
+        yield flask_app
+        _close_connections()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# The SQL statements the app sends while the fixture is active
+@pytest.fixture
+def queries(app):
+    statements = []
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(db.engine, "before_cursor_execute", record)
@@ -0,0 +1,93 @@
+import pytest
+import plans
+import models
+from models import db, Class, ClassStudents, Timeline, User
+from utils import MAX_BATCH_SIZE
+
+@pytest.fixture
+def resizes(monkeypatch):
+    changes = []
+    resize = Timeline.resize
+    def record(class_changes):
+        changes.append(class_changes)
+        return resize(class_changes)
+    monkeypatch.setattr(Timeline, "resize", record)
+    return changes
+
+def _other_class(user):
+    return db.session.scalar(db.select(Class.id).where(~Class.id.in_(
+        db.select(ClassStudents.c.class_id).where(ClassStudents.c.user_id == user)
+    )).order_by(Class.id))
+
+# Joining twice counts the student once
+def test_joining_twice(client, resizes):
+    id = _other_class(2)
+    before = Class.student_counts([id]).get(id, 0)
+    for _ in range(2):
+        assert client.post(f"/classes/{id}").status_code == 302
+    assert Class.student_counts([id])[id] == before + 1
+    assert resizes == [{id: 1}]
+
+# Enrolling counts only the students that were not in the Class yet
+def test_enrolling_counts_the_new_students(client, resizes):
+    id = _other_class(2)
+    enrolled = {row.user_id for row in db.session.execute(
+        db.select(ClassStudents.c.user_id).where(ClassStudents.c.class_id == id)
+    )}
+    new = db.session.scalars(db.select(User.id).where(~User.id.in_(enrolled)).order_by(User.id).limit(3)).all()
+    students = new + sorted(enrolled)[:2] + new[:1]
+
+    response = client.post(f"/classes/{id}/students", json={"students": students})
+    assert response.json == {"enrolled": len(new)}
+    assert resizes == [{id: len(new)}]
+
+    response = client.post(f"/classes/{id}/students", json={"students": students})
+    assert response.json == {"enrolled": 0}
+    assert resizes == [{id: len(new)}]
+
+# Pages of a roster hold every student once, highest id first
+def test_roster_pages(client):
+    id = db.session.scalar(db.select(ClassStudents.c.class_id).order_by(ClassStudents.c.class_id))
+    expected = sorted(db.session.scalars(
+        db.select(ClassStudents.c.user_id).where(ClassStudents.c.class_id == id)
+    ), reverse=True)
+
+    ids, cursor = [], None
+    while True:
+        response = client.get(f"/classes/{id}/students?limit=7" + (f"&after={cursor}" if cursor else ""))
+        assert response.status_code == 200
+        ids += [student["id"] for student in response.json]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert ids == expected
+
+# A roster page is a range of the (class_id, user_id) index, the Class is never sorted
+def test_roster_pages_need_no_sort(app):
+    page = Class.roster_query(1).filter(Class.roster_key() < 1000).order_by(Class.roster_key().desc()).limit(21)
+    plan, scans = plans.explain(db.session.connection(), page)
+    assert not scans
+    assert not any("TEMP B-TREE" in line for line in plan), plan
+
+# Enrolments are batches like the others, up to MAX_BATCH_SIZE students
+@pytest.mark.parametrize("students", [0, MAX_BATCH_SIZE + 1])
+def test_enrolling_too_many(client, resizes, students):
+    response = client.post(f"/classes/{_other_class(2)}/students", json={"students": list(range(1, students + 1))})
+    assert response.status_code == 400
+    assert resizes == []
+
+# A cached catalog response costs one primary key read of the "catalog" VersionCounter
+def test_catalog_hits(client, queries):
+    body = client.get("/classes/1").get_data()
+    queries.clear()
+    assert client.get("/classes/1").get_data() == body
+    assert len(queries) == 1 and "version_counter" in queries[0]
+
+# A change committed through another worker, which doesn't clear this worker's
+# cache, is seen on the next request all the same
+def test_catalog_changes_elsewhere(client, monkeypatch):
+    assert client.get("/classes/1").json["name"] != "renamed"
+    monkeypatch.setattr(models.catalog_cache, "clear", lambda: None)
+    db.session.get(Class, 1).name = "renamed"
+    db.session.commit()
+    assert client.get("/classes/1").json["name"] == "renamed"
@@ -0,0 +1,132 @@
+import threading
+import tracemalloc
+import pytest
+from models import db, Class, Coll, LikedColls, User
+from utils import stream_json
+
+def _count_queries(client, queries, url):
+    queries.clear()
+    response = client.get(url)
+    assert response.status_code == 200
+    return len(queries), response.json
+
+# A page of the feed costs the same number of queries however many Colls it holds
+@pytest.mark.parametrize("view", ["", "&view=counts"])
+def test_feed_queries_do_not_grow_with_the_page(client, queries, view):
+    client.get("/colls?limit=1")
+    few, small = _count_queries(client, queries, f"/colls?limit=5{view}")
+    many, large = _count_queries(client, queries, f"/colls?limit=100{view}")
+    assert len(small) == 5 and len(large) == 100
+    assert many == few
+    assert large[:5] == small
+
+def _hammer(app, work, threads=8):
+    errors = []
+    def run(i):
+        try:
+            with app.app_context():
+                work(i)
+        except Exception as error:
+            errors.append(error)
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not errors, errors
+
+def _votes(coll):
+    db.session.expire_all()
+    likes = LikedColls.query.filter_by(coll_id=coll, is_like=True).count()
+    dislikes = LikedColls.query.filter_by(coll_id=coll, is_like=False).count()
+    return likes, dislikes
+
+# Users voting on one Coll at once leave one vote each, and counters that add them up
+def test_concurrent_votes(app):
+    coll = db.session.scalar(db.select(Coll.id).order_by(Coll.id))
+    voters = db.session.scalars(db.select(User.id).where(~User.id.in_(
+        db.select(LikedColls.user_id).where(LikedColls.coll_id == coll)
+    )).order_by(User.id).limit(16)).all()
+    before = _votes(coll)
+    db.session.commit()
+
+    _hammer(app, lambda i: [LikedColls.vote(user, coll, user % 2 == 0) for user in voters[i::8] for _ in range(3)])
+
+    likes, dislikes = _votes(coll)
+    assert (likes - before[0], dislikes - before[1]) == (
+        sum(user % 2 == 0 for user in voters), sum(user % 2 == 1 for user in voters)
+    )
+    counted = db.session.get(Coll, coll)
+    assert (counted.like_count, counted.dislike_count) == (likes, dislikes)
+
+# The same clicks repeated from many threads are answered with the same state
+def test_concurrent_clicks_are_idempotent(app):
+    coll = db.session.scalar(db.select(Coll.id).order_by(Coll.id.desc()))
+    db.session.commit()
+
+    def click(i):
+        client = app.test_client()
+        for _ in range(5):
+            assert client.put(f"/colls/{coll}/like", json={"like": True}).json is True
+            assert client.put(f"/colls/{coll}/fav").json is True
+
+    _hammer(app, click)
+    db.session.expire_all()
+    assert LikedColls.query.filter_by(coll_id=coll, user_id=2).one().is_like is True
+    assert Coll.is_faved(coll, 2)
+    likes, dislikes = _votes(coll)
+    counted = db.session.get(Coll, coll)
+    assert (counted.like_count, counted.dislike_count) == (likes, dislikes)
+
+def _streamed(app, rows):
+    query = Coll.feed_query(likes=False).order_by(Coll.timestamp.desc(), Coll.id.desc()).limit(rows)
+    with app.test_request_context():
+        tracemalloc.start()
+        try:
+            response = stream_json(query, lambda colls: Coll.serialize_page(colls, 2, True))
+            size = sum(len(chunk) for chunk in response.response)
+            return size, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+# Streaming holds one batch at a time, five times the Colls take no more memory
+def test_streaming_memory_is_bounded(app):
+    _streamed(app, 1000)
+    small, small_peak = _streamed(app, 1000)
+    large, large_peak = _streamed(app, 5000)
+    assert large > 4 * small
+    assert large_peak < 1.5 * small_peak, (small_peak, large_peak)
+
+# The streamed feed is the whole feed, as one JSON array
+def test_streamed_feed(client):
+    response = client.get("/colls?stream=true&view=counts")
+    assert response.status_code == 200
+    assert len(response.json) == Coll.query.count()
+    assert response.json[:20] == client.get("/colls?view=counts").json
+
+def _etag(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return response.headers["ETag"]
+
+# A Coll's ETag follows what it renders: joining a Class leaves it alone,
+# renaming its Class or a Faculty of its sender doesn't
+def test_coll_etags(client):
+    coll = db.session.get(Coll, db.session.scalar(db.select(Coll.id).where(Coll.sender_id.isnot(None)).order_by(Coll.id)))
+    url = f"/colls/{coll.id}"
+    etag = _etag(client, url)
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    other = db.session.scalar(db.select(Class.id).where(Class.id != coll.class_id).order_by(Class.id))
+    Class.enroll(other, [coll.sender_id])
+    db.session.commit()
+    assert _etag(client, url) == etag
+
+    coll._class.name = "renamed"
+    db.session.commit()
+    assert _etag(client, url) != etag
+    etag = _etag(client, url)
+
+    coll.sender.faculties[0].name = "renamed"
+    db.session.commit()
+    assert _etag(client, url) != etag
@@ -0,0 +1,45 @@
+import json
+import pytest
+import events
+from events import EventHub, SocketBackend
+
+@pytest.fixture
+def socket_hub(tmp_path):
+    hub = EventHub(SocketBackend(str(tmp_path)))
+    subscription = hub.subscribe(["class:1"])
+    yield hub, subscription
+    hub.backend.receiver.close()
+
+# A datagram that can't be decoded is skipped, the events after it still arrive
+def test_the_listener_survives_a_bad_datagram(socket_hub):
+    hub, subscription = socket_hub
+    hub.backend.sender.sendto(b"not json", hub.backend.path)
+    hub.publish("class:1", "coll", {"id": 1})
+    assert subscription.get(timeout=2) == ("coll", {"id": 1})
+
+# An event too big for a datagram is cut down to its id instead of failing the publish
+def test_oversized_events_are_cut_down_to_their_id(socket_hub):
+    hub, subscription = socket_hub
+    hub.publish("class:1", "coll", {"id": 5, "content": "x" * 200 * 1024})
+    assert subscription.get(timeout=2) == ("coll", {"id": 5, "truncated": True})
+
+# Delivery errors are logged, the request that published the event already committed
+def test_send_errors_do_not_raise(socket_hub, monkeypatch):
+    hub, _ = socket_hub
+    def fail(payload, path):
+        raise OSError(90, "Message too long")
+    monkeypatch.setattr(hub.backend, "sender", type("Sender", (), {"sendto": staticmethod(fail)})())
+    hub.backend.send(json.dumps(["class:1", "coll", {"id": 1}]).encode())
+
+# The message events name both users
+def test_message_events_carry_the_usernames(client):
+    subscription = events.hub.subscribe(["user:7"])
+    try:
+        response = client.post("/messages", data={"receiver": "7", "content": "Hello"})
+        assert response.status_code == 302
+        event, data = subscription.get(timeout=2)
+    finally:
+        events.hub.unsubscribe(subscription)
+    assert event == "message"
+    assert data["receiver"] == "user7"
+    assert data["sender"] is not None
@@ -0,0 +1,48 @@
+import os
+import pytest
+import jobs
+import storage
+from models import db, Class, File, Job
+
+def _blobs():
+    return sorted(name for _, _, names in os.walk(os.path.join(storage.STORAGE_DIR, "objects")) for name in names)
+
+def _upload(client, data, **fields):
+    fields = {"title": "Slides", "class": 1, "type": "notes", **fields}
+    return client.post("/files", query_string=fields, data=data, content_type="application/pdf")
+
+# An upload is stored by its content and described by a File
+def test_upload(client):
+    response = _upload(client, b"%PDF-1.4 slides")
+    assert response.status_code == 201
+    assert File.query.get(response.json["id"]).size == len(b"%PDF-1.4 slides")
+    assert os.path.exists(storage.path(File.query.get(response.json["id"]).sha256))
+
+# Uploads that are refused leave nothing in the store
+def test_empty_upload(client):
+    before = _blobs()
+    assert _upload(client, b"").status_code == 400
+    assert _blobs() == before
+
+@pytest.mark.parametrize("fields", [{"class": 10 ** 6}, {"type": "x" * 13}, {"title": ""}])
+def test_invalid_upload(client, fields):
+    before = _blobs()
+    assert _upload(client, b"orphan?", **fields).status_code == 400
+    assert _blobs() == before
+
+# When the File can't be created its blob is collected once nothing can be using it
+def test_failed_upload(app, client, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("database is gone")
+    monkeypatch.setattr(File, "create", fail)
+    monkeypatch.setattr(storage, "GRACE", 0)
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+    try:
+        assert _upload(client, b"never referenced").status_code == 500
+    finally:
+        app.config["PROPAGATE_EXCEPTIONS"] = None
+
+    job = Job.query.filter_by(name="delete_blob").one()
+    assert os.path.exists(storage.path(job.payload["sha256"]))
+    jobs.delete_blob(**job.payload)
+    assert not os.path.exists(storage.path(job.payload["sha256"]))
@@ -0,0 +1,71 @@
+from datetime import datetime
+import plans
+from models import db, Conversation, Message
+
+def _conversation(owner, counterpart):
+    return db.session.get(Conversation, (owner, counterpart))
+
+def _latest(user, counterpart):
+    return Message.query.filter(db.or_(
+        db.and_(Message.sender == user, Message.receiver == counterpart),
+        db.and_(Message.sender == counterpart, Message.receiver == user)
+    )).order_by(Message.timestamp.desc(), Message.id.desc()).first()
+
+# The conversation references its last message, deleting that message must move it back
+def test_deleting_the_last_message_of_a_conversation(client):
+    first = Message.create(2, 7, "first")
+    last = Message.create(7, 2, "last")
+    assert _conversation(2, 7).last_message_id == last.id
+
+    response = client.post(f"/messages/{last.id}/delete")
+    assert response.status_code == 302
+
+    db.session.expire_all()
+    assert db.session.get(Message, last.id) is None
+    assert _latest(2, 7).id == first.id
+    for owner, counterpart in ((2, 7), (7, 2)):
+        assert _conversation(owner, counterpart).last_message_id == first.id
+
+# With no messages left the conversation goes away on both sides
+def test_deleting_every_message_of_a_conversation(client):
+    thread = Message.query.filter(db.or_(
+        db.and_(Message.sender == 2, Message.receiver == 7),
+        db.and_(Message.sender == 7, Message.receiver == 2)
+    )).all()
+    thread += [Message.create(2, 7, "only")]
+    for message in thread:
+        assert client.post(f"/messages/{message.id}/delete").status_code == 302
+
+    db.session.expire_all()
+    assert _conversation(2, 7) is None
+    assert _conversation(7, 2) is None
+
+# Pages of a thread hold both directions, newest first, without gaps or repeats
+def test_thread_pages(client):
+    for i in range(15):
+        Message.create(2, 7, f"sent {i}") if i % 3 else Message.create(7, 2, f"received {i}")
+    expected = [message.id for message in Message.query.filter(db.or_(
+        db.and_(Message.sender == 2, Message.receiver == 7),
+        db.and_(Message.sender == 7, Message.receiver == 2)
+    )).order_by(Message.timestamp.desc(), Message.id.desc())]
+
+    ids, cursor = [], None
+    while True:
+        response = client.get("/conversations/7?limit=4" + (f"&after={cursor}" if cursor else ""))
+        assert response.status_code == 200
+        ids += [message["id"] for message in response.json]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert ids == expected
+
+# Each direction of a thread is read in the order of its index, the thread is never sorted
+def test_thread_pages_need_no_sort(app):
+    now = datetime.now()
+    for query in Message.thread_queries(2, 7):
+        page = query.filter(db.or_(
+            Message.timestamp < now, db.and_(Message.timestamp == now, Message.id < 1000)
+        )).order_by(Message.timestamp.desc(), Message.id.desc()).limit(21)
+        plan, scans = plans.explain(db.session.connection(), page)
+        assert not scans
+        assert not any("TEMP B-TREE" in line for line in plan), plan
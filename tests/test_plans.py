@@ -0,0 +1,7 @@
+import plans
+from models import db
+
+# Every hot query of the endpoints is answered through an index on the seeded data
+def test_hot_queries_use_indexes(app):
+    scanned = {name: scans for name, plan, scans in plans.check(db.session.connection()) if scans}
+    assert not scanned
@@ -0,0 +1,20 @@
+from models import File
+
+def _search(client, **params):
+    response = client.get("/search", query_string=params)
+    assert response.status_code == 200
+    return response.json
+
+# The Files of a page are loaded with their uploaders and Classes, in one query
+def test_file_hits_are_loaded_in_one_query(client, queries):
+    word = File.query.order_by(File.id).first().title.split()[0]
+    _search(client, q=word, kind="file", limit=2)
+    queries.clear()
+    _search(client, q=word, kind="file", limit=2)
+    few = len(queries)
+
+    queries.clear()
+    hits = _search(client, q=word, kind="file", limit=30)
+    assert len(hits) > 2
+    assert all(hit["item"]["uploader"] and hit["item"]["class"] for hit in hits)
+    assert len(queries) == few
@@ -0,0 +1,43 @@
+import pytest
+import models
+from models import db, Class, ClassStudents, Coll, Faculty, Timeline, User
+
+# A Class right at FANOUT_LIMIT, so one more student takes it over
+@pytest.fixture
+def full_class(app, monkeypatch):
+    id, students = db.session.execute(
+        db.select(ClassStudents.c.class_id, db.func.count()).group_by(ClassStudents.c.class_id).order_by(ClassStudents.c.class_id)
+    ).first()
+    monkeypatch.setattr(models, "FANOUT_LIMIT", students)
+    Timeline.fill(classes=[id])
+    db.session.commit()
+    return id
+
+def _entries(id):
+    return Timeline.query.filter_by(class_id=id).count()
+
+def _expected(id):
+    return Class.student_counts([id])[id] * Coll.query.filter_by(class_id=id).count()
+
+def _register(id):
+    faculty = db.session.scalar(db.select(Faculty.id).order_by(Faculty.id))
+    return User.register("crossing", "crossing@ucoll.es", "password", faculty, [id])
+
+# Registering into a Class at the limit moves it to fan-out on read, the reverse refills it
+def test_registering_crosses_the_limit(full_class):
+    assert _entries(full_class) == _expected(full_class) > 0
+    user = _register(full_class)
+    assert _entries(full_class) == 0
+
+    User.delete(user.id)
+    assert _entries(full_class) == _expected(full_class)
+
+# Same when an update joins or leaves the Class
+def test_updating_crosses_the_limit(full_class):
+    user = _register(full_class)
+    faculty = user.faculties[0].id
+    User.update(user, "crossing", "password", faculty, [])
+    assert _entries(full_class) == _expected(full_class)
+
+    User.update(user, "crossing", "password", faculty, [full_class])
+    assert _entries(full_class) == 0
@@ -0,0 +1,70 @@
+import pytest
+from flask_jwt_extended import create_access_token
+import models
+from models import db, Class, ClassStudents, User
+
+@pytest.fixture
+def token(app):
+    return {"Authorization": f"Bearer {create_access_token(identity='7')}"}
+
+# Changes made by another process (a web worker or a job) don't clear this process's cache
+@pytest.fixture
+def elsewhere(monkeypatch):
+    monkeypatch.setattr(models.identity_cache, "pop", lambda key: None)
+
+# A cached identity is not trusted once its User changed elsewhere
+def test_a_changed_user_is_reloaded(client, token, elsewhere):
+    assert client.get("/me", headers=token).json["username"] == "user7"
+    User.query.get(7).username = "renamed"
+    db.session.commit()
+    assert client.get("/me", headers=token).json["username"] == "renamed"
+
+# Nor once its User was deleted, the token stops working right away
+def test_a_deleted_user_is_not_served(client, token, elsewhere):
+    assert client.get("/me", headers=token).status_code == 200
+    User.delete(7)
+    db.session.commit()
+    assert client.get("/me", headers=token).status_code == 401
+    assert client.post("/me", headers=token, data={}).status_code == 401
+
+# The identity cache keeps a User until the change is committed, a rolled back
+# change is never dropped from it, nor read back into it
+def test_identities_are_dropped_on_commit(client, token):
+    client.get("/me", headers=token)
+    with models.unit_of_work():
+        user = User.query.get(7)
+        User.update(user, "renamed", "password", user.faculties[0].id, [])
+        assert models.identity_cache.get(7)["username"] == "user7"
+    assert models.identity_cache.get(7) is None
+
+def test_rolled_back_changes_keep_the_identity(client, token):
+    client.get("/me", headers=token)
+    with pytest.raises(ValueError), models.unit_of_work():
+        User.query.get(7).username = "renamed"
+        db.session.flush()
+        raise ValueError
+    assert models.identity_cache.get(7)["username"] == "user7"
+
+def _etag(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return response.headers["ETag"]
+
+# A profile's ETag changes with the student counts of its Classes it renders,
+# not when someone joins another Class
+def test_profile_etags(client):
+    url = "/user/7"
+    etag = _etag(client, url)
+    mine = db.session.scalars(db.select(ClassStudents.c.class_id).where(ClassStudents.c.user_id == 7)).all()
+    other = db.session.scalar(db.select(Class.id).where(~Class.id.in_(mine)).order_by(Class.id))
+    newcomer = db.session.scalar(db.select(User.id).where(~User.id.in_(
+        db.select(ClassStudents.c.user_id).where(ClassStudents.c.class_id.in_([mine[0], other]))
+    )).order_by(User.id))
+
+    Class.enroll(other, [newcomer])
+    db.session.commit()
+    assert _etag(client, url) == etag
+
+    Class.enroll(mine[0], [newcomer])
+    db.session.commit()
+    assert _etag(client, url) != etag